@@ -13,20 +13,26 @@ The functions in here are quite testable - so some coverage wouldn't hurt. Funct
 all available days and kernels have been parsed would also be interesting.
 
 One doesn't need to use this script unless rebuilding the data/ files from scratch, or in the event that additional
-dates/kernels are made available.
+dates/kernels are made available. For the latter, answer 'y' to the incremental update prompt: only the days that are
+not complete in data/ are listed, only the XML of granules that are not indexed yet is fetched, and the new rows are
+merged into the existing data/aqua_positions_<year>.csv.zip files (see update_positions_incrementally).
 """
 import datetime
 import re
 import os
+from functools import partial
 from getpass import getpass
 from time import sleep
+import pandas
 from tqdm import tqdm
 from multiprocessing.pool import ThreadPool as Pool
 
 from urllib3.exceptions import NewConnectionError, MaxRetryError
 from requests.exceptions import ConnectionError
 from classes._http import SessionWithHeaderRedirection
-from classes.calculate_GCA import calculate_gca_for_files_and_zip
+from classes.calculate_GCA import calculate_gca, calculate_gca_for_files_and_zip
+from classes.granule import GRANULES_PER_DAY
+from classes.position_index import PositionIndex
 
 THREADS = 13
 
@@ -36,6 +42,20 @@ XML_FILENAME_PATTERN = re.compile(
 
 XML_LON = re.compile(r'LonGranuleCen</PSAName>\n\s*<PSAValue>(.+?)<', re.MULTILINE)
 XML_LAT = re.compile(r'LatGranuleCen</PSAName>\n\s*<PSAValue>(.+?)<', re.MULTILINE)
+XML_BOUNDING_RECTANGLE = [
+    re.compile(r'<%sBoundingCoordinate>(.+?)</%sBoundingCoordinate>' % (side, side))
+    for side in ('West', 'North', 'East', 'South')
+]
+
+
+def get_bounding_rectangle(xml):
+    """Returns the (west, north, east, south) footprint of a granule from its XML, or empty values if the XML does
+    not have a BoundingRectangle. A west coordinate greater than the east one means the granule crosses the
+    antimeridian."""
+    try:
+        return tuple(float(re.findall(pattern, xml)[0]) for pattern in XML_BOUNDING_RECTANGLE)
+    except IndexError:
+        return ('', '', '', '')
 
 
 def get_html(http_client, url, count=0, echo=False):
@@ -111,7 +131,10 @@ def get_information_from_xml(period, files):
                     _longitude = int(re.findall(XML_LON, xml)[0])
                     _latitude = int(re.findall(XML_LAT, xml)[0])
 
-                    _positions.append((_year, _day, _kernel, _latitude, _longitude, filename.replace('.xml', '')))
+                    _west, _north, _east, _south = get_bounding_rectangle(xml)
+
+                    _positions.append((_year, _day, _kernel, _latitude, _longitude, _west, _north, _east, _south,
+                                       filename.replace('.xml', '')))
                     # print('    - Read %s/%s/%s' % (_year, _day, _kernel))
                 except IndexError as e:
                     print("Error encountered, will retry.")
@@ -141,6 +164,76 @@ def get_information_from_xml(period, files):
     return _positions
 
 
+def list_days(http_client, base_url, year):
+    html = get_html(http_client, "%s/%s/" % (base_url, year))
+    return sorted(set(re.findall(DAY_PATTERN, html)))
+
+
+def list_xml_files(http_client, base_url, year, day):
+    html = get_html(http_client, "%s/%s/%s" % (base_url, year, day))
+    return sorted(set(re.findall(XML_FILENAME_PATTERN, html)))
+
+
+def read_position_from_xml(http_client, base_url, year, day, filename):
+    """Returns the position row of a single granule, or None if its XML could not be fetched or parsed"""
+    xml = get_html(http_client, "%s/%s/%s/%s" % (base_url, year, day, filename))
+    try:
+        _longitude = int(re.findall(XML_LON, xml)[0])
+        _latitude = int(re.findall(XML_LAT, xml)[0])
+    except (IndexError, TypeError):
+        print('[read_position_from_xml] Could not read position for %s/%s/%s' % (year, day, filename))
+        return None
+    _west, _north, _east, _south = get_bounding_rectangle(xml)
+
+    return (year, int(day), int(filename.split('.')[4]), _latitude, _longitude, _west, _north, _east, _south,
+            filename.replace('.xml', ''))
+
+
+def update_positions_incrementally(http_client, base_url, year, position_index=None, threads=THREADS):
+    """
+    Adds the granules of a year that are not yet in the position index. Days that already have every granule indexed
+    are skipped without any request, the other days are listed, and XML is only fetched for the granules missing from
+    the index. The new rows get their GCA calculated and are merged into data/aqua_positions_<year>.csv.zip.
+    Returns the number of granules added.
+    """
+    if position_index is None:
+        position_index = PositionIndex()
+    indexed = position_index.indexed_filenames(year)
+
+    missing = []
+    for day in list_days(http_client, base_url, year):
+        indexed_for_day = indexed.get(int(day), set())
+        if len(indexed_for_day) >= GRANULES_PER_DAY:
+            continue
+        missing += [
+            (day, filename) for filename in list_xml_files(http_client, base_url, year, day)
+            if filename.replace('.xml', '') not in indexed_for_day
+        ]
+
+    print('    - %s granules missing from the index for %s' % (len(missing), year))
+    if not missing:
+        return 0
+
+    with Pool(processes=threads) as pool:
+        positions = pool.starmap(partial(read_position_from_xml, http_client, base_url, year), missing)
+
+    positions = [position for position in positions if position is not None]
+    if len(positions) < len(missing):
+        print('    - %s granules could not be read and were not added' % (len(missing) - len(positions)))
+    if not positions:
+        return 0
+
+    data = pandas.DataFrame(positions, columns=['year', 'day', 'granule', 'lat', 'lon', 'west', 'north', 'east',
+                                                'south', 'hdf_filename'])
+    for column in ('west', 'north', 'east', 'south'):
+        data[column] = pandas.to_numeric(data[column], errors='coerce')
+    data = calculate_gca(data)
+
+    position_index.merge(year, data)
+
+    return len(data)
+
+
 if __name__ == '__main__':
     user_name = input('Username for GESDISC/Earthdata Login: ')
     password = getpass()
@@ -166,6 +259,15 @@ if __name__ == '__main__':
     except ValueError:
         BASE_URL = chosen_url
     print('Chosen URL: {}'.format(BASE_URL))
+
+    if input('Incremental update (only fetch granules missing from the data/ files)? y/n: ') == 'y':
+        with SessionWithHeaderRedirection(user_name, password) as client:
+            for year in range(STARTING_YEAR, ENDING_YEAR + 1):
+                print('Updating positions for %s...' % year)
+                added = update_positions_incrementally(client, BASE_URL, year)
+                print('%s finished, %s granules added' % (year, added))
+        exit(0)
+
     output_dir = ''
     while output_dir == '' or not os.path.exists(output_dir):
         output_dir = input('Output path: ')
@@ -227,14 +329,14 @@ if __name__ == '__main__':
             pool.close()
             pool.join()
 
-            # [[_year, _day, _kernel, _latitude, _longitude, hdf_filename], ...]
+            # [[_year, _day, _kernel, _latitude, _longitude, _west, _north, _east, _south, hdf_filename], ...]
             positions = position_results.get()
             with open(os.path.join(temp_directory_name, 'aqua_positions_%s.csv' % year), 'w') as output_file:
-                output_file.write('year,day,kernel,lat,lon,hdf_filename\n')
+                output_file.write('year,day,kernel,lat,lon,west,north,east,south,hdf_filename\n')
                 for resulting_groups in positions:
                     for position in tqdm(resulting_groups, desc='Writing data'):
                         if position is not None:
-                            output_file.write('%s,%s,%s,%s,%s,%s\n' % position)
+                            output_file.write('%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n' % position)
                             # print('    - Wrote %s/%s/%s' % position[:3])
                         else:
                             dropped_data = True
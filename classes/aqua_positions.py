@@ -1,9 +1,11 @@
-import math
-import os
 from datetime import datetime
 
+import numpy as np
 import pandas
 
+from .position_index import PositionIndex
+from .solar import central_angle, reference_points
+
 BASE_URL = 'https://airsl2.gesdisc.eosdis.nasa.gov/data/Aqua_AIRS_Level2/AIRS2CCF.006/'
 
 
@@ -207,51 +209,135 @@ def calculate_lat_lon_filter_condition(data, min_lat, max_lat, min_lon, max_lon,
     return geo_condition
 
 
+def calculate_footprint_filter_condition(data, min_lat, max_lat, min_lon, max_lon, include_prime_meridian):
+    """Selects the granules whose footprint (lat_min, lat_max, lon_west, lon_east) intersects the requested area. The
+    longitude slice follows the same prime meridian logic as calculate_lat_lon_filter_condition."""
+    latitude_condition = (data.lat_max >= min_lat) & (data.lat_min <= max_lat)
+
+    lon_naively_contains_zero = (min_lon <= 0 <= max_lon)
+    special_logic = not ((lon_naively_contains_zero and include_prime_meridian) or
+                         (not lon_naively_contains_zero and not include_prime_meridian))
+    if special_logic:
+        area_intervals = [(-180, min_lon), (max_lon, 180)]
+    else:
+        area_intervals = [(min_lon, max_lon)]
+
+    # -180 and 180 are the same meridian
+    if any(east >= 180 for _west, east in area_intervals):
+        area_intervals.append((-180, -180))
+    if any(west <= -180 for west, _east in area_intervals):
+        area_intervals.append((180, 180))
+
+    # footprints crossing the antimeridian are split in two intervals, [west, 180] and [-180, east]
+    crosses_antimeridian = data.lon_west > data.lon_east
+    footprint_intervals = [
+        (data.lon_west, data.lon_east.where(~crosses_antimeridian, 180)),
+        (data.lon_west.where(~crosses_antimeridian, -180), data.lon_east),
+    ]
+
+    longitude_condition = False
+    for area_west, area_east in area_intervals:
+        for footprint_west, footprint_east in footprint_intervals:
+            longitude_condition |= (footprint_west <= area_east) & (footprint_east >= area_west)
+
+    return latitude_condition & longitude_condition
+
+
+class PositionQuery(object):
+    """The region and GCA settings of one granule selection, as passed to AquaPositions.get_hdf_urls_for_queries.
+    gca_reference is the point GCA is measured from: 'subsolar', 'antisolar' or a [latitude, longitude] pair."""
+
+    def __init__(self, min_latitude, min_longitude, max_latitude, max_longitude, include_prime_meridian,
+                 gca_threshold, gca_is_max, gca_reference='subsolar'):
+        self.min_latitude = min_latitude
+        self.min_longitude = min_longitude
+        self.max_latitude = max_latitude
+        self.max_longitude = max_longitude
+        self.include_prime_meridian = include_prime_meridian
+        self.gca_threshold = gca_threshold
+        self.gca_is_max = gca_is_max
+        self.gca_reference = gca_reference
+
+    def calculate_condition(self, data):
+        condition = np.array(calculate_footprint_filter_condition(data, self.min_latitude, self.max_latitude,
+                                                                  self.min_longitude, self.max_longitude,
+                                                                  self.include_prime_meridian), dtype=bool)
+
+        # check if granule was captured within min/max specified GCA. It is only calculated for the granules in the
+        # area, rounded to 0.1 degrees like the GCA column of the data/ files.
+        gca = self.calculate_gca(data[condition])
+        if self.gca_is_max:
+            condition[condition] = gca <= self.gca_threshold
+        else:
+            condition[condition] = gca >= self.gca_threshold
+
+        return pandas.Series(condition, index=data.index)
+
+    def calculate_gca(self, data):
+        reference_lat, reference_lon = reference_points(self.gca_reference, data.year, data.day, data.granule)
+        return np.round(central_angle(data.lat, data.lon, reference_lat, reference_lon), 1)
+
+
 class AquaPositions(object):
 
+    def __init__(self, position_index=None):
+        self._position_index = position_index if position_index is not None else PositionIndex()
+
     def get_hdf_urls(self, start_granule, end_granule, min_latitude, min_longitude, max_latitude, max_longitude,
-                     include_prime_meridian, gca_threshold, gca_is_max, test_hdf_output):
-        min_year, max_year = start_granule.year, end_granule.year
-        base_dir = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', 'data'))
+                     include_prime_meridian, gca_threshold, gca_is_max, test_hdf_output, gca_reference='subsolar'):
+        query = PositionQuery(min_latitude, min_longitude, max_latitude, max_longitude, include_prime_meridian,
+                              gca_threshold, gca_is_max, gca_reference)
+        data = self._get_granules_in_time_range(start_granule, end_granule)
+
+        data = data[query.calculate_condition(data)].reset_index(drop=True)
+        data['hdf_filename'] = self._position_index.hdf_filenames(data.year, data.filename_id)
+        data['GCA'] = query.calculate_gca(data)
+
+        if test_hdf_output:
+            return data
+
+        return (self.get_url(filename) for filename in data.hdf_filename)
 
-        data_files = [
-            os.path.join(base_dir, 'aqua_positions_%s.csv.zip' % year) for year in range(min_year, max_year + 1)
+    def get_hdf_urls_for_queries(self, start_granule, end_granule, queries):
+        """
+        Selects granules for several PositionQuery objects sharing the same time range, reading and slicing the
+        position table only once. Returns a tuple with the list of URLs for each query (in the same order as queries)
+        and the sorted list of URLs selected by any of them.
+        """
+        data = self._get_granules_in_time_range(start_granule, end_granule)
+        conditions = [query.calculate_condition(data).to_numpy() for query in queries]
+
+        selected = np.logical_or.reduce(conditions) if conditions else np.zeros(len(data), dtype=bool)
+        urls = np.empty(len(data), dtype=object)
+        urls[selected] = [
+            self.get_url(filename)
+            for filename in self._position_index.hdf_filenames(data.year[selected], data.filename_id[selected])
         ]
 
-        data = pandas.concat(
-            (pandas.read_csv(filename) for filename in data_files), sort=True
-        )
+        return [list(urls[condition]) for condition in conditions], sorted(urls[selected])
 
-        condition = calculate_lat_lon_filter_condition(data, min_latitude, max_latitude, min_longitude,
-                                                       max_longitude, include_prime_meridian,
-                                                       is_search_area=True)
+    def _get_granules_in_time_range(self, start_granule, end_granule):
+        """Returns the rows of the position table within the date range and the daily time window"""
+        # the index is sorted on int(Granule), so the date range is resolved with a binary search and the remaining
+        # predicates only run on the rows in range. A time window that wraps around midnight also applies to the
+        # first and last day, so in that case the whole days are sliced instead.
+        if end_granule.granule_number >= start_granule.granule_number:
+            start_key, end_key = int(start_granule), int(end_granule)
+        else:
+            start_key, end_key = start_granule.date_value * 1000, end_granule.date_value * 1000 + 999
+        data = self._position_index.get_range(start_key, end_key)
 
         # granule times must be within the specified range - this can be calculated against the granule numbers
         if end_granule.granule_number >= start_granule.granule_number:
-            condition &= (
+            condition = (
                     (data.granule >= start_granule.granule_number) & (data.granule <= end_granule.granule_number)
             )
         else:
-            condition &= (
+            condition = (
                 ((data.granule >= start_granule.granule_number) | (data.granule <= end_granule.granule_number))
             )
 
-        # check if granule was captured within min/max specified solar GCA
-        if gca_is_max:
-            condition &= (data.GCA <= gca_threshold)
-        else:
-            condition &= (data.GCA >= gca_threshold)
-
-        # granule dates must be within the specified range
-        data['date_value'] = data.year * 1000 + data.day  # same value as in Granule
-        condition &= ((data.date_value >= start_granule.date_value) & (data.date_value <= end_granule.date_value))
-
-        data = data[condition]
-
-        if test_hdf_output:
-            return data
-
-        return (self.get_url(filename) for filename in data.hdf_filename)
+        return data[condition].reset_index(drop=True)
 
     @staticmethod
     def get_url(filename):
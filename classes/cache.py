@@ -0,0 +1,142 @@
+"""
+Granule cache shared by all data directories. Granule filenames are unique (they include the production time), so the
+cache is keyed by filename and remembers the size and MD5 checksum of each file. Data directories get their granules
+from the cache as hard links, or copies where the cache is on another file system, instead of downloading them again.
+
+The cache keeps at most quota bytes. When a new granule would exceed it, the least recently used granules are evicted.
+Evicting only removes the cache's own link: data directories that linked the granule keep their file.
+
+The index is an SQLite database in the cache directory, so several jobs can share the cache at the same time.
+"""
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from .catalog import chunked_select
+
+INDEX_FILENAME = 'granule_cache.sqlite3'
+DEFAULT_QUOTA_GB = 200
+
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        raise
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class GranuleCache(object):
+    def __init__(self, directory, quota=DEFAULT_QUOTA_GB * 1e9):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.quota = quota
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        self._connection = sqlite3.connect(os.path.join(directory, INDEX_FILENAME), check_same_thread=False,
+                                           timeout=60)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS granules (name TEXT PRIMARY KEY, size INTEGER NOT NULL, md5 TEXT, '
+            'last_used REAL NOT NULL)')
+
+    def __contains__(self, name):
+        return bool(self.stored([name]))
+
+    @property
+    def size(self):
+        with self._lock:
+            return self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM granules').fetchone()[0]
+
+    def stored(self, names):
+        """Returns the set of names that are in the cache"""
+        with self._lock:
+            return set(row[0] for row in chunked_select(
+                self._connection, 'SELECT name FROM granules WHERE name IN (%s)', names))
+
+    def fetch(self, name, destination):
+        """
+        Links the cached granule name to destination, and returns its (size, md5), or None (a miss) if the granule is
+        not cached. Entries whose file is gone or has the wrong size are dropped.
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT size, md5 FROM granules WHERE name = ?', (name,)).fetchone()
+        cached = os.path.join(self.directory, name)
+        if row is not None:
+            size, md5 = row
+            try:
+                if os.path.getsize(cached) != size:
+                    raise OSError('%s has the wrong size' % cached)
+                link_or_copy(cached, destination)
+            except FileExistsError:
+                pass
+            except OSError:
+                self._remove(name)
+            else:
+                with self._lock, self._connection:
+                    self._connection.execute('UPDATE granules SET last_used = ? WHERE name = ?', (time.time(), name))
+                    self.hits += 1
+                return size, md5
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def store(self, filename, md5=None):
+        """Adds the granule at filename to the cache and evicts least recently used granules beyond the quota"""
+        name = os.path.basename(filename)
+        cached = os.path.join(self.directory, name)
+        try:
+            link_or_copy(filename, cached)
+        except FileExistsError:
+            # the cached file is replaced by the new download
+            os.remove(cached)
+            link_or_copy(filename, cached)
+
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO granules VALUES (?, ?, ?, ?)',
+                                     (name, os.path.getsize(cached), md5, time.time()))
+        self._evict(keep=name)
+
+    def _evict(self, keep):
+        with self._lock:
+            total = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM granules').fetchone()[0]
+            if total <= self.quota:
+                return
+            rows = self._connection.execute('SELECT name, size FROM granules WHERE name != ? ORDER BY last_used',
+                                            (keep,)).fetchall()
+
+        for name, size in rows:
+            if total <= self.quota:
+                break
+            self._remove(name)
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def _remove(self, name):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM granules WHERE name = ?', (name,))
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def print_report(self):
+        requests = self.hits + self.misses
+        if not requests:
+            return
+        print('Granule cache: {:,} hits, {:,} misses ({:.1f}% hit rate), {:,} evictions, {:.1f} of {:.1f} GB '
+              'used.'.format(self.hits, self.misses, 100. * self.hits / requests, self.evictions, self.size / 1e9,
+                             self.quota / 1e9))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
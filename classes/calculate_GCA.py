@@ -1,15 +1,17 @@
 import glob
 import os
-import datetime
 import shutil
 import zipfile
 
 import pandas
 import ephem
 import numpy
-from tqdm import tqdm
 
-tqdm.pandas()  # Register tqdm instance with Pandas for progress meter on 'progress_apply' func
+from .position_index import FOOTPRINT_COLUMNS
+from .solar import central_angle, granule_times, subsolar_point, subsolar_points_for_granules
+
+# The row-wise functions below are the original ephem based implementation, kept as the reference for the vectorized
+# routines in classes/solar.py
 
 
 def calculate_central_angle(row):
@@ -44,35 +46,44 @@ def calculate_subsolar_point(row):
     return row
 
 
+def calculate_gca(data, use_subsolar_table=True):
+    """Adds the granule time, subsolar point and GCA columns to a DataFrame of positions (year, day, granule, lat,
+    lon). The subsolar points are computed for whole columns at once (see classes/solar.py), by default through the
+    cached per-year table of the 6 minute granule grid."""
+    times = granule_times(data['year'], data['day'], data['granule'])
+    data['time'] = pandas.to_datetime(times, utc=True)
+
+    if use_subsolar_table:
+        subsolar_lat, subsolar_lon = subsolar_points_for_granules(data['year'], data['day'], data['granule'])
+    else:
+        subsolar_lat, subsolar_lon = subsolar_point(times)
+
+    data['subsolar lat'] = subsolar_lat
+    data['subsolar lon'] = subsolar_lon
+    data['GCA'] = numpy.round(central_angle(data['lat'], data['lon'], subsolar_lat, subsolar_lon), 1)
+
+    return data
+
+
 def calculate_gca_for_files_and_zip(temp_directory: str, output_directory):
     csv_glob = os.path.join(temp_directory, '*.csv')
     temp_output_directory = os.path.join(temp_directory, 'new')
     os.makedirs(temp_output_directory)
     data_files = glob.glob(csv_glob)
 
-    six_minutes = datetime.timedelta(minutes=6)
-    one_day = datetime.timedelta(days=1)
-    data_midnight_offset = datetime.timedelta(minutes=8, seconds=26)
-
     for data_file in data_files:
         data_file_basename = os.path.basename(data_file)
         print("Processing data for %s..." % data_file_basename)
         data = pandas.read_csv(data_file)
         data = pandas.DataFrame(data)
-        data['time'] = pandas.to_datetime(data['year'], format='%Y', utc=True)
-        data['time'] += (data['kernel'] - 1) * six_minutes
-        data['time'] += (data['day'] - 1) * one_day
-        data['time'] += data_midnight_offset
-
-        print("Calculating subsolar points...")
-        data = data.progress_apply(calculate_subsolar_point, axis=1)
-        print("Calculating central angles...")
-        data = data.progress_apply(calculate_central_angle, axis=1)
+        data = data.rename(columns={'kernel': 'granule'})
+        data = calculate_gca(data)
         print("Done with {}!".format(data_file))
         final_filename = os.path.join(temp_directory, 'new', data_file_basename)
-        data = data.rename(columns={'kernel': 'granule'})
-        data.to_csv(final_filename,
-                    columns=['year', 'day', 'granule', 'lat', 'lon', 'hdf_filename', 'GCA'], index=False)
+        columns = ['year', 'day', 'granule', 'lat', 'lon', 'hdf_filename', 'GCA']
+        # keep the granule footprints, when the positions were collected with them
+        columns += [column for column in FOOTPRINT_COLUMNS if column in data]
+        data.to_csv(final_filename, columns=columns, index=False)
 
         print("Finished GCA calculations, zipping CSVs and moving to output directory...")
 
@@ -0,0 +1,185 @@
+"""
+SQLite catalog of the granules stored in a data directory: name, size, mtime, MD5 checksum and whether the file has
+been verified against them. HDFStorage records every download as it lands, so presence checks are indexed lookups
+instead of directory listings.
+
+The catalog is created with one scan of the directory, which also imports the entries of a granule_manifest.json
+written by earlier versions. After that the directory is never listed again; files deleted behind the catalog's back
+are dropped when verification finds them missing (see verification.verify_files).
+
+The catalog also records the layout of the directory (see granule.LAYOUTS), which migration.migrate_directory changes,
+the granules that are only kept as transcoded files (see transcode.drop_transcoded_hdf), and the granules that failed
+extraction. A granule that failed QUARANTINE_AFTER_FAILURES times is quarantined: it is neither downloaded nor
+extracted again. Granule filenames include the production time, so a granule that is reprocessed upstream comes with a
+new name and is not quarantined.
+"""
+import json
+import os
+import sqlite3
+import threading
+
+from .granule import DATE_LAYOUT, FLAT_LAYOUT, find_granule_files
+from .transcode import TRANSCODED_SUFFIX
+
+CATALOG_FILENAME = 'granule_catalog.sqlite3'
+MANIFEST_FILENAME = 'granule_manifest.json'
+
+# names per query in lookups, below SQLite's limit on host parameters
+LOOKUP_CHUNK_SIZE = 500
+
+# a granule that failed extraction once is downloaded again, after the second failure it is quarantined
+QUARANTINE_AFTER_FAILURES = 2
+
+
+def chunked_select(connection, query, names, *parameters):
+    """Runs query, which selects rows of names with a 'name IN (%s)' condition, for chunks of LOOKUP_CHUNK_SIZE names,
+    and returns all rows"""
+    names = list(names)
+    rows = []
+    for start in range(0, len(names), LOOKUP_CHUNK_SIZE):
+        chunk = names[start:start + LOOKUP_CHUNK_SIZE]
+        rows += connection.execute(query % ','.join('?' * len(chunk)), chunk + list(parameters))
+    return rows
+
+
+class GranuleCatalog(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, CATALOG_FILENAME)
+        self._lock = threading.Lock()
+
+        is_new = not os.path.exists(self.path)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS granules (name TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER, '
+            'md5 TEXT, verified INTEGER NOT NULL DEFAULT 0)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS properties (key TEXT PRIMARY KEY, value TEXT)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS failures (name TEXT PRIMARY KEY, reason TEXT NOT NULL, count INTEGER NOT NULL)')
+        # granules whose HDF file was deleted after it was transcoded
+        self._connection.execute('CREATE TABLE IF NOT EXISTS transcoded (name TEXT PRIMARY KEY)')
+        if is_new:
+            self._import_directory()
+
+    def _import_directory(self):
+        """Adds the .hdf granules of the directory and its date subdirectories (unverified, unless a manifest entry
+        verifies them) and the transcoded files without HDF file, and records the date layout if they are in date
+        subdirectories"""
+        manifest = {}
+        manifest_path = os.path.join(self.directory, MANIFEST_FILENAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        rows = []
+        transcoded = []
+        layout = FLAT_LAYOUT
+        files = find_granule_files(self.directory, ('.hdf', TRANSCODED_SUFFIX))
+        for name, path in files.items():
+            if os.path.dirname(path) != self.directory:
+                layout = DATE_LAYOUT
+            if name.endswith(TRANSCODED_SUFFIX):
+                hdf_name = os.path.splitext(name)[0] + '.hdf'
+                if hdf_name not in files:
+                    transcoded.append((hdf_name,))
+                continue
+            stat = os.stat(path)
+            recorded = manifest.get(name, {})
+            verified = recorded.get('size') == stat.st_size and recorded.get('verified_mtime') == stat.st_mtime_ns
+            rows.append((name, stat.st_size, stat.st_mtime_ns, recorded.get('md5'), int(verified)))
+
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO granules VALUES (?, ?, ?, ?, ?)', rows)
+            self._connection.executemany('INSERT OR REPLACE INTO transcoded VALUES (?)', transcoded)
+        self.layout = layout
+
+    @property
+    def layout(self):
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM properties WHERE key = 'layout'").fetchone()
+        return row[0] if row is not None else FLAT_LAYOUT
+
+    @layout.setter
+    def layout(self, layout):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO properties VALUES ('layout', ?)", (layout,))
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM granules').fetchone()[0]
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def add(self, name, size, mtime_ns, md5=None, verified=False):
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO granules VALUES (?, ?, ?, ?, ?)',
+                                     (name, size, mtime_ns, md5, int(verified)))
+
+    def remove(self, name):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM granules WHERE name = ?', (name,))
+            self._connection.execute('DELETE FROM transcoded WHERE name = ?', (name,))
+
+    def record_transcoded(self, name):
+        """Records that granule name is only kept as its transcoded file, its HDF file was deleted"""
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM granules WHERE name = ?', (name,))
+            self._connection.execute('INSERT OR REPLACE INTO transcoded VALUES (?)', (name,))
+
+    def transcoded(self, names):
+        """Returns the set of names that are only kept as transcoded files"""
+        return set(row[0] for row in self._select('SELECT name FROM transcoded WHERE name IN (%s)', names))
+
+    def names(self):
+        with self._lock:
+            return set(row[0] for row in self._connection.execute('SELECT name FROM granules'))
+
+    def _select(self, query, names, *parameters):
+        with self._lock:
+            return chunked_select(self._connection, query, names, *parameters)
+
+    def stored(self, names):
+        """Returns the set of names that are in the catalog"""
+        return set(row[0] for row in self._select('SELECT name FROM granules WHERE name IN (%s)', names))
+
+    def get(self, name):
+        """Returns the verification entry of a granule, {'size', 'md5', 'verified_mtime'}, or None if it is not in the
+        catalog. verified_mtime is None unless the file has been verified at its current mtime."""
+        with self._lock:
+            row = self._connection.execute('SELECT size, mtime_ns, md5, verified FROM granules WHERE name = ?',
+                                           (name,)).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, md5, verified = row
+        return {'size': size, 'md5': md5, 'verified_mtime': mtime_ns if verified else None}
+
+    def record(self, name, size, md5, verified_mtime=None):
+        """Adds or updates a granule that has been verified (or downloaded) at verified_mtime"""
+        self.add(name, size, verified_mtime, md5, verified=verified_mtime is not None)
+
+    def record_failure(self, name, reason):
+        """Records a failed extraction of granule name, and returns whether it is quarantined now"""
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT INTO failures VALUES (?, ?, 1) ON CONFLICT(name) DO UPDATE SET reason = excluded.reason, '
+                'count = count + 1', (name, reason))
+            count = self._connection.execute('SELECT count FROM failures WHERE name = ?', (name,)).fetchone()[0]
+        return count >= QUARANTINE_AFTER_FAILURES
+
+    def quarantined(self, names):
+        """Returns {name: (reason, failure count)} of the quarantined granules among names"""
+        return {name: (reason, count) for name, reason, count in self._select(
+            'SELECT name, reason, count FROM failures WHERE name IN (%s) AND count >= ?', names,
+            QUARANTINE_AFTER_FAILURES)}
+
+    def clear_quarantine(self):
+        """Forgets all failures, so quarantined granules are downloaded and extracted again"""
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM failures')
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
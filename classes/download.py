@@ -0,0 +1,325 @@
+"""
+Granule downloads. AsyncDownloader runs up to max_connections transfers at once from a single process: an asyncio event
+loop schedules the URLs and each transfer streams to disk in a worker thread. Each worker thread keeps one long-lived
+session (see create_session), so the keep-alive connection to the data server and the Earthdata login cookies are
+reused across files. Only the first file of a thread pays the TLS handshake and the urs.earthdata.nasa.gov redirect
+round trip.
+
+Failed transfers are retried per URL with jittered exponential backoff (see RetryPolicy). A URL waiting for its next
+attempt does not hold a connection, so slow or flaky granules do not hold up the others.
+
+Completion callbacks run in threads of their own, never on the event loop, while holding one of the max_connections
+slots. A slow callback (a consumer whose queue is full, a copy into the granule cache) therefore slows down new
+transfers, but retry timers and the transfers in flight carry on.
+
+Transfers are written to a .part file next to the target, and renamed to the granule name only once their length has
+been verified, so a granule file on disk is always complete. A .part file left by an interrupted transfer is resumed
+with an HTTP Range request.
+"""
+import asyncio
+import hashlib
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ._http import SessionWithHeaderRedirection
+
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = 10
+PART_SUFFIX = '.part'
+
+# hosts a session keeps connections to: the data server, urs.earthdata.nasa.gov and the occasional mirror
+POOL_CONNECTIONS = 4
+
+# GESDISC allows at most 15 concurrent connections per user
+MAX_CONNECTIONS = 15
+DEFAULT_MAX_CONNECTIONS = 10
+
+DEFAULT_MAX_ATTEMPTS = 10
+# delay before the second attempt of a URL, doubled for every further attempt up to MAX_RETRY_DELAY, in seconds
+BASE_RETRY_DELAY = 2
+MAX_RETRY_DELAY = 120
+# the granule does not exist (anymore), retrying will not help
+PERMANENT_HTTP_STATUSES = (404, 410)
+
+
+class IncompleteDownloadError(Exception):
+    pass
+
+
+class DownloadResult(object):
+    """Outcome of a single download. handshake_seconds is the time until the response headers arrived (connection,
+    TLS, login redirects and server latency), transfer_seconds the time spent receiving the body. size is the number
+    of bytes received, resumed_from the size of the .part file the transfer continued, file_size and md5 describe the
+    complete file."""
+
+    def __init__(self, url, size=0, handshake_seconds=0., transfer_seconds=0., redirects=0, error=None,
+                 http_status=None, resumed_from=0, file_size=None, md5=None, error_type=None):
+        self.url = url
+        self.size = size
+        self.resumed_from = resumed_from
+        self.file_size = file_size
+        self.md5 = md5
+        self.handshake_seconds = handshake_seconds
+        self.transfer_seconds = transfer_seconds
+        self.redirects = redirects
+        self.error = error
+        self.error_type = error_type
+        self.http_status = http_status
+        # attempts made for the URL, and the error types of the failed ones
+        self.attempts = 1
+        self.error_types = [error_type] if error_type else []
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    @property
+    def filename(self):
+        return self.url.split('/')[-1]
+
+    @property
+    def is_permanent_failure(self):
+        return self.http_status in PERMANENT_HTTP_STATUSES
+
+    @property
+    def status(self):
+        if self.succeeded:
+            return 'downloaded'
+        return 'missing' if self.is_permanent_failure else 'failed'
+
+
+class RetryPolicy(object):
+    """How often and when failed downloads are retried: up to max_attempts attempts per URL, waiting
+    base_delay * 2 ** (attempt - 1) seconds (at most max_delay) times a random factor between 0.5 and 1.5 before the
+    next one. URLs that fail with one of PERMANENT_HTTP_STATUSES are not retried."""
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=BASE_RETRY_DELAY, max_delay=MAX_RETRY_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, result):
+        return not result.succeeded and not result.is_permanent_failure and result.attempts < self.max_attempts
+
+    def delay(self, attempt):
+        """Seconds to wait after the given (failed) attempt"""
+        return min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+
+def create_session(username, password, pool_size=1):
+    """Returns a SessionWithHeaderRedirection that keeps up to pool_size connections open per host"""
+    session = SessionWithHeaderRedirection(username, password)
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def download_url(url, output_dir, session):
+    """Downloads url with session. Errors are returned in the DownloadResult instead of raised."""
+    try:
+        return perform_download(url, output_dir, session=session)
+    except requests.exceptions.HTTPError as e:
+        return DownloadResult(url, error=str(e), http_status=e.response.status_code,
+                              error_type='HTTP %s' % e.response.status_code)
+    except Exception as e:
+        return DownloadResult(url, error='%s: %s' % (type(e).__name__, e), error_type=type(e).__name__)
+
+
+def update_checksum(checksum, filename):
+    """Updates checksum (a hashlib object) with the contents of filename and returns it"""
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return checksum
+
+
+def file_md5(filename):
+    return update_checksum(hashlib.md5(), filename).hexdigest()
+
+
+def parse_content_range(content_range):
+    """Returns (first byte, total length) of a Content-Range header; total is None if unknown"""
+    _unit, _, byte_range = content_range.partition(' ')
+    first_to_last, _, total = byte_range.partition('/')
+    first = first_to_last.split('-')[0]
+    return (int(first) if first.isdigit() else None), (int(total) if total.isdigit() else None)
+
+
+def perform_download(url, output_dir, username=None, password=None, session=None):
+    """Downloads url into output_dir and returns a DownloadResult. Uses a new session (closed afterwards) if none is
+    passed. Raises IncompleteDownloadError if fewer bytes than announced arrived; the .part file is kept to resume."""
+    if session is None:
+        with create_session(username, password) as session:
+            return perform_download(url, output_dir, session=session)
+
+    filename = os.path.join(output_dir, url.split('/')[-1])
+    part_filename = filename + PART_SUFFIX
+    offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+
+    started = time.perf_counter()
+    response = session.get(url, stream=True, timeout=TIMEOUT,
+                           headers={'Range': 'bytes=%s-' % offset} if offset else None)
+    headers_received = time.perf_counter()
+    try:
+        if response.status_code == 416:
+            # nothing left after offset: the .part file is either complete or longer than the file
+            _first, total = parse_content_range(response.headers.get('Content-Range', ''))
+            if total != offset:
+                os.remove(part_filename)
+                raise IncompleteDownloadError('%s bytes of %s could not be resumed' % (offset, filename))
+            total, size = offset, 0
+            checksum = update_checksum(hashlib.md5(), part_filename)
+        else:
+            response.raise_for_status()  # raise an exception in case of http errors
+
+            if response.status_code == 206:
+                first, total = parse_content_range(response.headers.get('Content-Range', ''))
+                if first != offset:
+                    os.remove(part_filename)
+                    raise IncompleteDownloadError('Server resumed %s at byte %s instead of %s'
+                                                  % (filename, first, offset))
+            else:
+                # a full response, either because nothing was stored yet or because the server ignored the Range
+                offset = 0
+                length = response.headers.get('Content-Length')
+                total = int(length) if length is not None and length.isdigit() else None
+
+            # the checksum is calculated while streaming, only a resumed .part file is read back
+            checksum = update_checksum(hashlib.md5(), part_filename) if offset else hashlib.md5()
+            size = 0
+            with open(part_filename, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    checksum.update(chunk)
+                    size += len(chunk)
+    finally:
+        response.close()
+
+    received = os.path.getsize(part_filename)
+    if total is not None and received != total:
+        raise IncompleteDownloadError('Received %s of %s bytes of %s' % (received, total, filename))
+    os.replace(part_filename, filename)
+
+    return DownloadResult(url, size, headers_received - started, time.perf_counter() - headers_received,
+                          len(response.history), resumed_from=offset, file_size=received, md5=checksum.hexdigest())
+
+
+class AsyncDownloader(object):
+    """
+    Downloads lists of URLs with at most max_connections (capped at MAX_CONNECTIONS) transfers in flight. The
+    transfer threads and their sessions are kept between download calls, and calls from several threads share them,
+    so the cap holds for everything the downloader fetches at once. Call close() when done.
+    """
+
+    def __init__(self, username, password, max_connections=DEFAULT_MAX_CONNECTIONS, retry_policy=None):
+        if max_connections < 1:
+            raise ValueError('max_connections must be at least 1.')
+        if max_connections > MAX_CONNECTIONS:
+            print('WARNING: GESDISC allows at most %s connections, using %s instead of %s.'
+                  % (MAX_CONNECTIONS, MAX_CONNECTIONS, max_connections))
+            max_connections = MAX_CONNECTIONS
+
+        self.max_connections = max_connections
+        self.retry_policy = retry_policy or RetryPolicy()
+        self._username = username
+        self._password = password
+        self._executor = ThreadPoolExecutor(max_workers=max_connections)
+        self._callback_executor = ThreadPoolExecutor(max_workers=max_connections)
+        self._thread_state = threading.local()
+        self._sessions = []
+
+    def download(self, urls, output_dir, on_complete=None):
+        """Downloads urls into output_dir (a directory, or a function that returns the directory of a URL) and returns
+        their DownloadResults, in the order of urls, after retrying failures according to the retry policy.
+        on_complete is called with the final DownloadResult of each URL as soon as it is known, in a callback thread.
+        It may block to hold up further transfers."""
+        return asyncio.run(self._download_all(list(urls), output_dir, on_complete))
+
+    def close(self):
+        self._executor.shutdown()
+        self._callback_executor.shutdown()
+        for session in self._sessions:
+            session.close()
+
+    def _download_in_thread(self, url, output_dir):
+        if callable(output_dir):
+            output_dir = output_dir(url)
+        if not hasattr(self._thread_state, 'session'):
+            self._thread_state.session = create_session(self._username, self._password)
+            self._sessions.append(self._thread_state.session)
+        return download_url(url, output_dir, self._thread_state.session)
+
+    async def _download_all(self, urls, output_dir, on_complete):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_connections)
+
+        async def attempt(url):
+            async with slots:
+                return await loop.run_in_executor(self._executor, self._download_in_thread, url, output_dir)
+
+        async def download(url):
+            result = await attempt(url)
+            error_types = result.error_types
+            while self.retry_policy.should_retry(result):
+                await asyncio.sleep(self.retry_policy.delay(result.attempts))
+                attempts = result.attempts + 1
+                result = await attempt(url)
+                result.attempts = attempts
+                error_types += result.error_types
+                result.error_types = error_types
+
+            if on_complete is not None:
+                # a blocked callback takes up a connection slot, which is the back-pressure on the transfers
+                async with slots:
+                    await loop.run_in_executor(self._callback_executor, on_complete, result)
+            return result
+
+        return await asyncio.gather(*(download(url) for url in urls))
+
+
+def print_download_summary(results):
+    """Prints the handshake vs transfer time of a list of DownloadResults"""
+    downloaded = [result for result in results if result.succeeded]
+    failed = len(results) - len(downloaded)
+
+    if downloaded:
+        handshake = sum(result.handshake_seconds for result in downloaded)
+        transfer = sum(result.transfer_seconds for result in downloaded)
+        size = sum(result.size for result in downloaded)
+        redirected = sum(1 for result in downloaded if result.redirects)
+        print('Downloaded {0:,} files ({1:.1f} MB): {2:.1f}s connecting/authenticating ({3:.3f}s per file, {4:,} '
+              'with login redirects), {5:.1f}s transferring ({6:.1f} MB/s per connection).'.format(
+                len(downloaded), size / 1e6, handshake, handshake / len(downloaded), redirected, transfer,
+                size / 1e6 / transfer if transfer else 0))
+
+    print_failure_summary(results)
+
+
+def print_failure_summary(results):
+    """Prints the URLs that are missing upstream, and the ones that failed after all attempts with their errors"""
+    missing = [result for result in results if result.status == 'missing']
+    failed = [result for result in results if result.status == 'failed']
+
+    if missing:
+        print('{:,} granules do not exist on the server (HTTP {}):'.format(
+            len(missing), '/'.join(str(status) for status in PERMANENT_HTTP_STATUSES)))
+        for result in missing:
+            print('  %s' % result.filename)
+
+    if failed:
+        error_counts = {}
+        for result in failed:
+            for error_type in result.error_types:
+                error_counts[error_type] = error_counts.get(error_type, 0) + 1
+        print('{:,} granules failed to download after up to {} attempts ({}):'.format(
+            len(failed), max(result.attempts for result in failed),
+            ', '.join('%s x %s' % (count, error_type) for error_type, count in sorted(error_counts.items()))))
+        for result in failed:
+            print('  %s: %s' % (result.filename, result.error))
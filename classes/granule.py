@@ -1,7 +1,32 @@
+import os
+import re
 from calendar import isleap, month_name
 from datetime import datetime, timedelta
 from functools import total_ordering
 
+import numpy as np
+
+GRANULES_PER_DAY = 240
+
+# layouts of a data directory: all granules in the directory itself, or in <year>/<day of year>/ subdirectories
+FLAT_LAYOUT = 'flat'
+DATE_LAYOUT = 'date'
+LAYOUTS = (FLAT_LAYOUT, DATE_LAYOUT)
+
+# AIRS.YYYY.MM.DD.GGG. prefix of granule filenames (HDF and transcoded), see GranuleArray.from_filenames
+GRANULE_FILENAME_PATTERN = re.compile(r'AIRS\.\d{4}\.(0[1-9]|1[0-2])\.(0[1-9]|[12]\d|3[01])\.\d{3}\.')
+
+# MONTH_BY_DAY_OF_YEAR[is_leap_year, day_of_year] -> month number (index 0 is unused)
+MONTH_BY_DAY_OF_YEAR = np.zeros((2, 367), dtype=np.uint8)
+for _leap in (0, 1):
+    _month_lengths = [31, 28 + _leap, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+    MONTH_BY_DAY_OF_YEAR[_leap, 1:366 + _leap] = np.repeat(np.arange(1, 13), _month_lengths)
+
+# FIRST_DAY_OF_MONTH[is_leap_year, month] -> day of year of the 1st of that month (index 0 is unused)
+FIRST_DAY_OF_MONTH = np.zeros((2, 13), dtype=np.int64)
+for _leap in (0, 1):
+    FIRST_DAY_OF_MONTH[_leap, 1:] = np.searchsorted(MONTH_BY_DAY_OF_YEAR[_leap, 1:], np.arange(1, 13)) + 1
+
 
 @total_ordering
 class Granule(object):
@@ -23,14 +48,16 @@ class Granule(object):
         return self.year * 10 ** 6 + self.day * 10 ** 3 + self.granule_number
 
     def __add__(self, granule_count: int):
-        days, granule_number = divmod(self.granule_number + granule_count, 240)
-        final_date = datetime.strptime('%s%s' % (self.year, str(self.day).zfill(3)), '%Y%j') + timedelta(days=days)
-        return self.__class__(final_date.year, int(final_date.strftime('%j')), granule_number)
+        return (GranuleArray([int(self)]) + granule_count)[0]
 
     def __eq__(self, other):
+        if isinstance(other, GranuleArray):
+            return NotImplemented
         return int(self) == int(other)
 
     def __gt__(self, other):
+        if isinstance(other, GranuleArray):
+            return NotImplemented
         return int(self) > int(other)
 
     @property
@@ -41,7 +68,7 @@ class Granule(object):
     @property
     def month_period(self):
         """Returns a string representing the period of the year (year and month)"""
-        month = datetime.strptime('%s%s' % (self.year, str(self.day).zfill(3)), '%Y%j').month
+        month = MONTH_BY_DAY_OF_YEAR[int(isleap(self.year)), self.day]
         return '%s %s' % (month_name[month], self.year)
 
     @staticmethod
@@ -115,3 +142,188 @@ class Granule(object):
 
         # return 1 if it exceeds the maximum value for the kernel
         return g ** (g <= 240), g > 240
+
+
+class GranuleArray(object):
+    """
+    A sequence of granules backed by a NumPy array of the same integer keys as int(Granule), for the places where
+    tens of thousands of granules are handled at once. Arithmetic, comparisons, month lookups and filename parsing are
+    vectorized; indexing with an integer returns a regular Granule.
+    """
+
+    def __init__(self, keys, local_file_names=None):
+        self.keys = np.asarray(keys, dtype=np.int64).reshape(-1)
+        self.local_file_names = None if local_file_names is None else np.asarray(local_file_names, dtype=object)
+
+    @classmethod
+    def from_granules(cls, granules):
+        granules = list(granules)
+        local_file_names = [granule.local_file_name for granule in granules]
+        if all(name is None for name in local_file_names):
+            local_file_names = None
+        return cls([int(granule) for granule in granules], local_file_names)
+
+    @classmethod
+    def from_components(cls, year, day, granule_number, local_file_names=None):
+        return cls(granule_keys(year, day, granule_number), local_file_names)
+
+    @classmethod
+    def from_filenames(cls, filenames, directory=None, layout=FLAT_LAYOUT):
+        """Parses HDF filenames or URLs (e.g. .../AIRS.2002.08.30.225.L2.CC.v6.0.7.0.G13201091521.hdf). When a
+        directory is passed, the local file names of the granules point into it, according to its layout."""
+        filenames = [filename.split('/')[-1] for filename in filenames]
+        # AIRS.YYYY.MM.DD.GGG - fixed width, so the digits can be read straight from the bytes
+        prefixes = np.array(filenames, dtype='S19').reshape(-1)
+        if not np.all(np.char.startswith(prefixes, b'AIRS.')):
+            raise ValueError('Not an AIRS granule filename: %s' % filenames[np.argmin(
+                np.char.startswith(prefixes, b'AIRS.'))])
+        digits = prefixes.view(np.uint8).reshape(-1, 19).astype(np.int64) - ord('0')
+
+        year = digits[:, 5] * 1000 + digits[:, 6] * 100 + digits[:, 7] * 10 + digits[:, 8]
+        month = digits[:, 10] * 10 + digits[:, 11]
+        day_of_month = digits[:, 13] * 10 + digits[:, 14]
+        granule_number = digits[:, 16] * 100 + digits[:, 17] * 10 + digits[:, 18]
+        day = FIRST_DAY_OF_MONTH[is_leap_year(year), month] + day_of_month - 1
+
+        local_file_names = None
+        if directory is not None:
+            local_file_names = [os.path.join(granule_directory(directory, granule_year, granule_day, layout), filename)
+                                for filename, granule_year, granule_day in zip(filenames, year, day)]
+
+        return cls.from_components(year, day, granule_number, local_file_names)
+
+    @property
+    def year(self):
+        return self.keys // 10 ** 6
+
+    @property
+    def day(self):
+        return self.keys // 10 ** 3 % 10 ** 3
+
+    @property
+    def granule_number(self):
+        return self.keys % 10 ** 3
+
+    @property
+    def date_value(self):
+        """Returns an array of integers representing year and day of year"""
+        return self.keys // 10 ** 3
+
+    @property
+    def month(self):
+        return MONTH_BY_DAY_OF_YEAR[is_leap_year(self.year), self.day]
+
+    @property
+    def month_period(self):
+        """Returns an array of strings representing the period of the year (year and month)"""
+        periods, inverse = np.unique(self.year * 100 + self.month, return_inverse=True)
+        labels = np.array(['%s %s' % (month_name[period % 100], period // 100) for period in periods], dtype=object)
+        return labels[inverse.reshape(-1)]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            key = int(self.keys[item])
+            local_file_name = None if self.local_file_names is None else self.local_file_names[item]
+            return Granule(key // 10 ** 6, key // 10 ** 3 % 10 ** 3, key % 10 ** 3, local_file_name)
+
+        local_file_names = None if self.local_file_names is None else self.local_file_names[item]
+        return self.__class__(self.keys[item], local_file_names)
+
+    def __repr__(self):
+        return 'GranuleArray<%s granules>' % len(self)
+
+    def __int__(self):
+        raise TypeError('Use GranuleArray.keys to get the integer values of a GranuleArray')
+
+    def __add__(self, granule_count):
+        days, granule_index = np.divmod(self.granule_number - 1 + np.asarray(granule_count, dtype=np.int64),
+                                        GRANULES_PER_DAY)
+        dates = (self.year - 1970).astype('datetime64[Y]').astype('datetime64[D]') + (self.day - 1 + days)
+        years = dates.astype('datetime64[Y]')
+        final_days = (dates - years.astype('datetime64[D]')).astype(np.int64) + 1
+        return self.__class__.from_components(years.astype(np.int64) + 1970, final_days, granule_index + 1,
+                                              self.local_file_names)
+
+    def _other_keys(self, other):
+        if isinstance(other, GranuleArray):
+            return other.keys
+        return np.asarray(other if isinstance(other, (int, np.integer, np.ndarray)) else int(other), dtype=np.int64)
+
+    def __eq__(self, other):
+        return self.keys == self._other_keys(other)
+
+    def __ne__(self, other):
+        return self.keys != self._other_keys(other)
+
+    def __lt__(self, other):
+        return self.keys < self._other_keys(other)
+
+    def __le__(self, other):
+        return self.keys <= self._other_keys(other)
+
+    def __gt__(self, other):
+        return self.keys > self._other_keys(other)
+
+    def __ge__(self, other):
+        return self.keys >= self._other_keys(other)
+
+    __hash__ = None
+
+
+def granule_directory(directory, year, day, layout=FLAT_LAYOUT):
+    """Returns the directory the granules of a day are stored in, in a data directory with the given layout"""
+    if layout == DATE_LAYOUT:
+        return os.path.join(directory, str(year), '%03d' % day)
+    if layout != FLAT_LAYOUT:
+        raise ValueError('Unknown data directory layout %r, use one of %s.' % (layout, ', '.join(LAYOUTS)))
+    return directory
+
+
+def granule_paths(filenames, directory, layout=FLAT_LAYOUT):
+    """Returns {filename: path} of granule filenames in a data directory with the given layout"""
+    filenames = list(filenames)
+    if not filenames:
+        return {}
+    return dict(zip(filenames, GranuleArray.from_filenames(filenames, directory, layout).local_file_names))
+
+
+def find_granule_files(directory, suffixes=('.hdf',)):
+    """Returns {filename: path} of the granule files with the given suffixes stored in a data directory: the ones in
+    the directory itself and the ones in <year>/<day of year>/ subdirectories that match their date. Files in any other
+    subdirectory are not granules of the data directory and are left out."""
+    def is_granule_file(name):
+        return name.endswith(tuple(suffixes)) and GRANULE_FILENAME_PATTERN.match(name) is not None
+
+    found = {}
+    dated = []
+    for entry in os.scandir(directory):
+        if entry.is_file():
+            if is_granule_file(entry.name):
+                found[entry.name] = entry.path
+        elif entry.is_dir() and len(entry.name) == 4 and entry.name.isdigit():
+            for day in os.scandir(entry.path):
+                if day.is_dir() and len(day.name) == 3 and day.name.isdigit():
+                    dated.extend((name, os.path.join(day.path, name)) for name in os.listdir(day.path)
+                                 if is_granule_file(name))
+
+    expected = granule_paths([name for name, _path in dated], directory, DATE_LAYOUT)
+    found.update((name, path) for name, path in dated if expected[name] == path)
+    return found
+
+
+def is_leap_year(year):
+    """Vectorized equivalent of calendar.isleap, returning 0 or 1"""
+    year = np.asarray(year, dtype=np.int64)
+    return ((year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))).astype(np.int64)
+
+
+def granule_keys(year, day, granule_number):
+    """Vectorized equivalent of int(Granule)"""
+    return np.asarray(year, dtype=np.int64) * 10 ** 6 + np.asarray(day, dtype=np.int64) * 10 ** 3 + \
+        np.asarray(granule_number, dtype=np.int64)
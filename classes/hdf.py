@@ -1,16 +1,33 @@
 import os
+import threading
+from functools import partial
 from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
-import pyhdf
-import requests
-from pyhdf.SD import SD
 from pyhdf.error import HDF4Error
 
 from classes.constants import CHANNELS_TO_WAVELENGTHS
-from ._http import SessionWithHeaderRedirection
 from .aqua_positions import calculate_lat_lon_filter_condition
+from .download import DEFAULT_MAX_CONNECTIONS, AsyncDownloader, perform_download, print_download_summary
+from .catalog import GranuleCatalog
+from .granule import FLAT_LAYOUT, granule_paths
+from .migration import migrate_directory
+from .numpy_engine import (CHANNELS, LATITUDE_BUCKETS, PIXELS, bin_sums_and_counts, filter_granule,
+                           granule_cloud_cover, latitude_bins)
+from .transcode import MissingDatasetError, has_current_transcoded, read_granule_datasets
+from .verification import verify_files
+
+PANDAS_ENGINE = 'pandas'
+NUMPY_ENGINE = 'numpy'
+PROCESSING_ENGINES = (PANDAS_ENGINE, NUMPY_ENGINE)
+
+EXTRACTION_PROCESSES = 10
+# failure reason of granules that were not on disk when they were extracted; they are downloaded again instead of being
+# counted towards the quarantine
+FILE_NOT_PRESENT = 'file not present'
+# granules that may wait for or be in extraction at once in HDFDataAggregator.process_stream
+EXTRACTION_QUEUE_SIZE = 2 * EXTRACTION_PROCESSES
 
 
 def print_stats(filter_stats):
@@ -58,23 +75,6 @@ def print_stats(filter_stats):
         pass
 
 
-def perform_download(url, output_dir, username, password):
-    with SessionWithHeaderRedirection(username, password) as http_client:
-        try:
-            response = http_client.get(url, stream=True, timeout=10)
-            response.raise_for_status()  # raise an exception in case of http errors
-
-            filename = os.path.join(output_dir, url.split('/')[-1])
-            with open(filename, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=1024 * 1024):
-                    f.write(chunk)
-
-        except requests.exceptions.HTTPError:
-            raise
-        except Exception as e:
-            raise Exception('Unhandled exception: %s' % e)
-
-
 class HDFFilter(object):
     """
     so a 'curve' is the monthly average of all radiances observed, grouped by wavelength.
@@ -87,7 +87,10 @@ class HDFFilter(object):
                  cloud_cover_threshold_is_max, all_spots_avg_threshold, all_spots_avg_threshold_is_max, noise_amp,
                  dust_flag_no_dust, dust_flag_single_fov, dust_flag_detected, examine_wavenumber_mode,
                  selected_wavenumber, scanang, inside_scanang, solzen_threshold, solzen_is_max, min_lat, max_lat,
-                 min_lon, max_lon, include_prime_meridian, delete_unreadable):
+                 min_lon, max_lon, include_prime_meridian, delete_unreadable, transcode=False, engine=PANDAS_ENGINE,
+                 drop_hdf=False):
+        if engine not in PROCESSING_ENGINES:
+            raise ValueError('Unknown processing engine %r, use one of %s.' % (engine, ', '.join(PROCESSING_ENGINES)))
         self.use_radiance_filters = use_radiance_filters
         self.radiance = radiance
         self.radiance_range = radiance_range
@@ -117,73 +120,269 @@ class HDFFilter(object):
         self.max_lon = max_lon
         self.include_prime_meridian = include_prime_meridian
         self.delete_unreadable = delete_unreadable
+        # write a transcoded file of each granule read from HDF (see transcode.py)
+        self.transcode = transcode
+        # delete the HDF file of a granule once its transcoded file is verified (see transcode.drop_transcoded_hdf)
+        self.drop_hdf = drop_hdf
+        # extract granules with DataFrames (filter_dataset) or with the NumPy engine (see numpy_engine.py)
+        self.engine = engine
 
 
 class HDFStorage(object):
-    def __init__(self, storage_path, username, password):
+    def __init__(self, storage_path, username, password, max_connections=DEFAULT_MAX_CONNECTIONS, retry_policy=None,
+                 cache=None, layout=FLAT_LAYOUT):
         self._username = username
         self._password = password
         self._storage_directory = storage_path
-
-    def download_files(self, urls, count_callback=None):
-        """Downloads all necessary files that are not yet stored on the disk using multiple processes.
-        download_finished_callback and error_callback cannot be bound or unbound methods in Windows, so pass
-        functions instead.
+        self._downloader = AsyncDownloader(username, password, max_connections, retry_policy)
+        self.catalog = GranuleCatalog(storage_path)
+        # granules stored in another layout are moved into this one first
+        migrate_directory(storage_path, layout, self.catalog)
+        self.layout = layout
+        # GranuleCache shared with other storages, or None
+        self.cache = cache
+        # DownloadResult of each URL of the last download_files call
+        self.results = {}
+        # quarantined granules skipped since the storage was opened, {name: (reason, failure count)}
+        self.skipped_quarantined = {}
+
+    def download_files(self, urls, count_callback=None, on_complete=None, prepared=False):
+        """Downloads all necessary files that are not yet stored on the disk, with up to max_connections concurrent
+        transfers and failed URLs retried according to the retry policy. The urls are prepared first (see
+        prepare_files), unless prepared is True because the caller already did. The final outcome of each URL is kept
+        in self.results, and passed to on_complete as soon as it is known.
         """
-        urls = list(self.filter_files(urls, self._storage_directory))
+        urls = list(self.filter_files(urls)) if prepared else self.prepare_files(urls)
 
         if count_callback is not None:
             count_callback(len(urls))
 
-        process_args = [(url, self._storage_directory, self._username, self._password) for url in urls]
-
-        with Pool(processes=5) as pool:
-            pool.starmap_async(perform_download, process_args, callback=lambda x: None, error_callback=lambda x: None)
-            pool.close()
-            pool.join()
+        results = self._downloader.download(urls, self._download_directory,
+                                            partial(self._record_download, on_complete=on_complete))
+        self.results = {result.url: result for result in results}
+        print_download_summary(results)
 
         # check if any files failed to download, and return false if so
-        urls = list(self.filter_files(urls, self._storage_directory))
+        urls = list(self.filter_files(urls))
         return len(urls) == 0
 
-    @staticmethod
-    def filter_files(urls, directory):
-        requested = set(map(lambda x: x.split('/')[-1], urls))
-        existing = set([f for f in os.listdir(directory) if f.endswith('.hdf')])
-        missing = requested.difference(existing)
-        return (url for url in urls if any(map(lambda x: x in url, missing)))
+    def prepare_files(self, urls):
+        """Verifies the stored files of urls, so that bad ones are downloaded again, and links the missing ones from the
+        granule cache. Returns the urls that still have to be downloaded."""
+        urls = list(urls)
+        self.verify_files(urls)
+        self.link_cached_files(urls)
+        return list(self.filter_files(urls))
+
+    def close(self):
+        self._downloader.close()
+        self.catalog.close()
+
+    def file_paths(self, names):
+        """Returns {name: path} of granule filenames in this storage"""
+        return granule_paths(names, self._storage_directory, self.layout)
+
+    def file_path(self, name):
+        return self.file_paths([name])[name]
+
+    def _download_directory(self, url):
+        directory = os.path.dirname(self.file_path(url.split('/')[-1]))
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def verify_files(self, urls):
+        """
+        Verifies the stored files of urls against the catalog and deletes the ones that fail. Files that are on disk
+        but not in the catalog are checked (and added) too, and catalog entries of files that are gone are dropped.
+        Granules whose HDF file is gone but which have a current transcoded file are recorded as transcoded only.
+        """
+        requested = set(url.split('/')[-1] for url in urls)
+        paths = self.file_paths(requested)
+        present = set(name for name, path in paths.items() if os.path.exists(path))
+        transcoded = self.catalog.transcoded(requested)
+        for name in requested - present:
+            if has_current_transcoded(paths[name]):
+                if name not in transcoded:
+                    self.catalog.record_transcoded(name)
+            elif name in transcoded:
+                # the transcoded file is gone too, so the granule is downloaded again
+                self.catalog.remove(name)
+        candidates = [paths[name] for name in present.union(self.catalog.stored(requested))]
+
+        for filename, problem in verify_files(candidates, self.catalog):
+            if os.path.exists(filename):
+                print('Deleting %s: %s' % (filename, problem))
+                os.remove(filename)
+
+    def link_cached_files(self, urls):
+        """
+        Links the files of urls that are missing here from the granule cache, and adds the stored ones the cache does
+        not have yet to it. Call after verify_files, so only good files are shared.
+        """
+        if self.cache is None:
+            return
+        urls = list(urls)
+        missing = self.file_paths(url.split('/')[-1] for url in self.filter_files(urls))
+        for name, filename in missing.items():
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            cached = self.cache.fetch(name, filename)
+            if cached is not None:
+                size, md5 = cached
+                self.catalog.record(name, size, md5, os.stat(filename).st_mtime_ns if md5 else None)
+
+        names = set(url.split('/')[-1] for url in urls)
+        for name in self.catalog.stored(names) - self.cache.stored(names):
+            self.cache.store(self.file_path(name), self.catalog.get(name)['md5'])
+
+    def _record_download(self, result, on_complete=None):
+        if result.succeeded:
+            filename = self.file_path(result.filename)
+            self.catalog.record(result.filename, result.file_size, result.md5, os.stat(filename).st_mtime_ns)
+            if self.cache is not None:
+                self.cache.store(filename, result.md5)
+        if on_complete is not None:
+            on_complete(result)
+
+    def filter_files(self, urls):
+        """Returns the urls whose files are not in the catalog (as HDF or transcoded file), except for quarantined
+        granules"""
+        urls = list(urls)
+        names = [url.split('/')[-1] for url in urls]
+        skipped = self.catalog.stored(names).union(self.catalog.transcoded(names), self._quarantined(names))
+        return (url for url in urls if url.split('/')[-1] not in skipped)
+
+    def stored_granules(self, granules):
+        """Returns the granules that are in the catalog or on disk (or only have a transcoded file)"""
+        granules = list(granules)
+        cataloged = self.catalog.stored(os.path.basename(granule.local_file_name) for granule in granules)
+        return [granule for granule in granules if os.path.basename(granule.local_file_name) in cataloged or
+                os.path.exists(granule.local_file_name) or has_current_transcoded(granule.local_file_name)]
+
+    def without_quarantined(self, granules):
+        """Returns the granules that are not quarantined"""
+        granules = list(granules)
+        quarantined = self._quarantined(os.path.basename(granule.local_file_name) for granule in granules)
+        return [granule for granule in granules if os.path.basename(granule.local_file_name) not in quarantined]
+
+    def _quarantined(self, names):
+        quarantined = self.catalog.quarantined(names)
+        self.skipped_quarantined.update(quarantined)
+        return quarantined
+
+    def record_failures(self, failures):
+        """Records the (granule, reason) of granules that could not be extracted, and quarantines repeat failures.
+        Granules that were not on disk are not held against them."""
+        for granule, reason in failures:
+            if reason == FILE_NOT_PRESENT:
+                continue
+            if self.catalog.record_failure(os.path.basename(granule.local_file_name), reason):
+                print('WARNING: Quarantined %s, it failed again (%s). It will not be downloaded or processed anymore.'
+                      % (granule.local_file_name, reason))
+
+    def print_quarantine_report(self):
+        if not self.skipped_quarantined:
+            return
+        print('Skipped {:,} quarantined granules of {}:'.format(len(self.skipped_quarantined), self._storage_directory))
+        for name, (reason, count) in sorted(self.skipped_quarantined.items()):
+            print('  %s: failed %s times, last %s' % (name, count, reason))
 
 
 class HDFDataAggregator(object):
+    def __init__(self):
+        # (granule, reason) of the granules that could not be extracted in the last process(_stream) call
+        self.failures = []
+
     def process(self, granules, hdf_filter):
         process_args = [(granule, hdf_filter) for granule in granules]
 
-        with Pool(processes=10) as pool:
+        with Pool(processes=EXTRACTION_PROCESSES) as pool:
             async_results = pool.starmap_async(extract_granule_dataset, process_args)
             pool.close()
             pool.join()
 
-        # (granule, radiances_sum, radiances_count, radiances, filter_stats)
+        # (granule, radiances_sum, radiances_count, radiances, filter_stats), with (LATITUDE_BUCKETS, CHANNELS) sums
+        # and counts
         results = async_results.get()
+        self._record_failures(results)
+
+        # curve_data, filter_stats, count_data, wavenumber_details
+        return calculate_averages_and_filter(results, hdf_filter)
+
+    def process_stream(self, granules, hdf_filter, on_extracted=None, extracted=()):
+        """
+        Like process, for an iterable of granules that are still arriving (e.g. while they are being downloaded). Each
+        granule is extracted as soon as the iterable yields it, and the iterable is only advanced while fewer than
+        EXTRACTION_QUEUE_SIZE granules wait for or are in extraction. on_extracted is called with each granule and its
+        extraction result (None if extraction raised) once the result is recorded, after which its file is no longer
+        needed. The results in extracted, of granules extracted earlier, are included in the output.
+        """
+        in_flight = threading.BoundedSemaphore(EXTRACTION_QUEUE_SIZE)
+        results = list(extracted)
+        errors = []
+
+        def on_result(granule, result):
+            results.append(result)
+            finished(granule, result)
+
+        def on_error(granule, error):
+            errors.append(error)
+            finished(granule, None)
+
+        def finished(granule, result):
+            try:
+                if on_extracted is not None:
+                    on_extracted(granule, result)
+            finally:
+                in_flight.release()
+
+        with Pool(processes=EXTRACTION_PROCESSES) as pool:
+            for granule in granules:
+                in_flight.acquire()
+                pool.apply_async(extract_granule_dataset, (granule, hdf_filter),
+                                 callback=partial(on_result, granule), error_callback=partial(on_error, granule))
+            pool.close()
+            pool.join()
+
+        if errors:
+            raise errors[0]
+
+        # granules finish in any order, keep the output the same as process
+        results.sort(key=lambda result: int(result[0]))
+        self._record_failures(results)
 
         # curve_data, filter_stats, count_data, wavenumber_details
         return calculate_averages_and_filter(results, hdf_filter)
 
+    def _record_failures(self, results):
+        # failed extractions return (granule, None, None, None, reason)
+        self.failures = [(result[0], result[4]) for result in results if result[1] is None]
+
+
+def period_curve_data(period, sums, counts, wavelengths):
+    """Rows of the curve data of period: the sum and count of each latitude bucket for each wavenumber"""
+    columns = {'period': period, 'wavenumber': wavelengths}
+    for index, bucket in enumerate(LATITUDE_BUCKETS):
+        columns[bucket + '_sum'] = sums[index]
+        columns[bucket + '_count'] = counts[index]
+    return pd.DataFrame(columns)
+
 
 def calculate_averages_and_filter(results, hdf_filter):
+    # granules that could not be extracted have no buckets
+    results = [result for result in results if result[1] is not None]
     columns = ['period', 'wavenumber']
     if results:
-        for bucket in results[0][2].keys():
+        for bucket in LATITUDE_BUCKETS:
             columns.append(bucket + '_sum')
             columns.append(bucket + '_count')
     wavelengths = pd.Series(list(CHANNELS_TO_WAVELENGTHS.values()))
 
-    data = []
+    # {period: [(LATITUDE_BUCKETS, CHANNELS) sums, counts]}
+    data = {}
     wavenumber_data = None
     if hdf_filter.examine_wavenumber_mode and results:
         wavenumber_data = pd.DataFrame(columns=['timestamp', 'lat', 'lon', 'radiances'])
-        data = {}
-        data = data.fromkeys(results[0][2], [])
+        data = data.fromkeys(LATITUDE_BUCKETS, [])
 
     filter_stats = {'total': 0, 'total_filtered': 0, 'land_frac': 0, 'cloud_cover': 0, 'all_spots': 0, 'noise': 0,
                     'dust': 0, 'quality': 0, 'scanang': 0, 'solzen': 0}
@@ -199,46 +398,11 @@ def calculate_averages_and_filter(results, hdf_filter):
                 if cloud_info[1] < most_cloud_free_granule[1]:
                     most_cloud_free_granule = cloud_info
 
-                periods = pd.Series([granule.month_period] * len(wavelengths))
-
-                data += list(zip(periods, wavelengths,
-                         radiances_by_latitude_sum['-90to-80'],
-                         radiances_by_latitude_count['-90to-80'],
-                         radiances_by_latitude_sum['-80to-70'],
-                         radiances_by_latitude_count['-80to-70'],
-                         radiances_by_latitude_sum['-70to-60'],
-                         radiances_by_latitude_count['-70to-60'],
-                         radiances_by_latitude_sum['-60to-50'],
-                         radiances_by_latitude_count['-60to-50'],
-                         radiances_by_latitude_sum['-50to-40'],
-                         radiances_by_latitude_count['-50to-40'],
-                         radiances_by_latitude_sum['-40to-30'],
-                         radiances_by_latitude_count['-40to-30'],
-                         radiances_by_latitude_sum['-30to-20'],
-                         radiances_by_latitude_count['-30to-20'],
-                         radiances_by_latitude_sum['-20to-10'],
-                         radiances_by_latitude_count['-20to-10'],
-                         radiances_by_latitude_sum['-10to0'],
-                         radiances_by_latitude_count['-10to0'],
-                         radiances_by_latitude_sum['0to10'],
-                         radiances_by_latitude_count['0to10'],
-                         radiances_by_latitude_sum['10to20'],
-                         radiances_by_latitude_count['10to20'],
-                         radiances_by_latitude_sum['20to30'],
-                         radiances_by_latitude_count['20to30'],
-                         radiances_by_latitude_sum['30to40'],
-                         radiances_by_latitude_count['30to40'],
-                         radiances_by_latitude_sum['40to50'],
-                         radiances_by_latitude_count['40to50'],
-                         radiances_by_latitude_sum['50to60'],
-                         radiances_by_latitude_count['50to60'],
-                         radiances_by_latitude_sum['60to70'],
-                         radiances_by_latitude_count['60to70'],
-                         radiances_by_latitude_sum['70to80'],
-                         radiances_by_latitude_count['70to80'],
-                         radiances_by_latitude_sum['80to90'],
-                         radiances_by_latitude_count['80to90'],
-                         ))
+                if granule.month_period in data:
+                    data[granule.month_period][0] += radiances_by_latitude_sum
+                    data[granule.month_period][1] += radiances_by_latitude_count
+                else:
+                    data[granule.month_period] = [radiances_by_latitude_sum.copy(), radiances_by_latitude_count.copy()]
             else:
                 granule, radiances_by_latitude_sum, radiances_by_latitude_count, radiances_by_latitude, stats, \
                 cloud_info, wavenumber_details = result
@@ -287,8 +451,11 @@ def calculate_averages_and_filter(results, hdf_filter):
 
     if hdf_filter.examine_wavenumber_mode:
         curve_data = pd.DataFrame.from_dict(data, orient='index').T
+    elif data:
+        curve_data = pd.concat([period_curve_data(period, sums, counts, wavelengths)
+                                for period, (sums, counts) in data.items()], ignore_index=True)
     else:
-        curve_data = pd.DataFrame(data, columns=columns)
+        curve_data = pd.DataFrame(columns=columns)
 
     if hdf_filter.examine_wavenumber_mode:
         # curves_data, filter_stats, count_data, wavenumber_details
@@ -310,7 +477,7 @@ def calculate_averages_and_filter(results, hdf_filter):
     drop_columns = []
     count_drop_columns = []
     if results:
-        for bucket in results[0][2].keys():
+        for bucket in LATITUDE_BUCKETS:
             sum_bucket = bucket + '_sum'
             count_bucket = bucket + '_count'
             drop_columns.append(sum_bucket)
@@ -329,9 +496,19 @@ def calculate_averages_and_filter(results, hdf_filter):
 
 
 def extract_granule_dataset(granule, hdf_filter: HDFFilter):
+    if not os.path.exists(granule.local_file_name) and not has_current_transcoded(granule.local_file_name):
+        print("WARNING: Granule is not on disk: " + granule.local_file_name)
+        return granule, None, None, None, FILE_NOT_PRESENT
+
     try:
-        data = SD(granule.local_file_name)
-    except (HDF4Error, ValueError):
+        data = read_granule_datasets(granule.local_file_name, hdf_filter.transcode, hdf_filter.drop_hdf)
+    except MissingDatasetError as e:
+        print("A dataset is missing in granule: {}".format(granule.local_file_name))
+        return granule, None, None, None, 'missing dataset %s' % e
+    except (HDF4Error, ValueError) as e:
+        if not os.path.exists(granule.local_file_name):
+            print("WARNING: Granule is not on disk: " + granule.local_file_name)
+            return granule, None, None, None, FILE_NOT_PRESENT
         print("WARNING: Granule could not be read: " + granule.local_file_name)
         if hdf_filter.delete_unreadable:
             try:
@@ -344,33 +521,33 @@ def extract_granule_dataset(granule, hdf_filter: HDFFilter):
             print(
                 'Enable "delete_unreadable_granules" flag to delete and re-download automatically in a subsequent run.'
             )
-        return granule, None, None, None
+        return granule, None, None, None, 'unreadable: %s' % e
+
+    if data['radiances'].size != PIXELS * CHANNELS or data['radiances_QC'].size != PIXELS * CHANNELS:
+        print("WARNING: could not reshape data: " + granule.local_file_name)
+        return granule, None, None, None, 'radiances of shape %s' % (data['radiances'].shape,)
+
+    if hdf_filter.engine == NUMPY_ENGINE and not hdf_filter.examine_wavenumber_mode:
+        cloud_info = (granule.local_file_name, granule_cloud_cover(data['TotCld_4_CCfinal']))
+        return (granule,) + filter_granule(data, hdf_filter)[:4] + (cloud_info, None)
 
     # relevant datasets are dust_flag (2D), landFrac (2D), CCfinal_Noise_Amp (2D), radiances_QC(3D), radiances (3D)
-    try:
-        dust_flag = pd.DataFrame(data.select('dust_flag').get())
-        land_frac = pd.DataFrame(data.select('landFrac').get())
-        cloud_cover = pd.DataFrame(data.select('TotCld_4_CCfinal').get())
-        all_spots = pd.DataFrame(data.select('all_spots_avg').get())
-        final_noise_amp = pd.DataFrame(data.select('CCfinal_Noise_Amp').get())
-        latitude = pd.DataFrame(data.select('Latitude').get())
-        longitude = pd.DataFrame(data.select('Longitude').get())
-        scanang = pd.DataFrame(data.select('scanang').get())
-        solzen = pd.DataFrame(data.select('solzen').get())
-        timestamp = pd.DataFrame(data.select('Time').get())
-    except pyhdf.error.HDF4Error:
-        print("A dataset is missing in granule: {}".format(granule.local_file_name))
-        return granule, None, None, None
+    dust_flag = pd.DataFrame(data['dust_flag'])
+    land_frac = pd.DataFrame(data['landFrac'])
+    cloud_cover = pd.DataFrame(data['TotCld_4_CCfinal'])
+    all_spots = pd.DataFrame(data['all_spots_avg'])
+    final_noise_amp = pd.DataFrame(data['CCfinal_Noise_Amp'])
+    latitude = pd.DataFrame(data['Latitude'])
+    longitude = pd.DataFrame(data['Longitude'])
+    scanang = pd.DataFrame(data['scanang'])
+    solzen = pd.DataFrame(data['solzen'])
+    timestamp = pd.DataFrame(data['Time'])
 
     multi_index = pd.MultiIndex.from_product([np.arange(45), np.arange(30)])
-    try:
-        radiances = pd.DataFrame(data.select('radiances').get().reshape(1350, 2378), index=multi_index)
-    except ValueError:
-        print("WARNING: could not reshape data: " + granule.local_file_name)
-        return granule, None, None, None
+    radiances = pd.DataFrame(data['radiances'].reshape(1350, 2378), index=multi_index)
     radiances.rename(columns={x: 'radiance_channel_%s' % x for x in range(2378)}, inplace=True)
 
-    radiances_qc = pd.DataFrame(data.select('radiances_QC').get().reshape(1350, 2378), index=multi_index)
+    radiances_qc = pd.DataFrame(data['radiances_QC'].reshape(1350, 2378), index=multi_index)
 
     # use same columns as radiances for proper filtering
     radiances_qc.rename(columns={x: 'radiance_channel_%s' % x for x in range(2378)}, inplace=True)
@@ -413,8 +590,10 @@ def filter_dataset(df: pd.DataFrame, radiances: pd.DataFrame, radiances_quality:
     df = df[prefilter_geo_condition]
     radiances_quality = radiances_quality[prefilter_geo_condition]
 
-    # start counting amount of data points removed by filters
-    num_data_points = radiances.count().sum()
+    # start counting amount of data points removed by filters, from the number of valid channels of each pixel so
+    # that each filter stage only sums over the pixels it keeps
+    valid_channels = radiances.count(axis=1)
+    num_data_points = valid_channels.sum()
     num_filtered_total = 0
     selected_channel = -1
     if hdf_filter.examine_wavenumber_mode:
@@ -424,34 +603,13 @@ def filter_dataset(df: pd.DataFrame, radiances: pd.DataFrame, radiances_quality:
         except KeyError:
             print("ERROR: Invalid wavenumber selected: " + str(hdf_filter.selected_wavenumber))
 
-    radiances_by_latitude_mask = {
-        '-90to-80': (df.lat >= -90) & (df.lat < -80),
-        '-80to-70': (df.lat >= -80) & (df.lat < -70),
-        '-70to-60': (df.lat >= -70) & (df.lat < -60),
-        '-60to-50': (df.lat >= -60) & (df.lat < -50),
-        '-50to-40': (df.lat >= -50) & (df.lat < -40),
-        '-40to-30': (df.lat >= -40) & (df.lat < -30),
-        '-30to-20': (df.lat >= -30) & (df.lat < -20),
-        '-20to-10': (df.lat >= -20) & (df.lat < -10),
-        '-10to0': (df.lat >= -10) & (df.lat < 0),
-        '0to10': (df.lat >= 0) & (df.lat <= 10),
-        '10to20': (df.lat > 10) & (df.lat <= 20),
-        '20to30': (df.lat > 20) & (df.lat <= 30),
-        '30to40': (df.lat > 30) & (df.lat <= 40),
-        '40to50': (df.lat > 40) & (df.lat <= 50),
-        '50to60': (df.lat > 50) & (df.lat <= 60),
-        '60to70': (df.lat > 60) & (df.lat <= 70),
-        '70to80': (df.lat > 70) & (df.lat <= 80),
-        '80to90': (df.lat > 80) & (df.lat <= 90)
-    }
-
     # max landFrac
     if hdf_filter.landfrac_threshold_is_max:
         condition = df.land_frac <= hdf_filter.landfrac_threshold
     else:
         condition = df.land_frac >= hdf_filter.landfrac_threshold
 
-    num_filtered_landfrac = num_data_points - radiances[condition].count().sum() - num_filtered_total
+    num_filtered_landfrac = num_data_points - valid_channels[condition].sum() - num_filtered_total
     num_filtered_total += num_filtered_landfrac
 
     # max cloud cover
@@ -460,7 +618,7 @@ def filter_dataset(df: pd.DataFrame, radiances: pd.DataFrame, radiances_quality:
     else:
         condition &= df.cloud_cover >= hdf_filter.cloud_cover_threshold
 
-    num_filtered_cloud_cover = num_data_points - radiances[condition].count().sum() - num_filtered_total
+    num_filtered_cloud_cover = num_data_points - valid_channels[condition].sum() - num_filtered_total
     num_filtered_total += num_filtered_cloud_cover
 
     # max all_spots_avg
@@ -469,7 +627,7 @@ def filter_dataset(df: pd.DataFrame, radiances: pd.DataFrame, radiances_quality:
     else:
         condition &= df.all_spots >= hdf_filter.all_spots_avg_threshold
 
-    num_filtered_all_spots = num_data_points - radiances[condition].count().sum() - num_filtered_total
+    num_filtered_all_spots = num_data_points - valid_channels[condition].sum() - num_filtered_total
     num_filtered_total += num_filtered_all_spots
 
     # consider noise amplification
@@ -478,7 +636,7 @@ def filter_dataset(df: pd.DataFrame, radiances: pd.DataFrame, radiances_quality:
         condition &= (
                 (df.final_noise_amp > 0.3333) & (df.final_noise_amp < 0.3334)
         )
-        num_filtered_noise_amp = num_data_points - radiances[condition].count().sum() - num_filtered_total
+        num_filtered_noise_amp = num_data_points - valid_channels[condition].sum() - num_filtered_total
         num_filtered_total += num_filtered_noise_amp
 
     # scanang
@@ -491,14 +649,14 @@ def filter_dataset(df: pd.DataFrame, radiances: pd.DataFrame, radiances_quality:
         condition &= (
                 (df.scanang <= inverse_scanang) & (df.scanang >= hdf_filter.scanang)
         )
-    num_filtered_scanang = num_data_points - radiances[condition].count().sum() - num_filtered_total
+    num_filtered_scanang = num_data_points - valid_channels[condition].sum() - num_filtered_total
     num_filtered_total += num_filtered_scanang
 
     # dust filters/flags
     dust_filters = [hdf_filter.dust_flag_no_dust, hdf_filter.dust_flag_single_fov, hdf_filter.dust_flag_detected]
     dust_values = [index - 1 for index, selected in enumerate(dust_filters) if selected]
     condition &= (df.dust_flag.isin(dust_values))
-    num_filtered_dust = num_data_points - radiances[condition].count().sum() - num_filtered_total
+    num_filtered_dust = num_data_points - valid_channels[condition].sum() - num_filtered_total
     num_filtered_total += num_filtered_dust
 
     # solar zenith
@@ -506,7 +664,7 @@ def filter_dataset(df: pd.DataFrame, radiances: pd.DataFrame, radiances_quality:
         condition &= (df.solzen <= hdf_filter.solzen_threshold)
     else:
         condition &= (df.solzen >= hdf_filter.solzen_threshold)
-    num_filtered_solzen = num_data_points - radiances[condition].count().sum() - num_filtered_total
+    num_filtered_solzen = num_data_points - valid_channels[condition].sum() - num_filtered_total
     num_filtered_total += num_filtered_solzen
 
     filtered_wavenumber_data = None
@@ -534,57 +692,30 @@ def filter_dataset(df: pd.DataFrame, radiances: pd.DataFrame, radiances_quality:
         if len(filtered_wavenumber_data) == 0:
             filtered_wavenumber_data = None
 
-    for bucket, data in radiances_by_latitude_mask.items():
-        radiances_by_latitude_mask[bucket] &= condition
-
-    radiances_by_latitude = dict.fromkeys(radiances_by_latitude_mask)
-    selected_radiances_by_latitude = radiances_by_latitude.copy()
-    for bucket, data in radiances_by_latitude.items():
-        lat_condition = radiances_by_latitude_mask[bucket]
-        radiances_by_latitude[bucket] = radiances[lat_condition]
-
-    radiances_quality_by_latitude = dict.fromkeys(radiances_by_latitude)
-    for bucket, data in radiances_quality_by_latitude.items():
-        lat_condition = radiances_by_latitude_mask[bucket]
-        radiances_quality_by_latitude[bucket] = radiances_quality[lat_condition]
-
+    # assign each selected pixel its latitude bin once (see numpy_engine.LATITUDE_BUCKETS for the edges), and mask out
+    # the radiances of unselected quality
     radiance_qc_filters = [hdf_filter.data_quality_best, hdf_filter.data_quality_enough, hdf_filter.data_quality_worst]
     radiance_qc_values = [index for index, selected in enumerate(radiance_qc_filters) if selected]
-    radiances_quality_mask_by_latitude = dict.fromkeys(radiances_by_latitude)
-    for bucket, data in radiances_quality_mask_by_latitude.items():
-        radiances_quality_mask_by_latitude[bucket] = radiances_quality_by_latitude[bucket].isin(radiance_qc_values)
+    selected = condition.to_numpy()
+    bins = latitude_bins(df.lat.to_numpy()[selected])
+    quality_radiances = radiances.to_numpy()[selected]
+    quality_radiances = np.where(np.isin(radiances_quality.to_numpy()[selected], radiance_qc_values),
+                                 quality_radiances, np.nan)
 
-    num_filtered_quality = 0
-    for bucket, radiances_ in radiances_by_latitude.items():
-        radiances_mask_ = radiances_quality_mask_by_latitude[bucket]
-        num_filtered_quality += radiances_.count().sum() - radiances_[radiances_mask_].count().sum()
+    # sum and count the radiances of each bin and channel
+    radiances_by_latitude_sum, radiances_by_latitude_count = bin_sums_and_counts(quality_radiances, bins)
 
+    num_filtered_quality = valid_channels.to_numpy()[selected][bins >= 0].sum() - radiances_by_latitude_count.sum()
     num_filtered_total += num_filtered_quality
 
     filter_stats = (num_data_points, num_filtered_total, num_filtered_landfrac, num_filtered_cloud_cover,
                     num_filtered_all_spots, num_filtered_noise_amp, num_filtered_dust, num_filtered_quality,
                     num_filtered_scanang, num_filtered_solzen)
 
-    # sum radiance values only where the quality matches the selected ones
-    for bucket, radiances_ in radiances_by_latitude.items():
-        radiances_mask_ = radiances_quality_mask_by_latitude[bucket]
-        radiances_by_latitude[bucket] = radiances_[radiances_mask_]
-
+    selected_radiances_by_latitude = dict.fromkeys(LATITUDE_BUCKETS)
     if hdf_filter.examine_wavenumber_mode:
-        for bucket, radiances_ in radiances_by_latitude.items():
-            selected_radiances_by_latitude[bucket] = list(radiances_.iloc[:, selected_channel - 1])
-
-    # bin radiances by latitude
-    radiances_by_latitude_sum = dict.fromkeys(radiances_by_latitude)
-    radiances_by_latitude_count = dict.fromkeys(radiances_by_latitude)
-    for bucket, radiances_ in radiances_by_latitude.items():
-        radiances_by_latitude_sum[bucket] = radiances_.sum()
-        radiances_by_latitude_count[bucket] = radiances_.count()
-
-    # radiances_by_latitude_count = dict.fromkeys(radiances_by_latitude)
-    for bucket, radiances_mask_ in radiances_quality_mask_by_latitude.items():
-        pass
-        # radiances_by_latitude_count[bucket] = radiances_mask_.sum()
+        for index, bucket in enumerate(LATITUDE_BUCKETS):
+            selected_radiances_by_latitude[bucket] = list(quality_radiances[bins == index, selected_channel - 1])
 
-    # return the sum of all applicable radiances and their count per channel
+    # return the (LATITUDE_BUCKETS, CHANNELS) sums of all applicable radiances and their counts
     return radiances_by_latitude_sum, radiances_by_latitude_count, selected_radiances_by_latitude, filter_stats, filtered_wavenumber_data
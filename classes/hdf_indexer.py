@@ -0,0 +1,107 @@
+"""
+Offline position indexer: harvests granule positions from AIRS2CCF files that are already on disk, so the position
+index can be extended without crawling the GESDISC XML. Only the small Latitude, Longitude and Time datasets of each
+granule are read, and files are processed in parallel on all available cores.
+"""
+import os
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+import pandas
+from pyhdf.SD import SD
+from pyhdf.error import HDF4Error
+
+from .calculate_GCA import calculate_gca
+from .granule import GranuleArray
+from .position_index import PositionIndex
+
+POSITION_COLUMNS = ['year', 'day', 'granule', 'lat', 'lon', 'west', 'north', 'east', 'south', 'hdf_filename']
+
+# if the longitudes of a granule leave no gap wider than this, the granule goes around a pole
+POLE_LONGITUDE_GAP = 90
+
+
+def find_hdf_files(directory):
+    """Returns the paths of all .hdf files under directory, including subdirectories"""
+    return sorted(
+        os.path.join(root, filename)
+        for root, _dirs, filenames in os.walk(directory) for filename in filenames if filename.endswith('.hdf')
+    )
+
+
+def calculate_longitude_bounds(longitudes):
+    """
+    Returns the (west, east) bounds of a set of longitudes as the complement of the widest gap between them around the
+    globe, so granules crossing the antimeridian get west > east. Returns (-180, 180) when there is no gap wider than
+    POLE_LONGITUDE_GAP, which happens for granules that go around a pole.
+    """
+    longitudes = np.unique(longitudes)
+    gaps = np.diff(np.append(longitudes, longitudes[0] + 360))
+    widest = int(np.argmax(gaps))
+
+    if gaps[widest] <= POLE_LONGITUDE_GAP:
+        return -180., 180.
+
+    west = longitudes[(widest + 1) % len(longitudes)]
+    east = longitudes[widest]
+    return float(west), float(east)
+
+
+def read_granule_position(filename):
+    """Returns the position row (see POSITION_COLUMNS) of a local HDF file, or None if it cannot be read"""
+    try:
+        data = SD(filename)
+        latitude = data.select('Latitude').get()
+        longitude = data.select('Longitude').get()
+        time = data.select('Time').get()
+        data.end()
+    except HDF4Error:
+        print('WARNING: Granule could not be indexed: %s' % filename)
+        return None
+
+    valid = (np.abs(latitude) <= 90) & (np.abs(longitude) <= 180) & (time > 0)
+    if not valid.any():
+        print('WARNING: Granule has no valid geolocation: %s' % filename)
+        return None
+
+    granule = GranuleArray.from_filenames([filename])[0]
+    rows, columns = latitude.shape
+    centre_lat, centre_lon = latitude[rows // 2, columns // 2], longitude[rows // 2, columns // 2]
+
+    south, north = float(latitude[valid].min()), float(latitude[valid].max())
+    west, east = calculate_longitude_bounds(longitude[valid])
+    if (west, east) == (-180., 180.):
+        # the granule goes around a pole, so it covers it
+        if centre_lat > 0:
+            north = 90.
+        else:
+            south = -90.
+
+    return (granule.year, granule.day, granule.granule_number, round(float(centre_lat), 2),
+            round(float(centre_lon), 2), west, north, east, south, os.path.basename(filename))
+
+
+def index_local_granules(directory, position_index=None, processes=None):
+    """Adds the positions of every .hdf file under directory to the position index. Returns the number of granules
+    indexed."""
+    if position_index is None:
+        position_index = PositionIndex()
+
+    filenames = find_hdf_files(directory)
+    print('Indexing %s local granules...' % len(filenames))
+
+    with Pool(processes=processes or cpu_count()) as pool:
+        positions = [
+            position for position in pool.imap_unordered(read_granule_position, filenames, chunksize=16)
+            if position is not None
+        ]
+
+    if not positions:
+        return 0
+
+    data = pandas.DataFrame(positions, columns=POSITION_COLUMNS)
+    for year, rows in data.groupby('year'):
+        print('Calculating GCA for %s granules of %s...' % (len(rows), year))
+        position_index.merge(int(year), calculate_gca(rows.reset_index(drop=True)))
+
+    return len(data)
@@ -1,44 +1,60 @@
 from datetime import datetime
 import os
-import pathlib
+import queue
+import threading
 
-from classes.aqua_positions import AquaPositions
+from classes.aqua_positions import AquaPositions, PositionQuery
 from classes.constants import CHANNELS_TO_WAVELENGTHS, COLORS
-from classes.granule import Granule
-from classes.hdf import HDFFilter, HDFStorage, HDFDataAggregator
+from classes.cache import DEFAULT_QUOTA_GB, GranuleCache
+from classes.download import DEFAULT_MAX_ATTEMPTS, DEFAULT_MAX_CONNECTIONS, RetryPolicy
+from classes.granule import FLAT_LAYOUT, Granule, GranuleArray
+from classes.hdf import PANDAS_ENGINE, HDFFilter, HDFStorage, HDFDataAggregator
+from classes.interface.rolling_window import ROLLING_WINDOW_CHUNK_SIZE, PartialResults, RollingWindow
+from classes.transcode import has_current_transcoded
+
+# granules downloaded and waiting for extraction in the pipelined mode
+PIPELINE_QUEUE_SIZE = 32
 
 
 class MainController(object):
     def __init__(self, status_callback=None):
         self._status_callback = status_callback
+        # HDFStorage of each data directory, shared by all batches (and threads) that download into it
+        self._storages = {}
+        # GranuleCache of each granule_cache_directory
+        self._caches = {}
+        self._storages_lock = threading.Lock()
 
     def signal_status_update(self, message, done=False, data=None):
         if self._status_callback is not None:
             self._status_callback(message, done, data)
 
-    def process(self, data: dict):
+    def process(self, data: dict, on_selected=None):
+        """Selects, downloads and processes the granules of a batch. on_selected is called once they are selected."""
         self.signal_status_update('>>> Calculating...')
 
         granules = self.get_granules(data)
 
         urls = self.get_urls_for_granules(data, *granules)
+        if on_selected is not None:
+            on_selected()
 
         if 'test_hdf_output' in data and data['test_hdf_output']:
             return urls
 
-        self.download_files(data, urls)
-
-        # comment out the following two lines to re-enable data processing after download:
-        # self.signal_status_update('>>> Bypassing granule processing step. See main_controller.py, line 27.')
-        # return None
-
-        # granules that map to the downloaded files
-        self.signal_status_update('>>> Processing HDF data...')
-        all_granules = self.build_granules_for_aggregation(data, urls)
-
         hdf_filter = self.build_hdf_filter(data)
 
-        curves_data, filter_stats, count_data, wavenumber_details = self.aggregate_hdf_data(all_granules, hdf_filter)
+        if data.get('rolling_window_gb'):
+            self.signal_status_update('>>> Downloading and processing HDF data in a rolling window...')
+            curves_data, filter_stats, count_data, wavenumber_details = \
+                self.download_and_aggregate(data, urls, hdf_filter, float(data['rolling_window_gb']) * 1e9)
+        elif data.get('pipeline', False):
+            self.signal_status_update('>>> Downloading and processing HDF data...')
+            curves_data, filter_stats, count_data, wavenumber_details = \
+                self.download_and_aggregate(data, urls, hdf_filter)
+        else:
+            curves_data, filter_stats, count_data, wavenumber_details = \
+                self.download_then_aggregate(data, urls, hdf_filter)
 
         self.signal_status_update('>>> Writing output...')
 
@@ -47,22 +63,14 @@ class MainController(object):
         self.write_output_files(data, curves_data, wavenumber_details)
         if not hdf_filter.examine_wavenumber_mode:
             self.write_output_files(data_copy, count_data)
+        if data.get('rolling_window_gb'):
+            # the results of the evicted granules are in the output now
+            PartialResults(data['data_directory'], hdf_filter, [url.split('/')[-1] for url in urls]).remove()
 
         self.signal_status_update('>>> Process finished', done=True)
 
         return filter_stats
 
-    @staticmethod
-    def delete_empty_hdfs(data_directory):
-        hdf_file_list = pathlib.Path(data_directory).glob('*.hdf')
-        # Filter out files less than 1MB
-        hdf_file_list = [f for f in hdf_file_list if os.path.getsize(f) < 1000000]
-        if hdf_file_list is not []:
-            print('Deleting empty HDFs...')
-        for file in hdf_file_list:
-            print('Deleting file ' + str(file) + '... (' + str(os.path.getsize(file)) + ' bytes)')
-            os.remove(file)
-
     @staticmethod
     def write_output_files(data, curves_data, wavenumber_details=None):
         output_dir = data['output_directory']
@@ -137,47 +145,166 @@ class MainController(object):
 
     @staticmethod
     def build_granules_for_aggregation(data, urls):
-        result = []
+        return GranuleArray.from_filenames(urls, data['data_directory'], data.get('data_directory_layout', FLAT_LAYOUT))
+
+    def get_storage(self, data):
         data_directory = data['data_directory']
+        with self._storages_lock:
+            if data_directory not in self._storages:
+                if not os.path.isdir(data_directory):
+                    os.makedirs(data_directory)
+                retry_policy = RetryPolicy(int(data.get('download_attempts', DEFAULT_MAX_ATTEMPTS)))
+                self._storages[data_directory] = HDFStorage(
+                    data_directory, data['username'], data['password'],
+                    int(data.get('max_connections', DEFAULT_MAX_CONNECTIONS)), retry_policy, self._get_cache(data),
+                    data.get('data_directory_layout', FLAT_LAYOUT))
+                if data.get('retry_quarantined_granules', False):
+                    self._storages[data_directory].catalog.clear_quarantine()
+
+            return self._storages[data_directory]
+
+    def _get_cache(self, data):
+        """Returns the GranuleCache of the batch, or None if it does not use one. Call with _storages_lock held."""
+        cache_directory = data.get('granule_cache_directory')
+        if not cache_directory:
+            return None
+        if cache_directory not in self._caches:
+            quota = float(data.get('granule_cache_quota_gb', DEFAULT_QUOTA_GB)) * 1e9
+            self._caches[cache_directory] = GranuleCache(cache_directory, quota)
+        return self._caches[cache_directory]
+
+    def close(self):
+        """Closes the download connections of all storages, and reports quarantined granules and the use of the
+        granule caches"""
+        with self._storages_lock:
+            for storage in self._storages.values():
+                storage.print_quarantine_report()
+                storage.close()
+            self._storages.clear()
+            for cache in self._caches.values():
+                cache.print_report()
+                cache.close()
+            self._caches.clear()
+
+    def download_files(self, data, urls, on_complete=None, prepared=False):
+        def count_callback(count):
+            self.signal_status_update('>>> Downloading %s granules...' % count)
 
-        for url in urls:
-            # AIRS.2002.08.30.225.L2.CC.v6.0.7.0.G13201091521.hdf
-            filename = url.split('/')[-1]
-            year, month, day, granule_number = map(int, filename.split('.')[1:5])
+        # failed granules are retried individually with backoff, so whatever is still missing afterwards is given up on
+        if not self.get_storage(data).download_files(urls, count_callback, on_complete, prepared):
+            print("Some granules failed to download!")
 
-            day_of_year = int(datetime.strftime(datetime(year, month, day), '%j'))
+    def download_then_aggregate(self, data, urls, hdf_filter):
+        """Downloads the granules of urls, and then processes the ones that are stored"""
+        self.download_files(data, urls)
 
-            result.append(Granule(year, day_of_year, granule_number, os.path.join(data_directory, filename)))
+        # comment out the following two lines to re-enable data processing after download:
+        # self.signal_status_update('>>> Bypassing granule processing step. See main_controller.py, line 27.')
+        # return None
 
-        return result
+        # granules that map to the downloaded files, without the ones that failed to download
+        self.signal_status_update('>>> Processing HDF data...')
+        storage = self.get_storage(data)
+        granules = storage.stored_granules(storage.without_quarantined(self.build_granules_for_aggregation(data, urls)))
 
-    def download_files(self, data, urls):
-        data_directory = data['data_directory']
-        username = data['username']
-        password = data['password']
+        aggregator = HDFDataAggregator()
+        results = aggregator.process(granules, hdf_filter)
+        storage.record_failures(aggregator.failures)
+        return results
+
+    def download_and_aggregate(self, data, urls, hdf_filter, window_budget=None):
+        """
+        Pipelined download and processing: each granule goes onto the extraction queue as soon as it is on disk, so
+        the network and the CPUs work at the same time. The queue holds at most PIPELINE_QUEUE_SIZE granules, and
+        downloads wait while it is full.
+
+        With a window_budget (in bytes), the batch runs in a rolling window instead: at most that many bytes of raw
+        granules the batch downloads (or links from the granule cache) are kept on disk, downloads wait for room, and
+        those granules are deleted once their extraction results are checkpointed in PartialResults, which process
+        removes once the output is written. Granules that were stored before are kept. Granules with checkpointed
+        results (from an interrupted run) are neither downloaded nor extracted again, and granules with a transcoded
+        file are read from it and not downloaded.
+        """
+        storage = self.get_storage(data)
+        granules = {os.path.basename(granule.local_file_name): granule
+                    for granule in storage.without_quarantined(self.build_granules_for_aggregation(data, urls))}
+
+        window = None
+        extracted_names, extracted = set(), []
+        if window_budget is not None:
+            partial_results = PartialResults(data['data_directory'], hdf_filter, [url.split('/')[-1] for url in urls])
+            window = RollingWindow(storage, window_budget, partial_results)
+            extracted_names, extracted = partial_results.load()
+            granules = {name: granule for name, granule in granules.items() if name not in extracted_names}
+            urls = [url for url in urls if url.split('/')[-1] not in extracted_names]
+            # granules stored before the batch, which the window leaves alone
+            stored = set(name for name, granule in granules.items() if os.path.exists(granule.local_file_name))
+
+        # verified and linked from the cache once here, the downloads below only fetch what is still missing
+        missing = set(url.split('/')[-1] for url in storage.prepare_files(urls))
+
+        if window is not None:
+            missing = set(name for name in missing if not has_current_transcoded(granules[name].local_file_name))
+            for name, granule in granules.items():
+                if name not in missing and name not in stored and os.path.exists(granule.local_file_name):
+                    window.add(name, os.path.getsize(granule.local_file_name))
+
+        ready = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+        def queue_stored_granules():
+            try:
+                for name, granule in granules.items():
+                    if name not in missing:
+                        ready.put(granule)
+            finally:
+                ready.put(None)
+
+        def queue_downloaded_granule(result):
+            # runs in a callback thread of the downloader, where waiting for room in the queue holds a connection slot
+            # and so pauses new transfers without stopping the event loop
+            if result.succeeded:
+                if window is not None:
+                    window.add(result.filename, result.file_size)
+                ready.put(granules[result.filename])
+
+        def download():
+            try:
+                if window is None:
+                    self.download_files(data, urls, queue_downloaded_granule, prepared=True)
+                    return
+                missing_urls = [url for url in urls if url.split('/')[-1] in missing]
+                for start in range(0, len(missing_urls), ROLLING_WINDOW_CHUNK_SIZE):
+                    window.wait_for_space()
+                    self.download_files(data, missing_urls[start:start + ROLLING_WINDOW_CHUNK_SIZE],
+                                        queue_downloaded_granule, prepared=True)
+            finally:
+                ready.put(None)
+
+        producers = [threading.Thread(target=target, daemon=True) for target in (queue_stored_granules, download)]
+
+        def arriving_granules():
+            finished = 0
+            while finished < len(producers):
+                granule = ready.get()
+                if granule is None:
+                    finished += 1
+                else:
+                    yield granule
+
+        for producer in producers:
+            producer.start()
 
-        if not os.path.isdir(data_directory):
-            os.makedirs(data_directory)
+        aggregator = HDFDataAggregator()
+        results = aggregator.process_stream(arriving_granules(), hdf_filter,
+                                            window.evict if window is not None else None, extracted)
+        if window is not None:
+            window.flush()
 
-        def count_callback(count):
-            self.signal_status_update('>>> Downloading %s granules...' % count)
+        for producer in producers:
+            producer.join()
+        storage.record_failures(aggregator.failures)
 
-        storage = HDFStorage(data_directory, username, password)
-
-        finished = False
-        max_retries = 50
-        num_retries = 0
-        while not finished:
-            success = storage.download_files(urls, count_callback)
-            if success:
-                finished = True
-            elif num_retries == max_retries:
-                print("Max retries reached. Some granules failed to download!")
-                finished = True
-            else:
-                num_retries += 1
-                print("Retrying failed granule downloads. Retry {} of {}...".format(num_retries, max_retries))
-                self.delete_empty_hdfs(data_directory)
+        return results
 
     @staticmethod
     def get_granules(data):
@@ -196,14 +323,15 @@ class MainController(object):
         return start_granule, end_granule
 
     @staticmethod
-    def get_urls_for_granules(data, start_granule, end_granule):
-        min_latitude = float(data['min_latitude'])
-        max_latitude = float(data['max_latitude'])
-        min_longitude = float(data['min_longitude'])
-        max_longitude = float(data['max_longitude'])
-        gca_threshold = float(data['gca_threshold'])
-        gca_is_max = bool(data['gca_is_max'])
-        include_prime_meridian = data['include_prime_meridian']
+    def build_position_query(data):
+        return PositionQuery(
+            float(data['min_latitude']), float(data['min_longitude']), float(data['max_latitude']),
+            float(data['max_longitude']), data['include_prime_meridian'], float(data['gca_threshold']),
+            bool(data['gca_is_max']), data.get('gca_reference', 'subsolar')
+        )
+
+    def get_urls_for_granules(self, data, start_granule, end_granule):
+        query = self.build_position_query(data)
         if 'test_hdf_output' in data:
             test_hdf_output = data['test_hdf_output']
         else:
@@ -213,12 +341,28 @@ class MainController(object):
 
         if test_hdf_output:
             return aqua_positions.get_hdf_urls(
-                start_granule, end_granule, min_latitude, min_longitude, max_latitude, max_longitude,
-                include_prime_meridian, gca_threshold, gca_is_max, test_hdf_output)
+                start_granule, end_granule, query.min_latitude, query.min_longitude, query.max_latitude,
+                query.max_longitude, query.include_prime_meridian, query.gca_threshold, query.gca_is_max,
+                test_hdf_output, query.gca_reference)
 
         return list(aqua_positions.get_hdf_urls(
-            start_granule, end_granule, min_latitude, min_longitude, max_latitude, max_longitude,
-            include_prime_meridian, gca_threshold, gca_is_max, test_hdf_output))
+            start_granule, end_granule, query.min_latitude, query.min_longitude, query.max_latitude,
+            query.max_longitude, query.include_prime_meridian, query.gca_threshold, query.gca_is_max,
+            test_hdf_output, query.gca_reference))
+
+    def get_urls_for_batch(self, data_items):
+        """
+        Selects the granules for several settings dicts that share the same date and time range (e.g. the files of a
+        batch directory that only differ in their longitude slice) in a single pass over the position table. Returns
+        a tuple with the list of URLs for each item and the sorted union of all of them.
+        """
+        start_granule, end_granule = self.get_granules(data_items[0])
+        if any(self.get_granules(data) != (start_granule, end_granule) for data in data_items[1:]):
+            raise ValueError('All settings in a batch query must share the same date and time range.')
+
+        queries = [self.build_position_query(data) for data in data_items]
+
+        return AquaPositions().get_hdf_urls_for_queries(start_granule, end_granule, queries)
 
     @staticmethod
     def build_hdf_filter(data):
@@ -249,6 +393,9 @@ class MainController(object):
             max_lon = data['max_longitude']
             include_prime_meridian = data['include_prime_meridian']
             delete_unreadable = data['delete_unreadable_granules']
+            transcode = data.get('transcode_granules', False)
+            drop_hdf = data.get('drop_transcoded_hdf', False)
+            engine = data.get('processing_engine', PANDAS_ENGINE)
 
             noise_amp = data['noise_amp']  # bool
             radiance = None
@@ -260,7 +407,7 @@ class MainController(object):
                 cloud_cover_threshold_is_max, all_spots_avg_threshold, all_spots_avg_threshold_is_max, noise_amp,
                 dust_flag_no_dust, dust_flag_single_fov, dust_flag_detected, examine_wavenumber_mode, selected_wavenumber,
                 scanang, inside_scanang, solzen_threshold, solzen_is_max, min_lat, max_lat, min_lon, max_lon,
-                include_prime_meridian, delete_unreadable
+                include_prime_meridian, delete_unreadable, transcode, engine, drop_hdf
             )
 
         except KeyError as e:
@@ -0,0 +1,156 @@
+import threading
+
+# granules downloaded in one step of the prefetcher; the disk budget is checked before each step
+PREFETCH_CHUNK_SIZE = 10
+DEFAULT_PREFETCH_DISK_BUDGET_GB = 20
+
+
+class BatchPrefetcher(object):
+    """
+    Selects and downloads the granules of the next batches_ahead batches of data_list in a background thread, while
+    the current batch is processed. A batch is a settings dict, or a list of them for files that run it together.
+    Call claim(index) when batch index starts: prefetching stops for that batch, and the batch's own download_files
+    call fetches whatever is still missing. Call selected(index) once the batch's granules are selected; prefetching
+    waits for that, so the position index of a year is never built by the batch and the prefetcher at the same time.
+
+    Prefetched files of batches that have not started yet may take up at most disk_budget bytes. Prefetching pauses
+    once they do, and resumes as batches start and their files stop counting. Granules are downloaded
+    PREFETCH_CHUNK_SIZE at a time, so the budget can be exceeded by one chunk at most.
+    """
+
+    def __init__(self, controller, data_list, batches_ahead=1, disk_budget=DEFAULT_PREFETCH_DISK_BUDGET_GB * 1e9):
+        self._controller = controller
+        self._data_list = data_list
+        self._batches_ahead = batches_ahead
+        self._disk_budget = disk_budget
+
+        self._condition = threading.Condition()
+        # prefetch downloads hold this lock, so a claimed batch never downloads the same files at the same time
+        self._download_lock = threading.Lock()
+        # the first batch is never prefetched, it starts right away
+        self._current = 0
+        # last batch whose granules were selected
+        self._selected = -1
+        self._stopped = False
+        self._prefetched_bytes = {}
+        # batch the background thread is waiting for in _wait_for, if any
+        self._waiting = None
+        self._finished = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @property
+    def prefetched_bytes(self):
+        """Bytes prefetched for batches that have not started yet"""
+        with self._condition:
+            return self._unclaimed_bytes()
+
+    def start(self):
+        self._thread.start()
+
+    def claim(self, index):
+        """Marks batch index as started, and waits for any prefetch download of it to finish"""
+        with self._condition:
+            self._current = index
+            self._condition.notify_all()
+        with self._download_lock:
+            pass
+
+    def selected(self, index):
+        """Marks the granule selection of batch index as finished"""
+        with self._condition:
+            self._selected = max(self._selected, index)
+            self._condition.notify_all()
+
+    def wait_until_paused(self, timeout=None):
+        """Waits until prefetching pauses, for a batch to start, its selection or disk space, or has finished. Returns
+        False if it did not within timeout seconds."""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self._finished or (self._waiting is not None and not self._may_continue(self._waiting)),
+                timeout)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _is_wanted(self, index):
+        return not self._stopped and self._current < index <= self._current + self._batches_ahead
+
+    def _wait_for(self, index):
+        """Waits until batch index is at most batches_ahead after the current batch, the current batch's selection has
+        finished and the disk budget is not used up. Returns False if the batch started in the meantime or the
+        prefetcher was stopped."""
+        with self._condition:
+            self._waiting = index
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: self._may_continue(index))
+            self._waiting = None
+            return self._is_wanted(index)
+
+    def _may_continue(self, index):
+        return self._stopped or index <= self._current or \
+            (self._is_wanted(index) and self._selected >= self._current and self._unclaimed_bytes() < self._disk_budget)
+
+    def _unclaimed_bytes(self):
+        return sum(size for index, size in self._prefetched_bytes.items() if index > self._current)
+
+    def _record(self, index, result):
+        if result.succeeded:
+            with self._condition:
+                self._prefetched_bytes[index] = self._prefetched_bytes.get(index, 0) + result.file_size
+
+    def _run(self):
+        try:
+            self._prefetch()
+        finally:
+            with self._condition:
+                self._finished = True
+                self._condition.notify_all()
+
+    def _prefetch(self):
+        for index in range(1, len(self._data_list)):
+            if not self._wait_for(index):
+                continue
+
+            try:
+                selection = self._select(self._data_list[index])
+            except Exception as e:
+                print('WARNING: Could not prefetch batch %s: %s' % (index + 1, e))
+                continue
+
+            print('Prefetching %s granules of batch %s...' % (sum(len(missing) for _storage, missing in selection),
+                                                             index + 1))
+            for storage, missing in selection:
+                for start in range(0, len(missing), PREFETCH_CHUNK_SIZE):
+                    if not self._wait_for(index):
+                        break
+                    with self._download_lock:
+                        with self._condition:
+                            if not self._is_wanted(index):
+                                break
+                        storage.download_files(missing[start:start + PREFETCH_CHUNK_SIZE],
+                                               on_complete=lambda result: self._record(index, result))
+
+    def _select(self, data):
+        """Returns (storage, URLs not stored yet) of the granules batch data selects. data is a settings dict, or a
+        list of the settings of several files that run the batch together (see cli.py), whose union is selected in
+        one pass over the position table per data directory and granule range (see MainController.get_urls_for_batch).
+        """
+        if isinstance(data, dict):
+            urls = self._controller.get_urls_for_granules(data, *self._controller.get_granules(data))
+            storage = self._controller.get_storage(data)
+            return [(storage, list(storage.filter_files(urls)))]
+
+        groups = {}
+        for item in data:
+            start_granule, end_granule = self._controller.get_granules(item)
+            groups.setdefault((item['data_directory'], int(start_granule), int(end_granule)), []).append(item)
+
+        selection = []
+        for items in groups.values():
+            _urls, all_urls = self._controller.get_urls_for_batch(items)
+            storage = self._controller.get_storage(items[0])
+            selection.append((storage, list(storage.filter_files(all_urls))))
+        return selection
@@ -0,0 +1,165 @@
+import hashlib
+import os
+import pickle
+import shutil
+import threading
+
+import pandas as pd
+
+# granules downloaded in one step of the rolling window; the window is checked before each step
+ROLLING_WINDOW_CHUNK_SIZE = 10
+# extracted granules whose results are checkpointed together before they are evicted
+CHECKPOINT_GRANULES = 10
+# subdirectory of the data directory holding the PartialResults of rolling window batches
+PARTIAL_RESULTS_DIRECTORY = 'partial_results'
+
+
+def merge_results(first, second):
+    """Merges two extraction results of granules of the same period into one, as calculate_averages_and_filter would
+    add them up"""
+    granule, sums, counts, selected, stats, cloud_info, details = first
+    _granule, other_sums, other_counts, other_selected, other_stats, other_cloud_info, other_details = second
+
+    selected = {bucket: values if other_selected[bucket] is None else
+                (values or []) + other_selected[bucket] for bucket, values in selected.items()}
+    if details is None or other_details is None:
+        details = details if other_details is None else other_details
+    else:
+        details = pd.concat([details, other_details])
+    stats = tuple(value + other_value for value, other_value in zip(stats, other_stats))
+    cloud_info = cloud_info if cloud_info[1] <= other_cloud_info[1] else other_cloud_info
+    return granule, sums + other_sums, counts + other_counts, selected, stats, cloud_info, details
+
+
+class PartialResults(object):
+    """
+    Running totals of the extraction results of a rolling window batch, checkpointed in one file per period under
+    <data directory>/partial_results/<batch>/ until the batch output is written. Each checkpoint holds one merged
+    result (see merge_results) and the names of the granules in it, so it stays the size of a single result however
+    many granules the period has. A granule is only evicted once its results are checkpointed, so a batch that is
+    interrupted picks them up again instead of downloading the granule. The checkpoints depend on the filter settings
+    and on the granules of the batch, so each batch gets its own directory.
+    """
+
+    def __init__(self, data_directory, hdf_filter, names):
+        batch = repr(sorted(vars(hdf_filter).items())) + '\n' + '\n'.join(sorted(names))
+        self.directory = os.path.join(data_directory, PARTIAL_RESULTS_DIRECTORY,
+                                      hashlib.md5(batch.encode()).hexdigest())
+        # {period: (names, merged result)}
+        self._periods = {}
+
+    @staticmethod
+    def _filename(period):
+        return period.replace(' ', '_') + '.pickle'
+
+    def load(self):
+        """Returns the names of the granules with checkpointed results, and the merged result of each period"""
+        if os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                if filename.endswith('.pickle'):
+                    with open(os.path.join(self.directory, filename), 'rb') as f:
+                        names, result = pickle.load(f)
+                    self._periods[result[0].month_period] = (names, result)
+        names = set()
+        for period_names, _result in self._periods.values():
+            names.update(period_names)
+        return names, [result for _names, result in self._periods.values()]
+
+    def store(self, results):
+        """Adds {name: result} of extracted granules to the checkpoints of their periods. Each checkpoint is replaced,
+        so it is never partly written."""
+        os.makedirs(self.directory, exist_ok=True)
+        periods = set()
+        for name, result in results.items():
+            period = result[0].month_period
+            names, merged = self._periods.get(period, (frozenset(), None))
+            self._periods[period] = (names | {name}, result if merged is None else merge_results(merged, result))
+            periods.add(period)
+
+        for period in periods:
+            path = os.path.join(self.directory, self._filename(period))
+            with open(path + '.part', 'wb') as f:
+                pickle.dump(self._periods[period], f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.part', path)
+
+    def remove(self):
+        """Removes the checkpoints, once the output of the batch is written"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(self.directory))
+        except OSError:
+            # other batches still have checkpoints
+            pass
+
+
+class RollingWindow(object):
+    """
+    Bounds the raw granules a batch keeps on disk in the rolling window mode (see MainController.download_and_aggregate)
+    to budget bytes. Only granules the window downloaded (or linked from the granule cache) are added, as they land;
+    granules that were stored before the batch started are left alone. Added granules are evicted (deleted, and
+    dropped from the storage's catalog) once their extraction results are checkpointed in partial_results, which
+    happens for CHECKPOINT_GRANULES granules at a time, or right away while the window is full. Downloads call
+    wait_for_space before each step of ROLLING_WINDOW_CHUNK_SIZE granules, so the budget can be exceeded by one step
+    at most.
+
+    Transcoded files (see transcode.py) are kept, they are what later runs read instead of downloading again. With a
+    granule cache on the same disk, evicted granules also stay in the cache, up to its quota.
+    """
+
+    def __init__(self, storage, budget, partial_results):
+        self._storage = storage
+        self.partial_results = partial_results
+        self._budget = budget
+        self._sizes = {}
+        # [(granule, result)] extracted, waiting for the next checkpoint
+        self._pending = []
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+
+    @property
+    def size(self):
+        with self._condition:
+            return sum(self._sizes.values())
+
+    def add(self, filename, size):
+        with self._condition:
+            self._sizes[os.path.basename(filename)] = size
+
+    def wait_for_space(self):
+        with self._condition:
+            self._condition.wait_for(lambda: sum(self._sizes.values()) < self._budget)
+
+    def evict(self, granule, result=None):
+        """Evicts granule, if the window added it, with the next checkpoint of its extraction result (None if the
+        extraction failed)"""
+        with self._condition:
+            if os.path.basename(granule.local_file_name) not in self._sizes:
+                return
+            self._pending.append((granule, result))
+            full = sum(self._sizes.values()) >= self._budget
+            if len(self._pending) < CHECKPOINT_GRANULES and not full:
+                return
+        self.flush()
+
+    def flush(self):
+        """Checkpoints the results of the extracted granules, and then deletes them"""
+        with self._flush_lock:
+            with self._condition:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+
+            self.partial_results.store({os.path.basename(granule.local_file_name): result for granule, result in pending
+                                        if result is not None and result[1] is not None})
+            for granule, _result in pending:
+                name = os.path.basename(granule.local_file_name)
+                try:
+                    os.remove(granule.local_file_name)
+                except FileNotFoundError:
+                    pass
+                self._storage.catalog.remove(name)
+                with self._condition:
+                    self._sizes.pop(name, None)
+                    self._condition.notify_all()
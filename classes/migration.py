@@ -0,0 +1,60 @@
+"""
+Moves the granules of a data directory into another layout (see granule.LAYOUTS): the HDF files and their transcoded
+files, MIGRATION_THREADS at a time. Moves are renames within the directory, so no data is copied, and the directory is
+listed once.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .catalog import GranuleCatalog
+from .granule import find_granule_files, granule_paths
+from .transcode import TRANSCODED_SUFFIX
+
+MIGRATION_THREADS = 16
+
+
+def move_file(source, destination):
+    """Moves a file, and returns whether it had to be moved"""
+    if source == destination:
+        return False
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    os.replace(source, destination)
+    return True
+
+
+def remove_empty_directories(directory, paths):
+    """Removes the directories in paths that are empty now, and their parents up to directory"""
+    for path in sorted(paths, reverse=True):
+        while path != directory and os.path.isdir(path) and not os.listdir(path):
+            os.rmdir(path)
+            path = os.path.dirname(path)
+
+
+def migrate_directory(directory, layout, catalog=None, threads=MIGRATION_THREADS):
+    """Moves the granules of directory into layout and records it in the catalog. Returns the number of files
+    moved."""
+    own_catalog = catalog is None
+    if own_catalog:
+        catalog = GranuleCatalog(directory)
+    try:
+        if catalog.layout == layout:
+            return 0
+
+        # only granules in the directory itself or in their date subdirectory, other subdirectories are left alone
+        sources = find_granule_files(directory, ('.hdf', TRANSCODED_SUFFIX))
+        # transcoded files go next to their granule
+        hdf_names = {name: os.path.splitext(name)[0] + '.hdf' for name in sources}
+        hdf_paths = granule_paths(set(hdf_names.values()), directory, layout)
+        destinations = {name: os.path.join(os.path.dirname(hdf_paths[hdf_names[name]]), name) for name in sources}
+
+        print('Moving %s files of %s from the %s to the %s layout...' % (len(sources), directory, catalog.layout,
+                                                                        layout))
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            moved = sum(executor.map(move_file, sources.values(), (destinations[name] for name in sources)))
+
+        remove_empty_directories(directory, set(os.path.dirname(source) for source in sources.values()))
+        catalog.layout = layout
+        return moved
+    finally:
+        if own_catalog:
+            catalog.close()
@@ -0,0 +1,125 @@
+"""
+NumPy extraction engine ("processing_engine": "numpy"). Filters a granule straight from its SDS arrays with flat
+masks over its 1350 pixels, instead of building, stacking and indexing DataFrames like hdf.filter_dataset does. It
+returns the same (LATITUDE_BUCKETS, CHANNELS) sums and counts, and filter stats.
+
+Filter stats are counted from the number of valid (non-NaN) channels of each pixel, so each filter stage costs one
+pass over the pixels rather than over the whole radiance matrix. Latitude bins are assigned once per pixel, and the
+quality-masked radiances of each bin are accumulated with a single bincount.
+"""
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from .aqua_positions import calculate_lat_lon_filter_condition
+
+PIXELS = 45 * 30
+CHANNELS = 2378
+
+# 10 degree latitude bins; the bins below 0 include their lower edge, the ones above 0 their upper edge, and 0to10
+# includes both
+LATITUDE_BUCKETS = ['%sto%s' % (lower, lower + 10) for lower in range(-90, 90, 10)]
+
+
+def latitude_bins(latitude):
+    """Returns the index in LATITUDE_BUCKETS of each latitude, or -1 for latitudes outside of [-90, 90] (and NaN)"""
+    latitude = np.asarray(latitude)
+    edges = np.arange(-90, 100, 10)
+    southern = np.searchsorted(edges, latitude, side='right') - 1
+    northern = np.searchsorted(edges, latitude, side='left') - 1
+    bins = np.where(latitude < 0, southern, np.where(latitude <= 10, 9, northern))
+    return np.where((latitude >= -90) & (latitude <= 90), bins, -1)
+
+
+def bin_sums_and_counts(radiances, bins):
+    """Sums and counts the non-NaN radiances of the pixels of each latitude bin into (bins, channels) arrays. Pixels
+    with a bin of -1 are skipped."""
+    binned = bins >= 0
+    radiances = radiances[binned]
+    valid = ~np.isnan(radiances)
+    index = (bins[binned][:, np.newaxis] * CHANNELS + np.arange(CHANNELS)).reshape(-1)
+    size = len(LATITUDE_BUCKETS) * CHANNELS
+    sums = np.bincount(index, weights=np.where(valid, radiances, 0).reshape(-1), minlength=size)
+    counts = np.bincount(index, weights=valid.reshape(-1), minlength=size)
+    return sums.reshape(-1, CHANNELS), counts.reshape(-1, CHANNELS).astype(np.int64)
+
+
+def granule_cloud_cover(cloud_cover):
+    """Mean of the column means of TotCld_4_CCfinal, as DataFrame.mean().mean() computes it"""
+    column_means = pd.DataFrame(cloud_cover).mean()
+    return column_means.mean()
+
+
+def filter_granule(data, hdf_filter):
+    """
+    Filters the datasets of a granule (see transcode.GRANULE_DATASETS) like hdf.filter_dataset, and returns the same
+    (radiances_by_latitude_sum, radiances_by_latitude_count, selected_radiances_by_latitude, filter_stats,
+    filtered_wavenumber_data). The examine wavenumber mode is not supported.
+    """
+    latitude = data['Latitude'].reshape(-1)
+    longitude = data['Longitude'].reshape(-1)
+    radiances = data['radiances'].reshape(PIXELS, CHANNELS)
+    quality = data['radiances_QC'].reshape(PIXELS, CHANNELS)
+
+    condition = np.asarray(calculate_lat_lon_filter_condition(
+        SimpleNamespace(lat=latitude, lon=longitude), hdf_filter.min_lat, hdf_filter.max_lat, hdf_filter.min_lon,
+        hdf_filter.max_lon, hdf_filter.include_prime_meridian, is_search_area=False))
+
+    # number of data points (valid channels) of each pixel
+    valid_channels = np.count_nonzero(~np.isnan(radiances), axis=1)
+    num_data_points = valid_channels[condition].sum()
+    remaining = num_data_points
+
+    def filtered_by(stage_condition):
+        nonlocal condition, remaining
+        condition &= stage_condition
+        left = valid_channels[condition].sum()
+        filtered = remaining - left
+        remaining = left
+        return filtered
+
+    def threshold(values, limit, is_max):
+        values = data[values].reshape(-1)
+        return values <= limit if is_max else values >= limit
+
+    num_filtered_landfrac = filtered_by(
+        threshold('landFrac', hdf_filter.landfrac_threshold, hdf_filter.landfrac_threshold_is_max))
+    num_filtered_cloud_cover = filtered_by(
+        threshold('TotCld_4_CCfinal', hdf_filter.cloud_cover_threshold, hdf_filter.cloud_cover_threshold_is_max))
+    num_filtered_all_spots = filtered_by(
+        threshold('all_spots_avg', hdf_filter.all_spots_avg_threshold, hdf_filter.all_spots_avg_threshold_is_max))
+
+    num_filtered_noise_amp = 0
+    if hdf_filter.noise_amp:
+        noise_amp = data['CCfinal_Noise_Amp'].reshape(-1)
+        num_filtered_noise_amp = filtered_by((noise_amp > 0.3333) & (noise_amp < 0.3334))
+
+    scanang = data['scanang'].reshape(-1)
+    if hdf_filter.inside_scanang:
+        num_filtered_scanang = filtered_by((scanang > -hdf_filter.scanang) & (scanang < hdf_filter.scanang))
+    else:
+        num_filtered_scanang = filtered_by((scanang <= -hdf_filter.scanang) & (scanang >= hdf_filter.scanang))
+
+    dust_filters = [hdf_filter.dust_flag_no_dust, hdf_filter.dust_flag_single_fov, hdf_filter.dust_flag_detected]
+    dust_values = [index - 1 for index, selected in enumerate(dust_filters) if selected]
+    num_filtered_dust = filtered_by(np.isin(data['dust_flag'].reshape(-1), dust_values))
+
+    num_filtered_solzen = filtered_by(threshold('solzen', hdf_filter.solzen_threshold, hdf_filter.solzen_is_max))
+
+    # radiances of the selected pixels, with the ones of unselected quality masked out
+    bins = np.where(condition, latitude_bins(latitude), -1)
+    radiance_qc_filters = [hdf_filter.data_quality_best, hdf_filter.data_quality_enough, hdf_filter.data_quality_worst]
+    radiance_qc_values = [index for index, selected in enumerate(radiance_qc_filters) if selected]
+    binned = bins >= 0
+    quality_radiances = np.where(np.isin(quality[binned], radiance_qc_values), radiances[binned], np.nan)
+    sums, counts = bin_sums_and_counts(quality_radiances, bins[binned])
+
+    num_filtered_quality = valid_channels[binned].sum() - counts.sum()
+    num_filtered_total = num_data_points - remaining + num_filtered_quality
+
+    filter_stats = (num_data_points, num_filtered_total, num_filtered_landfrac, num_filtered_cloud_cover,
+                    num_filtered_all_spots, num_filtered_noise_amp, num_filtered_dust, num_filtered_quality,
+                    num_filtered_scanang, num_filtered_solzen)
+
+    return sums, counts, dict.fromkeys(LATITUDE_BUCKETS), filter_stats, None
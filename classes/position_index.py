@@ -0,0 +1,267 @@
+"""
+Binary, memory-mapped copy of the data/aqua_positions_<year>.csv.zip files (without their GCA column).
+
+Each year is stored as a directory of typed .npy columns (one file per column) plus an interned table of HDF
+filenames, so granule selection only has to map a few small files instead of decompressing and parsing a CSV. Rows
+are sorted on the same integer key as int(Granule), so a granule range is found with two binary searches.
+The binary copy is built from the zipped CSV the first time a year is requested, and rebuilt automatically
+whenever the zip changes (or the index format is bumped).
+
+Each row also carries the granule's bounding footprint (lat_min, lat_max, lon_west, lon_east). A footprint with
+lon_west > lon_east crosses the antimeridian. CSVs built from the XML BoundingRectangle provide the real footprint
+in their west/north/east/south columns; older CSVs only have the granule centre, in which case a conservative box
+around the centre is derived (see derive_footprints).
+"""
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+
+import numpy as np
+import pandas
+
+from .granule import granule_keys
+
+DATA_DIRECTORY = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', 'data'))
+
+INDEX_FORMAT_VERSION = 4
+
+# column name -> dtype stored on disk. 'key' is the sort key (same value as int(Granule)) and 'filename_id' points
+# into the interned filename table. GCA is not stored: it is calculated at query time (see classes/solar.py).
+COLUMN_TYPES = {
+    'key': np.int64,
+    'year': np.uint16,
+    'day': np.uint16,
+    'granule': np.uint8,
+    'lat': np.float32,
+    'lon': np.float32,
+    'lat_min': np.float32,
+    'lat_max': np.float32,
+    'lon_west': np.float32,
+    'lon_east': np.float32,
+    'filename_id': np.uint32,
+}
+
+FOOTPRINT_COLUMNS = ['west', 'north', 'east', 'south']
+
+# columns of the zipped CSVs, in order. The footprint columns are only written when known for some row.
+CSV_COLUMNS = ['year', 'day', 'granule', 'lat', 'lon', 'hdf_filename', 'GCA']
+
+# half-height of a derived footprint, in degrees of latitude
+DERIVED_FOOTPRINT_HALF_HEIGHT = 10
+
+# (minimum absolute latitude of the centre, half-width of a derived footprint in degrees of longitude). Granules get
+# wider in longitude towards the poles, and above 80 degrees they can span every longitude.
+DERIVED_FOOTPRINT_HALF_WIDTHS = [
+    (0, 10),
+    (60, 25),
+    (70, 45),
+    (80, 180),
+]
+
+# held while an index is built, so threads that need the same cold year build it once
+_build_lock = threading.RLock()
+
+
+class PositionIndex(object):
+    def __init__(self, data_directory=DATA_DIRECTORY):
+        self._data_directory = data_directory
+        self._index_directory = os.path.join(data_directory, 'index')
+        self._columns = {}
+        self._filenames = {}
+
+    def zip_path(self, year):
+        return os.path.join(self._data_directory, 'aqua_positions_%s.csv.zip' % year)
+
+    def index_path(self, year):
+        return os.path.join(self._index_directory, str(year))
+
+    def _source_signature(self, year):
+        stat = os.stat(self.zip_path(year))
+        return '%s %s %s' % (INDEX_FORMAT_VERSION, stat.st_mtime_ns, stat.st_size)
+
+    def is_current(self, year):
+        try:
+            with open(os.path.join(self.index_path(year), 'VERSION')) as f:
+                return f.read().strip() == self._source_signature(year)
+        except FileNotFoundError:
+            return False
+
+    def build(self, year):
+        """Converts the zipped CSV for a year into its binary index. Writes to a temporary directory of its own first
+        so that a partially written index is never picked up, and builders in other processes do not get in the way.
+        If another process installs a current index first, that one is kept."""
+        with _build_lock:
+            data = pandas.read_csv(self.zip_path(year))
+            data['key'] = granule_keys(data.year, data.day, data.granule)
+            data['lat_min'], data['lat_max'], data['lon_west'], data['lon_east'] = read_footprints(data)
+            data = data.sort_values(by='key', kind='mergesort').reset_index(drop=True)
+
+            filenames, filename_ids = np.unique(data.hdf_filename.to_numpy(dtype=str), return_inverse=True)
+            data['filename_id'] = filename_ids
+
+            # drop the memory maps of the previous build before replacing its files
+            self._columns.pop(year, None)
+            self._filenames.pop(year, None)
+
+            final_path = self.index_path(year)
+            os.makedirs(self._index_directory, exist_ok=True)
+            temp_path = tempfile.mkdtemp(prefix='%s.' % year, suffix='.tmp', dir=self._index_directory)
+
+            try:
+                for column, dtype in COLUMN_TYPES.items():
+                    np.save(os.path.join(temp_path, column + '.npy'), data[column].to_numpy().astype(dtype))
+                np.save(os.path.join(temp_path, 'filenames.npy'), filenames.astype(np.bytes_))
+
+                with open(os.path.join(temp_path, 'VERSION'), 'w') as f:
+                    f.write(self._source_signature(year))
+
+                shutil.rmtree(final_path, ignore_errors=True)
+                try:
+                    os.rename(temp_path, final_path)
+                except OSError:
+                    # another process installed its index since the rmtree
+                    if not self.is_current(year):
+                        raise
+            finally:
+                shutil.rmtree(temp_path, ignore_errors=True)
+
+    def has_year(self, year):
+        return os.path.isfile(self.zip_path(year))
+
+    def indexed_filenames(self, year):
+        """Returns a dict of day of year -> set of HDF filenames already in the index for that day."""
+        if not self.has_year(year):
+            return {}
+
+        columns = self.columns(year)
+        filenames = self._filenames[year][columns['filename_id']].astype(str)
+        days = np.asarray(columns['day'])
+
+        return {int(day): set(filenames[days == day]) for day in np.unique(days)}
+
+    def merge(self, year, positions):
+        """Adds rows (a DataFrame with the CSV_COLUMNS and optionally the footprint columns) to the zipped CSV of a
+        year, replacing existing rows of the same granule (year, day and granule number, so a granule reprocessed upstream
+        under a new filename replaces its old row), and rebuilds the year's index. The zip is written
+        next to the original and then moved over it, so an interrupted merge leaves the old data intact."""
+        if self.has_year(year):
+            existing = pandas.read_csv(self.zip_path(year))
+            positions = pandas.concat([existing, positions], sort=False, ignore_index=True)
+        positions = positions.drop_duplicates(subset=['year', 'day', 'granule'], keep='last')
+        positions = positions.sort_values(by=['day', 'granule'], kind='mergesort')
+
+        columns = CSV_COLUMNS + [
+            column for column in FOOTPRINT_COLUMNS if column in positions and positions[column].notna().any()
+        ]
+        csv_name = os.path.basename(self.zip_path(year))[:-len('.zip')]
+        temp_zip_path = self.zip_path(year) + '.tmp'
+        with zipfile.ZipFile(temp_zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zipped:
+            zipped.writestr(csv_name, positions.to_csv(columns=columns, index=False))
+        os.replace(temp_zip_path, self.zip_path(year))
+
+        self.build(year)
+
+    def columns(self, year):
+        """Returns a dict of memory-mapped column arrays for a year, building the index first if needed."""
+        if year not in self._columns:
+            with _build_lock:
+                if not self.is_current(year):
+                    self.build(year)
+                path = self.index_path(year)
+                filenames = np.load(os.path.join(path, 'filenames.npy'), mmap_mode='r')
+                self._columns[year] = {
+                    column: np.load(os.path.join(path, column + '.npy'), mmap_mode='r') for column in COLUMN_TYPES
+                }
+                self._filenames[year] = filenames
+
+        return self._columns[year]
+
+    def get_table(self, min_year, max_year):
+        """Returns the positions for all years in range as a DataFrame (without filenames, see hdf_filenames)."""
+        years = [self.columns(year) for year in range(min_year, max_year + 1)]
+
+        return pandas.DataFrame({
+            column: np.concatenate([columns[column] for columns in years]) for column in COLUMN_TYPES
+        })
+
+    def get_range(self, start_key, end_key):
+        """Returns the positions with start_key <= key <= end_key as a DataFrame. Only the matching slice of each
+        year is read from disk."""
+        min_year, max_year = start_key // 10 ** 6, end_key // 10 ** 6
+        slices = []
+
+        for year in range(min_year, max_year + 1):
+            columns = self.columns(year)
+            start = np.searchsorted(columns['key'], start_key, side='left')
+            end = np.searchsorted(columns['key'], end_key, side='right')
+            slices.append({column: columns[column][start:end] for column in COLUMN_TYPES})
+
+        return pandas.DataFrame({
+            column: np.concatenate([columns[column] for columns in slices]) for column in COLUMN_TYPES
+        })
+
+    def hdf_filenames(self, years, filename_ids):
+        """Resolves interned filename ids (as found in get_table) back to HDF filenames."""
+        years = np.asarray(years)
+        filename_ids = np.asarray(filename_ids)
+        result = np.empty(len(filename_ids), dtype=object)
+
+        for year in np.unique(years):
+            self.columns(int(year))
+            mask = years == year
+            result[mask] = self._filenames[int(year)][filename_ids[mask]].astype(str)
+
+        return result
+
+
+def read_footprints(data):
+    """Returns lat_min, lat_max, lon_west and lon_east arrays for a DataFrame of positions, using the bounding
+    rectangle columns where they are available and derived footprints elsewhere."""
+    lat_min, lat_max, lon_west, lon_east = derive_footprints(data.lat, data.lon)
+
+    if all(column in data for column in FOOTPRINT_COLUMNS):
+        known = data[FOOTPRINT_COLUMNS].notna().all(axis=1).to_numpy()
+        lat_min[known] = data.south[known]
+        lat_max[known] = data.north[known]
+        lon_west[known] = data.west[known]
+        lon_east[known] = data.east[known]
+
+    # a footprint that reaches a pole covers every longitude
+    pole_crossing = (lat_max >= 90) | (lat_min <= -90)
+    lon_west[pole_crossing] = -180
+    lon_east[pole_crossing] = 180
+
+    return lat_min, lat_max, lon_west, lon_east
+
+
+def derive_footprints(lat, lon):
+    """Returns a footprint box around each granule centre that contains the whole granule: +/-10 degrees of latitude,
+    and between +/-10 degrees and all longitudes depending on the latitude (see DERIVED_FOOTPRINT_HALF_WIDTHS)."""
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+
+    half_width = np.zeros(len(lat))
+    for min_abs_latitude, degrees in DERIVED_FOOTPRINT_HALF_WIDTHS:
+        half_width[np.abs(lat) >= min_abs_latitude] = degrees
+
+    lat_min = np.clip(lat - DERIVED_FOOTPRINT_HALF_HEIGHT, -90, 90)
+    lat_max = np.clip(lat + DERIVED_FOOTPRINT_HALF_HEIGHT, -90, 90)
+    lon_west = wrap_longitudes(lon - half_width)
+    lon_east = wrap_longitudes(lon + half_width)
+
+    whole_globe = half_width >= 180
+    lon_west[whole_globe] = -180
+    lon_east[whole_globe] = 180
+
+    return lat_min, lat_max, lon_west, lon_east
+
+
+def wrap_longitudes(lon):
+    """Wraps longitudes into [-180, 180]. Values already in range (including both ends) are kept as they are."""
+    lon = np.array(lon, dtype=np.float64)
+    out_of_range = (lon < -180) | (lon > 180)
+    lon[out_of_range] = (lon[out_of_range] + 180) % 360 - 180
+
+    return lon
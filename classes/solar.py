@@ -0,0 +1,120 @@
+"""
+Vectorized solar position and great-circle angle calculations.
+
+The subsolar point is computed with the low-precision solar coordinates of the Astronomical Almanac (section C) and
+the mean sidereal time at Greenwich, for whole arrays of timestamps at once. Over 2002-2030 it matches the ephem based
+calculate_GCA.calculate_subsolar_point to within SUBSOLAR_POINT_TOLERANCE degrees (see tests/test_solar.py), which is
+well below the 0.1 degree rounding of the GCA column.
+
+Granule times are on a regular 6 minute grid, so subsolar_table precomputes (and caches) the subsolar point of every
+(day, granule) of a year.
+
+GCA (the central angle between a granule and a reference point) is calculated at query time against one of the
+GCA_REFERENCES, or against a fixed [latitude, longitude] point (see reference_points).
+"""
+from functools import lru_cache
+
+import numpy as np
+
+# maximum difference to ephem, in degrees of latitude/longitude of the subsolar point
+SUBSOLAR_POINT_TOLERANCE = 0.02
+
+UNIX_EPOCH_JULIAN_DATE = 2440587.5
+J2000_JULIAN_DATE = 2451545.0
+
+# named reference points for GCA calculations, besides a fixed [latitude, longitude]
+GCA_REFERENCES = ('subsolar', 'antisolar')
+
+# granule N of a day starts (N - 1) * 6 minutes after midnight; positions are calculated 8m26s into that
+GRANULE_PERIOD = np.timedelta64(6, 'm')
+GRANULE_TIME_OFFSET = np.timedelta64(8 * 60 + 26, 's')
+
+
+def to_julian_date(times):
+    """Converts an array of datetime64 values (or anything numpy can convert to them), assumed UTC, to Julian dates"""
+    seconds = np.asarray(times, dtype='datetime64[ns]').astype(np.int64) / 1e9
+    return seconds / 86400. + UNIX_EPOCH_JULIAN_DATE
+
+
+def subsolar_point(times):
+    """Returns the (latitude, longitude) arrays of the subsolar point at each of the passed UTC times, in degrees"""
+    n = to_julian_date(times) - J2000_JULIAN_DATE
+
+    mean_longitude = 280.460 + 0.9856474 * n
+    mean_anomaly = np.radians(357.528 + 0.9856003 * n)
+    ecliptic_longitude = np.radians(mean_longitude + 1.915 * np.sin(mean_anomaly) + 0.020 * np.sin(2 * mean_anomaly))
+    obliquity = np.radians(23.439 - 0.0000004 * n)
+
+    right_ascension = np.degrees(np.arctan2(np.cos(obliquity) * np.sin(ecliptic_longitude),
+                                            np.cos(ecliptic_longitude)))
+    declination = np.degrees(np.arcsin(np.sin(obliquity) * np.sin(ecliptic_longitude)))
+    sidereal_time = 280.46061837 + 360.98564736629 * n
+
+    longitude = (right_ascension - sidereal_time + 180) % 360 - 180
+
+    return declination, longitude
+
+
+def central_angle(lat, lon, reference_lat, reference_lon):
+    """Great circle central angle, in degrees, between each (lat, lon) and the reference point(s)"""
+    lat_rad, lon_rad = np.radians(lat), np.radians(lon)
+    reference_lat_rad, reference_lon_rad = np.radians(reference_lat), np.radians(reference_lon)
+    cosine = np.sin(lat_rad) * np.sin(reference_lat_rad) + \
+        np.cos(lat_rad) * np.cos(reference_lat_rad) * np.cos(lon_rad - reference_lon_rad)
+
+    return np.degrees(np.arccos(np.clip(cosine, -1, 1)))
+
+
+def granule_times(year, day, granule):
+    """Returns the datetime64 (UTC) used for the position of each (year, day, granule)"""
+    year = np.asarray(year, dtype=np.int64)
+    start_of_year = (year - 1970).astype('datetime64[Y]').astype('datetime64[s]')
+
+    return start_of_year + (np.asarray(day, dtype=np.int64) - 1) * np.timedelta64(1, 'D') + \
+        (np.asarray(granule, dtype=np.int64) - 1) * GRANULE_PERIOD + GRANULE_TIME_OFFSET
+
+
+@lru_cache(maxsize=32)
+def subsolar_table(year):
+    """Returns (latitude, longitude) arrays of shape (367, 241), holding the subsolar point of granule G of day D of the
+    year at [D, G]. Index 0 of both axes is unused."""
+    day, granule = np.meshgrid(np.arange(367), np.arange(241), indexing='ij')
+    latitude, longitude = subsolar_point(granule_times(year, day, granule))
+    latitude.setflags(write=False)
+    longitude.setflags(write=False)
+
+    return latitude, longitude
+
+
+def subsolar_points_for_granules(year, day, granule):
+    """Returns the subsolar (latitude, longitude) arrays for arrays of (year, day, granule), using subsolar_table"""
+    year, day, granule = (np.asarray(values, dtype=np.int64) for values in (year, day, granule))
+    latitude = np.empty(len(year))
+    longitude = np.empty(len(year))
+
+    for table_year in np.unique(year):
+        rows = year == table_year
+        table_latitude, table_longitude = subsolar_table(int(table_year))
+        latitude[rows] = table_latitude[day[rows], granule[rows]]
+        longitude[rows] = table_longitude[day[rows], granule[rows]]
+
+    return latitude, longitude
+
+
+def reference_points(reference, year, day, granule):
+    """
+    Returns the (latitude, longitude) arrays of the GCA reference point for each (year, day, granule). The reference
+    is either 'subsolar', 'antisolar' (the point opposite the subsolar point) or a fixed (latitude, longitude) pair.
+    """
+    if isinstance(reference, str):
+        if reference not in GCA_REFERENCES:
+            raise ValueError('Unknown GCA reference "%s". Use one of %s or a [latitude, longitude] pair.'
+                             % (reference, ', '.join(GCA_REFERENCES)))
+        latitude, longitude = subsolar_points_for_granules(year, day, granule)
+        if reference == 'antisolar':
+            latitude, longitude = -latitude, longitude % 360 - 180
+        return latitude, longitude
+
+    reference_lat, reference_lon = map(float, reference)
+    count = len(np.asarray(year))
+    return np.full(count, reference_lat), np.full(count, reference_lon)
@@ -0,0 +1,148 @@
+"""
+Transcoded granules. extract_granule_dataset only needs 12 of the SDS of an AIRS2CCF granule, so a granule can be
+transcoded into a compressed .npz file next to it holding just those arrays, with radiances as float32 and radiances_QC
+as uint8. Reading it skips the HDF4 library and the datasets that are not used, which makes repeated analyses of the
+same granules faster.
+
+A transcoded file is only used while it is newer than its HDF file, so re-downloaded granules are transcoded again.
+
+A transcoded file takes extra space next to its HDF file, which the catalog, the granule cache and verification keep
+tracking. With drop_hdf, the HDF file is deleted once its transcoded file is verified to hold the same datasets (see
+drop_transcoded_hdf), and the catalog keeps the granule as transcoded only, so it is not downloaded again.
+"""
+import os
+import zipfile
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+from pyhdf.SD import SD
+from pyhdf.error import HDF4Error
+
+from .granule import find_granule_files
+
+TRANSCODED_SUFFIX = '.npz'
+GRANULE_DATASETS = ('dust_flag', 'landFrac', 'TotCld_4_CCfinal', 'all_spots_avg', 'CCfinal_Noise_Amp', 'Latitude',
+                    'Longitude', 'scanang', 'solzen', 'Time', 'radiances', 'radiances_QC')
+
+
+class MissingDatasetError(Exception):
+    pass
+
+
+def transcoded_file_name(filename):
+    return os.path.splitext(filename)[0] + TRANSCODED_SUFFIX
+
+
+def read_hdf_datasets(filename):
+    """Reads GRANULE_DATASETS from an HDF granule. Raises HDF4Error if the file cannot be opened, and
+    MissingDatasetError if a dataset is not in it."""
+    data = SD(filename)
+    try:
+        datasets = {}
+        for name in GRANULE_DATASETS:
+            try:
+                datasets[name] = data.select(name).get()
+            except HDF4Error:
+                raise MissingDatasetError(name)
+        return datasets
+    finally:
+        data.end()
+
+
+def write_transcoded(filename, datasets):
+    """Writes the datasets of the HDF granule filename to its transcoded file"""
+    datasets = dict(datasets)
+    datasets['radiances'] = datasets['radiances'].astype(np.float32, copy=False)
+    quality = datasets['radiances_QC']
+    if quality.size and 0 <= quality.min() and quality.max() <= np.iinfo(np.uint8).max:
+        datasets['radiances_QC'] = quality.astype(np.uint8)
+
+    transcoded = transcoded_file_name(filename)
+    with open(transcoded + '.part', 'wb') as f:
+        np.savez_compressed(f, **datasets)
+    os.replace(transcoded + '.part', transcoded)
+
+
+def has_current_transcoded(filename):
+    """Whether the HDF granule filename has a transcoded file that is newer than it"""
+    try:
+        transcoded_mtime = os.stat(transcoded_file_name(filename)).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    return not os.path.exists(filename) or transcoded_mtime >= os.stat(filename).st_mtime_ns
+
+
+def read_transcoded(filename):
+    """Returns the datasets of the transcoded file of the HDF granule filename, or None if it has no current one"""
+    if not has_current_transcoded(filename):
+        return None
+    transcoded = transcoded_file_name(filename)
+    try:
+        with np.load(transcoded) as f:
+            return {name: f[name] for name in GRANULE_DATASETS}
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        print('WARNING: Deleting unreadable transcoded granule %s' % transcoded)
+        os.remove(transcoded)
+        return None
+
+
+def drop_transcoded_hdf(filename, datasets=None):
+    """Deletes the HDF granule filename if its transcoded file holds the same GRANULE_DATASETS as it (datasets, when
+    the caller already read them from the HDF file). Returns whether the HDF file was deleted."""
+    transcoded = read_transcoded(filename)
+    if transcoded is None or not os.path.exists(filename):
+        return False
+    if datasets is None:
+        datasets = read_hdf_datasets(filename)
+    # the transcoded file has to hold exactly what write_transcoded converts the HDF datasets to
+    for name in GRANULE_DATASETS:
+        if not np.array_equal(transcoded[name], np.asarray(datasets[name]).astype(transcoded[name].dtype),
+                              equal_nan=transcoded[name].dtype.kind == 'f'):
+            return False
+    os.remove(filename)
+    return True
+
+
+def read_granule_datasets(filename, transcode=False, drop_hdf=False):
+    """Returns the GRANULE_DATASETS of a granule, from its transcoded file if it has a current one. Otherwise they are
+    read from the HDF file, which is transcoded if transcode is True. With drop_hdf too, the HDF file is deleted once
+    the transcoded file is verified."""
+    datasets = read_transcoded(filename)
+    if datasets is None:
+        datasets = read_hdf_datasets(filename)
+        if transcode:
+            write_transcoded(filename, datasets)
+            if drop_hdf:
+                drop_transcoded_hdf(filename, datasets)
+    elif transcode and drop_hdf and os.path.exists(filename):
+        drop_transcoded_hdf(filename)
+    return datasets
+
+
+def transcode_granule(filename, drop_hdf=False):
+    """Transcodes an HDF granule unless it has a current transcoded file, and deletes the HDF file afterwards if drop_hdf
+    is True (see drop_transcoded_hdf). Returns (filename, problem)."""
+    try:
+        datasets = None
+        if not has_current_transcoded(filename):
+            datasets = read_hdf_datasets(filename)
+            write_transcoded(filename, datasets)
+        if drop_hdf and not drop_transcoded_hdf(filename, datasets):
+            return filename, 'the transcoded file does not match the HDF file'
+        return filename, None
+    except (HDF4Error, MissingDatasetError, OSError) as e:
+        return filename, '%s: %s' % (type(e).__name__, e)
+
+
+def transcode_directory(directory, processes=None, drop_hdf=False):
+    """Transcodes all HDF granules of a directory (in any layout) in parallel, deleting the HDF files of the verified
+    ones if drop_hdf is True, and returns the (filename, problem) of the failures. The catalog of the directory
+    records the granules without HDF file as transcoded only when they are next requested (see
+    HDFStorage.verify_files)."""
+    filenames = sorted(find_granule_files(directory).values())
+    with Pool(processes=processes or cpu_count()) as pool:
+        return [(filename, problem) for filename, problem in
+                pool.imap_unordered(partial(transcode_granule, drop_hdf=drop_hdf), filenames) if problem is not None]
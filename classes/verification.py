@@ -0,0 +1,109 @@
+"""
+Granule verification. Before a download phase the stored granules are checked against the size and MD5 checksum the
+catalog (see catalog.GranuleCatalog) recorded when they were downloaded, so corrupt or truncated granules are deleted
+and fetched again in the same run.
+
+A verified file's mtime is recorded too, and files that have not been modified since are only checked by size.
+Granules without a checksum (downloaded before the catalog existed, or copied in by hand) are accepted if HDF4 can open
+them, and their checksum is recorded.
+"""
+import os
+from multiprocessing import Pool, cpu_count
+
+from pyhdf.SD import SD
+from pyhdf.error import HDF4Error
+
+from .catalog import GranuleCatalog
+from .download import file_md5
+from .granule import find_granule_files, granule_paths
+
+
+def is_readable_hdf(filename):
+    try:
+        SD(filename).end()
+        return True
+    except HDF4Error:
+        return False
+
+
+def check_file(filename, entry):
+    """
+    Checks a granule file against its catalog entry (None if there is none). Returns (filename, problem, entry) where
+    problem is None for a good file, and entry is the updated catalog entry of a good file.
+    """
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return filename, 'missing', None
+
+    if entry is None or entry['md5'] is None:
+        if not is_readable_hdf(filename):
+            return filename, 'not a readable HDF file', None
+        return filename, None, {'size': stat.st_size, 'md5': file_md5(filename), 'verified_mtime': stat.st_mtime_ns}
+
+    if stat.st_size != entry['size']:
+        return filename, 'size is %s bytes instead of %s' % (stat.st_size, entry['size']), None
+
+    if entry['verified_mtime'] != stat.st_mtime_ns:
+        if file_md5(filename) != entry['md5']:
+            return filename, 'checksum mismatch', None
+        entry = dict(entry, verified_mtime=stat.st_mtime_ns)
+
+    return filename, None, entry
+
+
+def needs_reading(filename, entry):
+    """Whether check_file has to read the contents of a file, or its size and mtime are enough"""
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return False
+    return entry is None or entry['md5'] is None or \
+        (stat.st_size == entry['size'] and entry['verified_mtime'] != stat.st_mtime_ns)
+
+
+def verify_files(filenames, catalog, processes=None):
+    """
+    Verifies granule files against the catalog, reading the ones that need a checksum in parallel. Updates the
+    catalog, and returns a list of (filename, problem) for the files that failed verification (or are missing).
+    """
+    entries = {filename: catalog.get(os.path.basename(filename)) for filename in filenames}
+    to_read = [filename for filename, entry in entries.items() if needs_reading(filename, entry)]
+    unread = set(entries).difference(to_read)
+
+    results = [check_file(filename, entries[filename]) for filename in unread]
+    if to_read:
+        print('Verifying checksums of %s granules...' % len(to_read))
+        with Pool(processes=min(processes or cpu_count(), len(to_read))) as pool:
+            results += pool.starmap(check_file, [(filename, entries[filename]) for filename in to_read])
+
+    failed = []
+    for filename, problem, entry in results:
+        name = os.path.basename(filename)
+        if problem is None:
+            catalog.record(name, **entry)
+        else:
+            catalog.remove(name)
+            failed.append((filename, problem))
+
+    return failed
+
+
+def verify_directory(directory, processes=None):
+    """Verifies every granule in directory, deleting the ones that fail, and drops catalog entries of files that are
+    gone. Returns the number of deleted files."""
+    catalog = GranuleCatalog(directory)
+    filenames = set(granule_paths(catalog.names(), directory, catalog.layout).values())
+    filenames.update(find_granule_files(directory).values())
+
+    failed = verify_files(sorted(filenames), catalog, processes)
+    catalog.close()
+
+    deleted = 0
+    for filename, problem in failed:
+        if os.path.exists(filename):
+            print('Deleting %s: %s' % (filename, problem))
+            os.remove(filename)
+            deleted += 1
+
+    return deleted
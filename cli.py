@@ -3,6 +3,7 @@ script's initialization."""
 
 import os
 import sys
+from functools import partial
 
 
 def main():
@@ -16,6 +17,8 @@ def main():
     
         {
             "data_directory": "C:\\TEMP\\DATA",  # where HDF files will be stored
+            "data_directory_layout": "flat",  # (optional) "date" stores granules in <year>/<day of year> subdirectories.
+                                              # Existing granules are moved when the layout changes.
             "output_directory": "C:\\TEMP\\OUTPUT",  # where the CSV and PNG output files will be stored
             
             "date_range_start": "12/31/2002",  # must follow mm/dd/yyyy
@@ -56,6 +59,8 @@ def main():
             
             "gca_threshold": 139.4,  # central angle between AQUA AIRS and Earth's subsolar point, in degrees. (Threshold is INCLUSIVE)
             "gca_is_max": false,  # whether the GCA threshold is a minimum (false) or maximum (true)
+            "gca_reference": "subsolar",  # (optional) point the GCA is measured from: "subsolar" (default),
+                                          # "antisolar" or a fixed [latitude, longitude] pair
             "solzen_threshold": 180,  # value between 0 and 180, min or max solar zenith (Threshold is INCLUSIVE)
             "solzen_is_max": true,  # whether the solzen threshold is a minimum (false) or maximum (true)
             
@@ -68,6 +73,18 @@ def main():
             "scanang_limit": 30,  # max inside/outside scan angle (Threshold is EXCLUSIVE if 'inside', INCLUSIVE otherwise)
             "inside_scanang": true  # whether or not scans must be inside or outside the above angle
             "delete_unreadable_granules": true  # If true, delete granules that are unreadable so they can be re-downloaded.
+            "retry_quarantined_granules": false  # (optional) download and process granules that failed repeatedly again
+            "max_connections": 10  # (optional) number of concurrent downloads. GESDISC allows at most 15.
+            "download_attempts": 10  # (optional) attempts per granule, with exponential backoff between them
+            "granule_cache_directory": "G:\\GRANULE_CACHE"  # (optional) granule cache shared by all data directories
+            "granule_cache_quota_gb": 200  # (optional) disk space the granule cache may take up
+            "transcode_granules": false  # (optional) keep a compact copy of the datasets used, read instead of the HDF
+            "drop_transcoded_hdf": false  # (optional) with transcode_granules, delete each HDF file once its transcoded copy is verified
+            "processing_engine": "pandas"  # (optional) "numpy" filters granules on plain arrays, with the same results
+            "pipeline": false  # (optional) process granules while the rest of the batch is still downloading
+            "prefetch_batches": 0  # (optional) upcoming batches (1 or 2) to download while a batch is processed
+            "prefetch_disk_budget_gb": 20  # (optional) disk space prefetched granules may take up
+            "rolling_window_gb": 0  # (optional) if set, keep at most this many GB of granules on disk, deleting each once its results are saved
             
         }         
             
@@ -98,7 +115,7 @@ def main():
         _username = input('EarthData Login username: ')
         _password = getpass()
 
-        def main_single_file_loop(data, global_username, global_pass, input_file_name):
+        def parse_settings(data, global_username, global_pass):
             if 'test_hdf_output' not in data or not data['test_hdf_output']:
                 username = global_username
                 password = global_pass
@@ -118,13 +135,10 @@ def main():
                 data['channel'] = parse_channel(data['wavelength'])
                 del data['wavelength']
 
-            data_list = []
+            return data
 
-            if data['examine_wavenumber_mode']:
-                temp_folder_name = 'wv_' + str(data['selected_wavenumber']) + '_info_' \
-                                   + datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-            else:
-                temp_folder_name = 'temp_' + datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        def split_into_batches(data, temp_folder_name):
+            data_list = []
 
             num_total_days: int = (data['date_range_end'] - data['date_range_start']).days + 1
 
@@ -192,72 +206,49 @@ def main():
 
                     data_list.append(batch)
 
-            controller = MainController(status_callback)
-
-            filter_stats = {}
-
-            days_processed: int = 0
-
-            time_started = datetime.now()
+            return data_list
+
+        def check_longitudes(data_item):
+            min_lon = data_item['min_longitude']
+            max_lon = data_item['max_longitude']
+            if min_lon > max_lon:
+                print('Error: Min lon is greater than max lon. Switch min and max values.')
+                exit(0)
+
+            if min_lon == 0 or max_lon == 0:
+                from classes.aqua_positions import calculate_longitude_angle_in_degrees
+                western_min_lon = min_lon + 0.001
+                eastern_min_lon = min_lon - 0.001
+                western_max_lon = max_lon + 0.001
+                eastern_max_lon = max_lon - 0.001
+                eastern_angle_pm = calculate_longitude_angle_in_degrees(eastern_min_lon, eastern_max_lon, True)
+                western_angle_pm = calculate_longitude_angle_in_degrees(western_min_lon, western_max_lon, True)
+                eastern_angle_no_pm = calculate_longitude_angle_in_degrees(eastern_min_lon, eastern_max_lon, False)
+                western_angle_no_pm = calculate_longitude_angle_in_degrees(western_min_lon, western_max_lon, False)
+
+                print(
+                    '\nError: Hemisphere selection is ambiguous. Max or min longitude CANNOT be zero. '
+                    '\n'
+                    '\nUse 0.001 or -0.001 instead.'
+                    '\n'
+                    '\nDouble check that you use the correct include_prime_meridian setting after making this change.'
+                    '\n'
+                    '\n 0.001 and include_prime_meridian = false: {} degree slice'
+                    '\n-0.001 and include_prime_meridian = false: {} degree slice'
+                    '\n 0.001 and include_prime_meridian = true:  {} degree slice'
+                    '\n-0.001 and include_prime_meridian = true:  {} degree slice'
+                        .format(western_angle_no_pm, eastern_angle_no_pm, western_angle_pm, eastern_angle_pm)
+                )
+                exit(0)
 
-            for data_item in data_list:
-                min_lon = data_item['min_longitude']
-                max_lon = data_item['max_longitude']
-                if min_lon > max_lon:
-                    print('Error: Min lon is greater than max lon. Switch min and max values.')
-                    exit(0)
-
-                if min_lon == 0 or max_lon == 0:
-                    from classes.aqua_positions import calculate_longitude_angle_in_degrees
-                    western_min_lon = min_lon + 0.001
-                    eastern_min_lon = min_lon - 0.001
-                    western_max_lon = max_lon + 0.001
-                    eastern_max_lon = max_lon - 0.001
-                    eastern_angle_pm = calculate_longitude_angle_in_degrees(eastern_min_lon, eastern_max_lon, True)
-                    western_angle_pm = calculate_longitude_angle_in_degrees(western_min_lon, western_max_lon, True)
-                    eastern_angle_no_pm = calculate_longitude_angle_in_degrees(eastern_min_lon, eastern_max_lon, False)
-                    western_angle_no_pm = calculate_longitude_angle_in_degrees(western_min_lon, western_max_lon, False)
-
-                    print(
-                        '\nError: Hemisphere selection is ambiguous. Max or min longitude CANNOT be zero. '
-                        '\n'
-                        '\nUse 0.001 or -0.001 instead.'
-                        '\n'
-                        '\nDouble check that you use the correct include_prime_meridian setting after making this change.'
-                        '\n'
-                        '\n 0.001 and include_prime_meridian = false: {} degree slice'
-                        '\n-0.001 and include_prime_meridian = false: {} degree slice'
-                        '\n 0.001 and include_prime_meridian = true:  {} degree slice'
-                        '\n-0.001 and include_prime_meridian = true:  {} degree slice'
-                            .format(western_angle_no_pm, eastern_angle_no_pm, western_angle_pm, eastern_angle_pm)
-                    )
-                    exit(0)
-
-                time_batch_started = datetime.now()
-                print("Processing data for dates: {} through {}".format(
-                    (data_item['date_range_start']), data_item['date_range_end']))
-                controller.delete_empty_hdfs(data_item['data_directory'])
-                data_stats = controller.process(data_item)
-
-                if 'test_hdf_output' in data_item and data_item['test_hdf_output']:
-                    return data_stats
-
-                #  Collect and sum stats from output
-                if filter_stats:
-                    filter_stats = \
-                        {k: filter_stats.get(k, 0) + data_stats.get(k, 0) for k in set(filter_stats) | set(data_stats)}
-                    days_processed += (data_item['date_range_end'] - data_item['date_range_start']).days + 1
-                    print("\nProcessed {0:,} of {1:,} days ({2:.3g}%)".format(
-                        days_processed, num_total_days, days_processed / num_total_days * 100))
-                elapsed_seconds = (datetime.now() - time_batch_started).total_seconds()
-                elapsed_minutes = int(elapsed_seconds // 60) % 60
-                elapsed_hours = int(elapsed_seconds // 3600)
-                batch_remainder_seconds = int(elapsed_seconds % 60)
-                print('Batch completed in {}H {}m {}s'.format(elapsed_hours, elapsed_minutes, batch_remainder_seconds))
+        def write_file_output(run):
+            data = run['data']
+            temp_folder_name = run['temp_folder_name']
+            input_file_name = run['input_file_name']
 
             from classes.hdf import print_stats
             print("-- FINAL STATS --")
-            print_stats(filter_stats)
+            print_stats(run['filter_stats'])
 
             # Finally, concatenate all CSVs and remove the temp folder
 
@@ -304,32 +295,135 @@ def main():
                 except Exception as e:
                     print("Unable to delete temporary folder. Caught {}".format(e))
 
-            total_elapsed_seconds = (datetime.now() - time_started).total_seconds()
-            total_elapsed_minutes = int(total_elapsed_seconds // 60) % 60
-            total_elapsed_hours = int(total_elapsed_seconds // 3600)
-            remainder_seconds = int(total_elapsed_seconds % 60)
-            print('Processing completed in {}H {}m {}s'.format(total_elapsed_hours, total_elapsed_minutes,
-                                                               remainder_seconds))
+        def main_files_loop(files):
+            """
+            Processes the settings of the files [(data, input file name)] batch by batch: batch i of every file runs
+            before batch i + 1 of any, so the files of a batch directory share the granules of each month while they
+            are on disk. With prefetch_batches, the granules that the upcoming batches of all files select are
+            prefetched together while a batch is processed (see BatchPrefetcher), their union selected in one pass over
+            the position table (see MainController.get_urls_for_batch).
+            """
+            timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+            runs = []
+            for position, (data, input_file_name) in enumerate(files):
+                if data['examine_wavenumber_mode']:
+                    temp_folder_name = 'wv_' + str(data['selected_wavenumber']) + '_info_' + timestamp
+                else:
+                    temp_folder_name = 'temp_' + timestamp
+                if len(files) > 1:
+                    # the files run side by side, each needs a temp folder of its own
+                    temp_folder_name += '_' + str(position + 1)
+
+                runs.append({
+                    'data': data,
+                    'input_file_name': input_file_name,
+                    'temp_folder_name': temp_folder_name,
+                    'data_list': split_into_batches(data, temp_folder_name),
+                    'num_total_days': (data['date_range_end'] - data['date_range_start']).days + 1,
+                    'filter_stats': {},
+                    'days_processed': 0,
+                    'prefetch': bool(data.get('prefetch_batches', 0)) and not data.get('test_hdf_output', False),
+                    # the data stats of the first batch, in the test_hdf_output mode
+                    'test_output': None,
+                })
+            num_steps = max(len(run['data_list']) for run in runs)
+
+            controller = MainController(status_callback)
+
+            time_started = datetime.now()
+
+            prefetcher = None
+            prefetching = [run for run in runs if run['prefetch']]
+            if prefetching:
+                from classes.interface.prefetcher import BatchPrefetcher, DEFAULT_PREFETCH_DISK_BUDGET_GB
+
+                prefetch_list = []
+                for index in range(num_steps):
+                    items = [run['data_list'][index] for run in prefetching if index < len(run['data_list'])]
+                    prefetch_list.append(items[0] if len(items) == 1 else items)
+                # the files share one prefetcher, as far ahead as any of them looks and within the smallest budget
+                batches_ahead = max(int(run['data']['prefetch_batches']) for run in prefetching)
+                prefetch_disk_budget = min(
+                    float(run['data'].get('prefetch_disk_budget_gb', DEFAULT_PREFETCH_DISK_BUDGET_GB))
+                    for run in prefetching) * 1e9
+                prefetcher = BatchPrefetcher(controller, prefetch_list, batches_ahead, prefetch_disk_budget)
+                prefetcher.start()
+
+            for index in range(num_steps):
+                step = [run for run in runs if index < len(run['data_list']) and run['test_output'] is None]
+                if prefetcher is not None:
+                    prefetcher.claim(index)
+
+                for position, run in enumerate(step):
+                    data_item = run['data_list'][index]
+                    check_longitudes(data_item)
+
+                    time_batch_started = datetime.now()
+                    if len(runs) > 1:
+                        print('\nRunning file {}...\n'.format(run['input_file_name']))
+                    print("Processing data for dates: {} through {}".format(
+                        (data_item['date_range_start']), data_item['date_range_end']))
+                    on_selected = None
+                    if prefetcher is not None and position == len(step) - 1:
+                        # the next batch is prefetched once every file has selected this one
+                        on_selected = partial(prefetcher.selected, index)
+                    data_stats = controller.process(data_item, on_selected)
+
+                    if 'test_hdf_output' in data_item and data_item['test_hdf_output']:
+                        run['test_output'] = data_stats
+                        continue
+
+                    #  Collect and sum stats from output
+                    filter_stats = run['filter_stats']
+                    if filter_stats:
+                        run['filter_stats'] = {k: filter_stats.get(k, 0) + data_stats.get(k, 0)
+                                               for k in set(filter_stats) | set(data_stats)}
+                        run['days_processed'] += (data_item['date_range_end'] - data_item['date_range_start']).days + 1
+                        print("\nProcessed {0:,} of {1:,} days ({2:.3g}%)".format(
+                            run['days_processed'], run['num_total_days'],
+                            run['days_processed'] / run['num_total_days'] * 100))
+                    elapsed_seconds = (datetime.now() - time_batch_started).total_seconds()
+                    elapsed_minutes = int(elapsed_seconds // 60) % 60
+                    elapsed_hours = int(elapsed_seconds // 3600)
+                    batch_remainder_seconds = int(elapsed_seconds % 60)
+                    print('Batch completed in {}H {}m {}s'.format(elapsed_hours, elapsed_minutes,
+                                                                  batch_remainder_seconds))
+
+            if prefetcher is not None:
+                prefetcher.stop()
+            controller.close()
+
+            if any(run['test_output'] is None for run in runs):
+                for run in runs:
+                    if run['test_output'] is None:
+                        if len(runs) > 1:
+                            print('\nFinished processing file {}.\n'.format(run['input_file_name']))
+                        write_file_output(run)
+
+                total_elapsed_seconds = (datetime.now() - time_started).total_seconds()
+                total_elapsed_minutes = int(total_elapsed_seconds // 60) % 60
+                total_elapsed_hours = int(total_elapsed_seconds // 3600)
+                remainder_seconds = int(total_elapsed_seconds % 60)
+                print('Processing completed in {}H {}m {}s'.format(total_elapsed_hours, total_elapsed_minutes,
+                                                                   remainder_seconds))
+
+            return [run['test_output'] for run in runs]
 
         if 'batch_directory' in global_data:
             # This is a batch run!
             print('Running batch of files...')
-            return_values = []
             files = os.listdir(global_data['batch_directory'])
+            batch_items = []
             for file in files:
                 path = os.path.join(global_data['batch_directory'], file)
                 with open(path) as f:
-                    batch_data = json.load(f)
-                    print('\nRunning file {}...\n'.format(file))
-                    filename = os.path.basename(file)
-                    return_values.append(main_single_file_loop(batch_data, _username, _password, filename))
-                    print('\nFinished processing file {}.\n'.format(file))
+                    batch_items.append((parse_settings(json.load(f), _username, _password), os.path.basename(file)))
 
-            return return_values
+            return main_files_loop(batch_items)
 
         else:
             # Regular run!
-            return main_single_file_loop(global_data, _username, _password, sys.argv[1])
+            return main_files_loop([(parse_settings(global_data, _username, _password), sys.argv[1])])[0]
 
 
 if __name__ == '__main__':
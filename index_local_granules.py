@@ -0,0 +1,18 @@
+"""
+Adds the positions of AIRS2CCF granules that are already downloaded to the data/ position files, without any network
+access. Useful to complete or refine the positions of a range of dates one has on disk: rows from local files carry
+the real granule footprint, and replace the rows of the same granules in data/aqua_positions_<year>.csv.zip.
+
+    python index_local_granules.py <directory with .hdf files>
+"""
+import sys
+
+from classes.hdf_indexer import index_local_granules
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print(__doc__)
+        exit(1)
+
+    indexed = index_local_granules(sys.argv[1])
+    print('Finished, %s granules indexed.' % indexed)
@@ -0,0 +1,19 @@
+"""
+Moves the granules of a data directory (and their transcoded files) into another layout: "date" for
+<year>/<day of year>/ subdirectories, or "flat" for the directory itself. Runs with several threads, and is also done
+automatically the first time a run uses the directory with a different data_directory_layout.
+
+    python migrate_data_directory.py <data directory> [date|flat]
+"""
+import sys
+
+from classes.granule import DATE_LAYOUT, LAYOUTS
+from classes.migration import migrate_directory
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3) or (len(sys.argv) == 3 and sys.argv[2] not in LAYOUTS):
+        print(__doc__)
+        exit(1)
+
+    moved = migrate_directory(sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else DATE_LAYOUT)
+    print('Finished, %s files moved.' % moved)
@@ -0,0 +1,182 @@
+"""Fixtures and helpers shared by the test modules"""
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+from pyhdf.SD import SD, SDC
+
+from classes.granule import GranuleArray
+
+# permissive settings (as parsed by cli.py) that let a good share of the synthetic pixels through every filter
+SETTINGS = {
+    'min_latitude': -90, 'max_latitude': 90, 'min_longitude': -180, 'max_longitude': 180,
+    'include_prime_meridian': True,
+    'data_quality_best': True, 'data_quality_enough': True, 'data_quality_worst': False,
+    'dust_flag_no_dust': True, 'dust_flag_single_fov': True, 'dust_flag_detected': False,
+    'landfrac_threshold': 0.5, 'landfrac_threshold_is_max': True, 'noise_amp': False,
+    'TotCld_4_CCfinal_threshold': 0.5, 'TotCld_4_CCfinal_threshold_is_max': True,
+    'all_spots_avg_threshold': 0.8, 'all_spots_avg_threshold_is_max': True,
+    'solzen_threshold': 150, 'solzen_is_max': True,
+    'examine_wavenumber_mode': False, 'selected_wavenumber': 649.6,
+    'scanang_limit': 40, 'inside_scanang': True,
+    'delete_unreadable_granules': False,
+}
+
+
+def granule_name(granule):
+    return 'AIRS.2013.01.01.%03d.L2.CC_IR.v6.0.7.0.G13018001234.hdf' % granule
+
+
+SD_TYPES = {
+    np.dtype(np.float64): SDC.FLOAT64,
+    np.dtype(np.float32): SDC.FLOAT32,
+    np.dtype(np.int32): SDC.INT32,
+    np.dtype(np.int16): SDC.INT16,
+    np.dtype(np.uint8): SDC.UINT8,
+}
+
+
+def write_granule(path, datasets):
+    """Writes a synthetic HDF4 granule with the given {SDS name: ndarray}"""
+    data = SD(str(path), SDC.WRITE | SDC.CREATE)
+    for name, values in datasets.items():
+        sds = data.create(name, SD_TYPES[values.dtype], values.shape)
+        sds[:] = values
+        sds.endaccess()
+    data.end()
+
+
+def airs_granule(seed, lat_range=(-85, 85)):
+    """Returns the {SDS name: ndarray} of a synthetic AIRS2CCF granule with the datasets extract_granule_dataset uses"""
+    rng = np.random.default_rng(seed)
+    shape = (45, 30)
+    latitude, longitude = np.meshgrid(np.linspace(*lat_range, 45), np.linspace(-100, 100, 30), indexing='ij')
+    radiances = rng.uniform(0, 150, shape + (2378,)).astype(np.float32)
+    radiances[rng.random(radiances.shape) < 0.01] = np.nan
+
+    return {
+        'dust_flag': rng.integers(-1, 2, shape).astype(np.int16),
+        'landFrac': np.where(rng.random(shape) < 0.5, 0, rng.random(shape)).astype(np.float32),
+        'TotCld_4_CCfinal': rng.random(shape).astype(np.float32),
+        'all_spots_avg': rng.random(shape).astype(np.float32),
+        'CCfinal_Noise_Amp': np.where(rng.random(shape) < 0.5, 0.33335, 1.2).astype(np.float32),
+        'Latitude': latitude,
+        'Longitude': longitude,
+        'scanang': rng.uniform(-49, 49, shape).astype(np.float32),
+        'solzen': rng.uniform(0, 180, shape).astype(np.float32),
+        'Time': np.full(shape, 631152000.) + rng.uniform(0, 360, shape),
+        'radiances': radiances,
+        'radiances_QC': rng.integers(0, 3, shape + (2378,)).astype(np.int16),
+    }
+
+
+def write_airs_granules(directory, count):
+    """Writes count synthetic granules into directory and returns their GranuleArray"""
+    filenames = [granule_name(granule) for granule in range(1, count + 1)]
+    for seed, filename in enumerate(filenames):
+        write_granule(os.path.join(str(directory), filename), airs_granule(seed))
+    return GranuleArray.from_filenames(filenames, str(directory))
+
+
+def serve_airs_granules(tmp_path, serve, count):
+    """Serves count synthetic granules and returns their URLs"""
+    source = os.path.join(str(tmp_path), 'source')
+    os.makedirs(source)
+    write_airs_granules(source, count)
+    files = {}
+    for name in os.listdir(source):
+        with open(os.path.join(source, name), 'rb') as f:
+            files[name] = f.read()
+    base_url = serve(files)
+    return [base_url + granule_name(granule) for granule in range(1, count + 1)]
+
+
+def touch(directory, name, size=10):
+    filename = os.path.join(str(directory), name)
+    with open(filename, 'wb') as f:
+        f.write(b'x' * size)
+    return filename
+
+
+@pytest.fixture
+def granule_server():
+    """
+    Serves {filename: bytes} over HTTP/1.1 with keep-alive. Like GESDISC, requests without the session cookie are
+    redirected to a login page that sets it, and Range requests are answered with partial content unless ranges is
+    False. The connection of the first request of each file in drop_after is closed after that many bytes, and the first
+    unavailable[name] requests of a file are answered with 503. Records the requested paths, the Range headers and the
+    client connections used.
+    """
+    requested = []
+    ranges_requested = []
+    connections = set()
+
+    def serve(files, drop_after=None, ranges=True, unavailable=None):
+        drop_after = dict(drop_after or {})
+        unavailable = dict(unavailable or {})
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                requested.append(self.path)
+                connections.add(self.client_address)
+                if self.path.startswith('/login'):
+                    self.send_response(302)
+                    self.send_header('Set-Cookie', 'session=1; Path=/')
+                    self.send_header('Location', self.path[len('/login'):])
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if 'session=1' not in self.headers.get('Cookie', ''):
+                    self.send_response(302)
+                    self.send_header('Location', '/login' + self.path)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                name = self.path.split('/')[-1]
+                if name not in files:
+                    self.send_error(404)
+                    return
+                if unavailable.get(name):
+                    unavailable[name] -= 1
+                    self.send_error(503)
+                    return
+                body = files[name]
+                byte_range = self.headers.get('Range')
+                ranges_requested.append(byte_range)
+                if byte_range and ranges:
+                    first = int(byte_range[len('bytes='):].rstrip('-'))
+                    if first >= len(body):
+                        self.send_response(416)
+                        self.send_header('Content-Range', 'bytes */%s' % len(body))
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes %s-%s/%s' % (first, len(body) - 1, len(body)))
+                    body = body[first:]
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if name in drop_after:
+                    self.wfile.write(body[:drop_after.pop(name)])
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return 'http://127.0.0.1:%s/data/' % server.server_address[1]
+
+    servers = []
+    yield serve, requested, connections, ranges_requested
+    for server in servers:
+        server.shutdown()
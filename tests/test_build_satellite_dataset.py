@@ -0,0 +1,132 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+from build_satellite_dataset import update_positions_incrementally
+from classes._http import SessionWithHeaderRedirection
+from classes.position_index import PositionIndex
+from tests.test_position_index import write_positions_zip
+
+XML_TEMPLATE = '''<GranuleMetaDataFile>
+<BoundingRectangle>
+<WestBoundingCoordinate>{west}</WestBoundingCoordinate>
+<NorthBoundingCoordinate>{north}</NorthBoundingCoordinate>
+<EastBoundingCoordinate>{east}</EastBoundingCoordinate>
+<SouthBoundingCoordinate>{south}</SouthBoundingCoordinate>
+</BoundingRectangle>
+<PSAName>LatGranuleCen</PSAName>
+  <PSAValue>{lat}</PSAValue>
+<PSAName>LonGranuleCen</PSAName>
+  <PSAValue>{lon}</PSAValue>
+</GranuleMetaDataFile>'''
+
+
+def hdf_filename(day, granule):
+    return 'AIRS.2013.01.%02d.%03d.L2.CC_IR.v6.0.7.0.G13018001234.hdf' % (day, granule)
+
+
+def build_site(days):
+    """Returns path -> page content for a fake GESDISC year listing with the given {day: [granules]}"""
+    site = {'/2013/': ''.join('<a href="%03d/">%03d/</a>\n' % (day, day) for day in days)}
+    for day, granules in days.items():
+        site['/2013/%03d' % day] = ''.join('<a href="%s.xml">\n' % hdf_filename(day, g) for g in granules)
+        for granule in granules:
+            site['/2013/%03d/%s.xml' % (day, hdf_filename(day, granule))] = XML_TEMPLATE.format(
+                west=-20, north=15, east=5, south=-5, lat=granule, lon=-10)
+    return site
+
+
+@pytest.fixture
+def gesdisc_server():
+    requested = []
+
+    def serve(site):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.replace('//', '/')
+                requested.append(path)
+                if path not in site:
+                    self.send_error(404)
+                    return
+                body = site[path].encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return 'http://127.0.0.1:%s/' % server.server_address[1]
+
+    servers = []
+    yield serve, requested
+    for server in servers:
+        server.shutdown()
+
+
+def test_incremental_update_only_fetches_missing_granules(tmp_path, gesdisc_server):
+    serve, requested = gesdisc_server
+    base_url = serve(build_site({1: range(1, 241), 2: [1, 2, 3], 3: [7]}))
+
+    # day 1 is complete and day 2 is partially indexed, day 3 is new
+    indexed = [(1, g) for g in range(1, 241)] + [(2, 1), (2, 2)]
+    write_positions_zip(tmp_path, pd.DataFrame({
+        'year': 2013, 'day': [d for d, _ in indexed], 'granule': [g for _, g in indexed], 'lat': 0, 'lon': 0,
+        'hdf_filename': [hdf_filename(d, g) for d, g in indexed], 'GCA': 90.0,
+    }))
+    position_index = PositionIndex(str(tmp_path))
+
+    with SessionWithHeaderRedirection('user', 'password') as http_client:
+        added = update_positions_incrementally(http_client, base_url, 2013, position_index, threads=2)
+
+    xml_requests = sorted(path for path in requested if path.endswith('.xml'))
+    assert added == 2
+    assert xml_requests == ['/2013/002/%s.xml' % hdf_filename(2, 3), '/2013/003/%s.xml' % hdf_filename(3, 7)]
+    assert '/2013/001' not in requested
+
+    table = position_index.get_table(2013, 2013)
+    assert len(table) == 244
+    new_rows = table[table.key.isin([2013002003, 2013003007])]
+    assert list(new_rows.lon_west) == [-20, -20]
+    assert list(new_rows.lat_max) == [15, 15]
+
+
+def test_incremental_update_without_changes_fetches_no_xml(tmp_path, gesdisc_server):
+    serve, requested = gesdisc_server
+    base_url = serve(build_site({2: [1, 2]}))
+    write_positions_zip(tmp_path, pd.DataFrame({
+        'year': 2013, 'day': 2, 'granule': [1, 2], 'lat': 0, 'lon': 0,
+        'hdf_filename': [hdf_filename(2, 1), hdf_filename(2, 2)], 'GCA': 90.0,
+    }))
+
+    with SessionWithHeaderRedirection('user', 'password') as http_client:
+        added = update_positions_incrementally(http_client, base_url, 2013, PositionIndex(str(tmp_path)))
+
+    assert added == 0
+    assert not [path for path in requested if path.endswith('.xml')]
+
+
+def test_reprocessed_granules_replace_their_old_row(tmp_path, gesdisc_server):
+    serve, requested = gesdisc_server
+    base_url = serve(build_site({2: [1, 2]}))
+    # granule 1 was indexed under an earlier production time
+    old_filename = hdf_filename(2, 1).replace('G13018001234', 'G13003000000')
+    write_positions_zip(tmp_path, pd.DataFrame({
+        'year': 2013, 'day': 2, 'granule': [1, 2], 'lat': 0, 'lon': 0,
+        'hdf_filename': [old_filename, hdf_filename(2, 2)], 'GCA': 90.0,
+    }))
+    position_index = PositionIndex(str(tmp_path))
+
+    with SessionWithHeaderRedirection('user', 'password') as http_client:
+        assert update_positions_incrementally(http_client, base_url, 2013, position_index) == 1
+
+    table = position_index.get_table(2013, 2013)
+    assert sorted(table.key) == [2013002001, 2013002002]
+    assert sorted(position_index.hdf_filenames(table.year, table.filename_id)) == [hdf_filename(2, 1),
+                                                                                    hdf_filename(2, 2)]
@@ -0,0 +1,50 @@
+import os
+
+from classes.cache import GranuleCache
+from classes.hdf import HDFStorage
+from tests.conftest import granule_name, touch
+
+
+def test_least_recently_used_granules_are_evicted(tmp_path):
+    source = os.path.join(str(tmp_path), 'source')
+    os.makedirs(source)
+    cache = GranuleCache(os.path.join(str(tmp_path), 'cache'), quota=250)
+
+    for granule in (1, 2):
+        cache.store(touch(source, granule_name(granule), 100))
+    # granule 1 was used more recently than granule 2
+    assert cache.fetch(granule_name(1), os.path.join(str(tmp_path), granule_name(1))) == (100, None)
+    cache.store(touch(source, granule_name(3), 100))
+
+    assert cache.stored(granule_name(granule) for granule in (1, 2, 3)) == {granule_name(1), granule_name(3)}
+    assert not os.path.exists(os.path.join(cache.directory, granule_name(2)))
+    assert cache.fetch(granule_name(2), os.path.join(str(tmp_path), granule_name(2))) is None
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 1)
+    assert cache.size == 200
+
+
+def test_storages_share_granules_through_the_cache(tmp_path, granule_server):
+    serve, requested, connections, _ranges = granule_server
+    files = {granule_name(g): os.urandom(100) for g in range(1, 5)}
+    base_url = serve(files)
+    urls = [base_url + name for name in files]
+    cache = GranuleCache(os.path.join(str(tmp_path), 'cache'))
+    for directory in ('first', 'second'):
+        os.makedirs(os.path.join(str(tmp_path), directory))
+    first = HDFStorage(os.path.join(str(tmp_path), 'first'), 'user', 'password', cache=cache)
+    second = HDFStorage(os.path.join(str(tmp_path), 'second'), 'user', 'password', cache=cache)
+
+    assert first.download_files(urls[:3])
+    del requested[:]
+    assert second.download_files(urls)
+
+    # only the granule the first storage did not download is requested again
+    assert set(path.split('/')[-1] for path in requested) == {granule_name(4)}
+    for name, body in files.items():
+        filename = os.path.join(str(tmp_path), 'second', name)
+        with open(filename, 'rb') as f:
+            assert f.read() == body
+        assert second.catalog.get(name)['md5'] is not None
+    assert os.path.samefile(os.path.join(str(tmp_path), 'first', granule_name(1)),
+                            os.path.join(str(tmp_path), 'second', granule_name(1)))
+    assert (cache.hits, cache.misses) == (3, 4)
@@ -0,0 +1,64 @@
+import json
+import os
+
+from classes.catalog import GranuleCatalog
+from classes.hdf import HDFStorage
+from tests.conftest import granule_name, touch
+
+
+def test_catalog_is_created_from_directory(tmp_path):
+    verified = touch(tmp_path, granule_name(1))
+    touch(tmp_path, granule_name(2))
+    touch(tmp_path, granule_name(3) + '.part')
+    with open(os.path.join(str(tmp_path), 'granule_manifest.json'), 'w') as f:
+        json.dump({granule_name(1): {'size': 10, 'md5': 'abc', 'verified_mtime': os.stat(verified).st_mtime_ns}}, f)
+
+    catalog = GranuleCatalog(str(tmp_path))
+
+    assert catalog.names() == {granule_name(1), granule_name(2)}
+    assert catalog.get(granule_name(1)) == {'size': 10, 'md5': 'abc', 'verified_mtime': os.stat(verified).st_mtime_ns}
+    assert catalog.get(granule_name(2))['verified_mtime'] is None
+
+    # the directory is only scanned when the catalog is created
+    touch(tmp_path, granule_name(4))
+    catalog.close()
+    assert granule_name(4) not in GranuleCatalog(str(tmp_path))
+
+
+def test_stored_lookups(tmp_path):
+    catalog = GranuleCatalog(str(tmp_path))
+    for granule in range(1, 1200, 2):
+        catalog.add(granule_name(granule), 10, 0)
+
+    assert catalog.stored(granule_name(granule) for granule in range(1, 1201)) == \
+        set(granule_name(granule) for granule in range(1, 1200, 2))
+
+
+def test_storage_presence_checks_do_not_list_the_directory(tmp_path, monkeypatch):
+    storage = HDFStorage(str(tmp_path), 'user', 'password')
+    storage.catalog.add(granule_name(1), 10, 0)
+    urls = ['https://example.com/' + granule_name(granule) for granule in (1, 2)]
+
+    def listdir(_path):
+        raise AssertionError('the directory was listed')
+
+    monkeypatch.setattr(os, 'listdir', listdir)
+    monkeypatch.setattr(os, 'scandir', listdir)
+
+    assert list(storage.filter_files(urls)) == urls[1:]
+
+    # the file of granule 1 is not on disk, so verification drops it
+    storage.verify_files(urls)
+    assert list(storage.filter_files(urls)) == urls
+
+
+def test_granules_are_quarantined_after_repeated_failures(tmp_path):
+    catalog = GranuleCatalog(str(tmp_path))
+
+    assert not catalog.record_failure(granule_name(1), 'unreadable')
+    assert catalog.quarantined([granule_name(1)]) == {}
+    assert catalog.record_failure(granule_name(1), 'missing dataset radiances')
+    assert catalog.quarantined([granule_name(1), granule_name(2)]) == {granule_name(1): ('missing dataset radiances', 2)}
+
+    catalog.clear_quarantine()
+    assert catalog.quarantined([granule_name(1)]) == {}
@@ -0,0 +1,162 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from classes.download import (CHUNK_SIZE, MAX_CONNECTIONS, AsyncDownloader, RetryPolicy, create_session,
+                              perform_download)
+from classes.hdf import HDFStorage
+from tests.conftest import granule_name, write_granule
+
+
+def test_session_is_reused_across_downloads(tmp_path, granule_server):
+    serve, requested, connections, _ranges = granule_server
+    files = {granule_name(g): os.urandom(1000 * g) for g in range(1, 4)}
+    base_url = serve(files)
+
+    with create_session('user', 'password') as session:
+        results = [perform_download(base_url + name, str(tmp_path), session=session) for name in files]
+
+    # only the first download goes through the login redirect, and all of them use the same connection
+    assert [result.redirects for result in results] == [2, 0, 0]
+    assert sum(path.startswith('/login') for path in requested) == 1
+    assert len(connections) == 1
+
+    for result, (name, body) in zip(results, files.items()):
+        assert result.succeeded and result.size == len(body)
+        assert result.handshake_seconds > 0 and result.transfer_seconds >= 0
+        with open(os.path.join(str(tmp_path), name), 'rb') as f:
+            assert f.read() == body
+
+
+def test_storage_downloads_missing_files(tmp_path, granule_server):
+    serve, requested, connections, _ranges = granule_server
+    files = {granule_name(g): os.urandom(100) for g in range(1, 13)}
+    base_url = serve(files)
+    write_granule(os.path.join(str(tmp_path), granule_name(1)), {'Latitude': np.zeros((45, 30))})
+
+    storage = HDFStorage(str(tmp_path), 'user', 'password', max_connections=4)
+
+    assert storage.download_files([base_url + name for name in files])
+
+    assert sorted(name for name in os.listdir(str(tmp_path)) if name.endswith('.hdf')) == sorted(files)
+    assert granule_name(1) not in ' '.join(requested)
+    assert len(storage.results) == 11
+    # each connection logs in once at most
+    assert sum(path.startswith('/login') for path in requested) <= 4
+
+
+def test_failed_downloads_are_reported(tmp_path, granule_server):
+    serve, requested, connections, _ranges = granule_server
+    base_url = serve({granule_name(1): b'granule'})
+    storage = HDFStorage(str(tmp_path), 'user', 'password')
+    urls = [base_url + granule_name(1), base_url + granule_name(2)]
+
+    assert not storage.download_files(urls)
+
+    assert storage.results[urls[0]].status == 'downloaded'
+    # missing granules are not retried
+    assert storage.results[urls[1]].status == 'missing'
+    assert storage.results[urls[1]].http_status == 404
+    assert storage.results[urls[1]].attempts == 1
+
+
+def test_failed_urls_are_retried_with_backoff(tmp_path, granule_server):
+    serve, requested, connections, _ranges = granule_server
+    files = {granule_name(g): os.urandom(100) for g in range(1, 4)}
+    base_url = serve(files, unavailable={granule_name(1): 2, granule_name(2): 10})
+    urls = [base_url + name for name in files]
+    completed = []
+
+    downloader = AsyncDownloader('user', 'password', retry_policy=RetryPolicy(4, base_delay=0.01))
+    results = downloader.download(urls, str(tmp_path), completed.append)
+
+    assert [result.status for result in results] == ['downloaded', 'failed', 'downloaded']
+    assert [result.attempts for result in results] == [3, 4, 1]
+    assert results[0].error_types == ['HTTP 503'] * 2
+    assert results[1].error_types == ['HTTP 503'] * 4
+    # on_complete only sees the final outcome of each URL
+    assert len(completed) == 3
+    assert sorted(os.listdir(str(tmp_path))) == sorted([granule_name(1), granule_name(3)])
+
+
+def test_retry_delays_grow_exponentially_with_jitter():
+    policy = RetryPolicy(base_delay=1, max_delay=10)
+
+    for attempt, delay in [(1, 1), (2, 2), (3, 4), (4, 8), (5, 10), (9, 10)]:
+        delays = [policy.delay(attempt) for _ in range(100)]
+        assert all(0.5 * delay <= d <= 1.5 * delay for d in delays)
+        assert len(set(delays)) > 1
+
+
+def test_downloader_caps_connections(tmp_path, granule_server):
+    serve, requested, connections, _ranges = granule_server
+    files = {granule_name(g): os.urandom(10) for g in range(1, 41)}
+    base_url = serve(files)
+    completed = []
+
+    downloader = AsyncDownloader('user', 'password', max_connections=50)
+    results = downloader.download([base_url + name for name in files], str(tmp_path), completed.append)
+
+    assert downloader.max_connections == MAX_CONNECTIONS
+    assert [result.filename for result in results] == list(files)
+    assert sorted(result.filename for result in completed) == sorted(files)
+    assert len(connections) <= MAX_CONNECTIONS
+
+
+@pytest.mark.parametrize('ranges', [True, False])
+def test_interrupted_download_is_resumed(tmp_path, granule_server, ranges):
+    serve, requested, connections, ranges_requested = granule_server
+    body = os.urandom(3 * CHUNK_SIZE)
+    url = serve({granule_name(1): body}, drop_after={granule_name(1): 2 * CHUNK_SIZE + 10}, ranges=ranges) + \
+        granule_name(1)
+    filename = os.path.join(str(tmp_path), granule_name(1))
+
+    with create_session('user', 'password') as session:
+        with pytest.raises(Exception):
+            perform_download(url, str(tmp_path), session=session)
+
+        # the truncated transfer is never visible under the granule name
+        assert not os.path.exists(filename)
+        assert os.path.getsize(filename + '.part') == 2 * CHUNK_SIZE
+
+        result = perform_download(url, str(tmp_path), session=session)
+
+    assert ranges_requested == [None, 'bytes=%s-' % (2 * CHUNK_SIZE)]
+    assert (result.resumed_from, result.size) == ((2 * CHUNK_SIZE, CHUNK_SIZE) if ranges else (0, 3 * CHUNK_SIZE))
+    assert os.listdir(str(tmp_path)) == [granule_name(1)]
+    with open(filename, 'rb') as f:
+        assert f.read() == body
+
+
+def test_complete_part_file_is_renamed(tmp_path, granule_server):
+    serve, requested, connections, ranges_requested = granule_server
+    url = serve({granule_name(1): b'granule'}) + granule_name(1)
+    with open(os.path.join(str(tmp_path), granule_name(1) + '.part'), 'wb') as f:
+        f.write(b'granule')
+
+    perform_download(url, str(tmp_path), 'user', 'password')
+
+    assert os.listdir(str(tmp_path)) == [granule_name(1)]
+
+
+def test_blocked_callbacks_do_not_stop_the_event_loop(tmp_path, granule_server):
+    serve, requested, connections, _ranges = granule_server
+    files = {granule_name(g): os.urandom(100) for g in range(1, 3)}
+    base_url = serve(files, unavailable={granule_name(2): 2})
+    second_completed = threading.Event()
+
+    def on_complete(result):
+        # the first granule's callback waits for the second one, which needs a retry timer of the event loop
+        if result.filename == granule_name(1):
+            assert second_completed.wait(timeout=10)
+        else:
+            second_completed.set()
+
+    downloader = AsyncDownloader('user', 'password', max_connections=2, retry_policy=RetryPolicy(3, base_delay=0.1))
+    results = downloader.download([base_url + name for name in files], str(tmp_path), on_complete)
+    downloader.close()
+
+    assert [result.status for result in results] == ['downloaded', 'downloaded']
+    assert results[1].attempts == 3
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from classes.granule import Granule, GranuleArray
+
+
+add_test_cases = [
+    # (year, day, granule number), granule count, expected (year, day, granule number)
+    [(2013, 1, 1), 0, (2013, 1, 1)],
+    [(2013, 1, 239), 1, (2013, 1, 240)],
+    [(2013, 1, 240), 1, (2013, 2, 1)],
+    [(2013, 365, 235), 10, (2014, 1, 5)],
+    [(2012, 365, 240), 1, (2012, 366, 1)],
+    [(2013, 10, 5), 240 * 30, (2013, 40, 5)],
+]
+
+
+@pytest.mark.parametrize('test_case', add_test_cases)
+def test_add(test_case):
+    expected = Granule(*test_case[2])
+
+    assert Granule(*test_case[0]) + test_case[1] == expected
+    assert list(GranuleArray([int(Granule(*test_case[0]))]) + test_case[1]) == [expected]
+
+
+def test_vectorized_add_matches_datetime_arithmetic():
+    granules = GranuleArray.from_components(
+        np.full(400, 2015), np.arange(1, 401) % 365 + 1, np.arange(400) % 240 + 1
+    )
+    counts = np.arange(400) * 37
+
+    for granule, count, result in zip(granules, counts, granules + counts):
+        days, granule_index = divmod(granule.granule_number - 1 + int(count), 240)
+        date = datetime(granule.year, 1, 1) + timedelta(days=granule.day - 1 + days)
+        assert result == Granule(date.year, date.timetuple().tm_yday, granule_index + 1)
+
+
+def test_from_filenames():
+    granules = GranuleArray.from_filenames([
+        'https://airsl2.gesdisc.eosdis.nasa.gov/data/Aqua_AIRS_Level2/AIRS2CCF.006//2013/365/'
+        'AIRS.2013.12.31.004.L2.CC_IR.v6.0.11.0.G14092095944.hdf',
+        'AIRS.2012.03.01.240.L2.CC_IR.v6.0.7.0.G13201091521.hdf',
+    ], 'data')
+
+    assert list(granules) == [Granule(2013, 365, 4), Granule(2012, 61, 240)]
+    assert granules[1].local_file_name.endswith('AIRS.2012.03.01.240.L2.CC_IR.v6.0.7.0.G13201091521.hdf')
+
+
+def test_month_period():
+    granules = GranuleArray.from_components([2012, 2012, 2013, 2013], [60, 61, 59, 60], [1, 1, 1, 1])
+
+    assert list(granules.month_period) == ['February 2012', 'March 2012', 'February 2013', 'March 2013']
+    assert [granule.month_period for granule in granules] == list(granules.month_period)
+
+
+def test_comparisons():
+    granules = GranuleArray.from_components([2013, 2013, 2013], [1, 2, 3], [1, 1, 1])
+
+    assert list(granules > Granule(2013, 2, 1)) == [False, False, True]
+    assert list(granules == Granule(2013, 2, 1)) == [False, True, False]
+    assert list(granules <= granules) == [True, True, True]
@@ -1,4 +1,6 @@
+import json
 import os
+import shutil
 
 import pytest
 from cli import main
@@ -55,3 +57,21 @@ def test_granule_selection(test_run):
     assert(num_correct == num_expected)
     assert(num_extra == 0)
     assert(num_missed == 0)
+
+
+def test_batch_directory_selects_the_granules_of_each_file(tmp_path):
+    batch_directory = tmp_path / 'batch'
+    batch_directory.mkdir()
+    for test_run in test_data[:2]:
+        shutil.copy(test_run['json'], str(batch_directory))
+    settings_file = tmp_path / 'batch.json'
+    settings_file.write_text(json.dumps({'batch_directory': str(batch_directory)}))
+    sys.argv = ['', str(settings_file)]
+
+    selected_by_file = main()
+
+    files = os.listdir(str(batch_directory))
+    assert len(selected_by_file) == len(files) == 2
+    for file, selected_granules in zip(files, selected_by_file):
+        expected_granules = pd.read_csv(os.path.join('tests', 'granule_selection_test_data', file.split('.')[0] + '.csv'))
+        assert set(selected_granules['hdf_filename']) == set(expected_granules['hdf_filename'])
@@ -0,0 +1,18 @@
+import pandas as pd
+
+from classes.hdf import HDFDataAggregator
+from classes.interface.main_controller import MainController
+from tests.conftest import SETTINGS, write_airs_granules
+
+
+def test_process_stream_matches_process(tmp_path):
+    granules = write_airs_granules(tmp_path, 3)
+    hdf_filter = MainController.build_hdf_filter(SETTINGS)
+
+    curves_data, filter_stats, count_data, _ = HDFDataAggregator().process(granules, hdf_filter)
+    streamed = HDFDataAggregator().process_stream(reversed(list(granules)), hdf_filter)
+
+    assert filter_stats['total'] > filter_stats['total_filtered'] > 0
+    pd.testing.assert_frame_equal(streamed[0], curves_data)
+    assert streamed[1] == filter_stats
+    pd.testing.assert_frame_equal(streamed[2], count_data)
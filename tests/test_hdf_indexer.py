@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+import pytest
+
+from classes.hdf_indexer import calculate_longitude_bounds, index_local_granules, read_granule_position
+from classes.position_index import PositionIndex
+from tests.conftest import write_granule
+from tests.test_position_index import POSITIONS, write_positions_zip
+
+
+def geolocation(lat_range, lon_range):
+    latitude, longitude = np.meshgrid(np.linspace(*lat_range, 45), np.linspace(*lon_range, 30), indexing='ij')
+    return {
+        'Latitude': latitude,
+        'Longitude': (longitude + 180) % 360 - 180,
+        'Time': np.full((45, 30), 662688000.),
+    }
+
+
+longitude_bounds_test_cases = [
+    # longitudes, (west, east)
+    [[-20, -10, 5], (-20, 5)],
+    [[170, 175, -178, -170], (170, -170)],
+    [list(range(-180, 180, 20)), (-180, 180)],
+]
+
+
+@pytest.mark.parametrize('test_case', longitude_bounds_test_cases)
+def test_calculate_longitude_bounds(test_case):
+    assert calculate_longitude_bounds(np.array(test_case[0], dtype=float)) == test_case[1]
+
+
+def test_read_granule_position(tmp_path):
+    path = os.path.join(str(tmp_path), 'AIRS.2013.01.02.010.L2.CC_IR.v6.0.11.0.G14092095944.hdf')
+    write_granule(path, geolocation((-10, 10), (170, 200)))
+
+    year, day, granule, lat, lon, west, north, east, south, filename = read_granule_position(path)
+
+    assert (year, day, granule) == (2013, 2, 10)
+    assert (west, east) == (170, -160)
+    assert (south, north) == (-10, 10)
+    assert filename == os.path.basename(path)
+
+
+def test_read_unreadable_granule(tmp_path):
+    path = os.path.join(str(tmp_path), 'AIRS.2013.01.02.010.L2.CC_IR.v6.0.11.0.G14092095944.hdf')
+    with open(path, 'wb') as f:
+        f.write(b'not an HDF file')
+
+    assert read_granule_position(path) is None
+
+
+def test_index_local_granules(tmp_path):
+    write_positions_zip(tmp_path, POSITIONS)
+    granule_directory = os.path.join(str(tmp_path), 'granules', '2013')
+    os.makedirs(granule_directory)
+    # replaces an existing row, the row of a granule stored under a newer production time, and adds a new one
+    write_granule(os.path.join(granule_directory, POSITIONS.hdf_filename[0]), geolocation((70, 89), (-180, 180)))
+    reprocessed = POSITIONS.hdf_filename[1].replace('G14092100039', 'G15001000000')
+    write_granule(os.path.join(granule_directory, reprocessed), geolocation((-10, 10), (-60, -30)))
+    write_granule(os.path.join(granule_directory, 'AIRS.2013.01.03.001.L2.CC_IR.v6.0.11.0.G14092095944.hdf'),
+                  geolocation((0, 20), (10, 40)))
+    position_index = PositionIndex(str(tmp_path))
+
+    assert index_local_granules(os.path.join(str(tmp_path), 'granules'), position_index, processes=2) == 3
+
+    table = position_index.get_table(2013, 2013).set_index('key')
+    assert len(table) == 4
+    assert tuple(table.loc[2013002010, ['lat_min', 'lat_max', 'lon_west', 'lon_east']]) == (70, 90, -180, 180)
+    assert tuple(table.loc[2013003001, ['lat_min', 'lat_max', 'lon_west', 'lon_east']]) == (0, 20, 10, 40)
+    assert tuple(table.loc[2013001200, ['lat_min', 'lat_max', 'lon_west', 'lon_east']]) == (-10, 10, -60, -30)
+    assert reprocessed in position_index.hdf_filenames(table.year, table.filename_id)
@@ -0,0 +1,203 @@
+import os
+from datetime import date, time
+
+import pandas as pd
+import pytest
+
+from classes.constants import CHANNELS_TO_WAVELENGTHS
+from classes.hdf import HDFStorage, calculate_averages_and_filter, extract_granule_dataset
+from classes.interface import main_controller
+from classes.interface.main_controller import MainController
+from classes.interface.rolling_window import PartialResults, RollingWindow, merge_results
+from tests.conftest import SETTINGS, granule_name, serve_airs_granules, write_airs_granules
+
+
+def assert_same_results(result, expected):
+    pd.testing.assert_frame_equal(result[0], expected[0])
+    assert result[1] == expected[1]
+    pd.testing.assert_frame_equal(result[2], expected[2])
+
+
+def test_pipelined_download_matches_sequential(tmp_path, granule_server, monkeypatch):
+    serve, requested, connections, ranges_requested = granule_server
+    urls = serve_airs_granules(tmp_path, serve, 4)
+    source = os.path.join(str(tmp_path), 'source')
+
+    controller = MainController()
+    hdf_filter = controller.build_hdf_filter(SETTINGS)
+    sequential = dict(SETTINGS, data_directory=os.path.join(str(tmp_path), 'sequential'), username='user',
+                      password='password')
+    pipelined = dict(sequential, data_directory=os.path.join(str(tmp_path), 'pipelined'))
+    # one of the granules is already stored
+    os.makedirs(pipelined['data_directory'])
+    os.link(os.path.join(source, granule_name(3)), os.path.join(pipelined['data_directory'], granule_name(3)))
+
+    controller.download_files(sequential, urls)
+    expected = controller.aggregate_hdf_data(controller.build_granules_for_aggregation(sequential, urls), hdf_filter)
+    del requested[:]
+    verified = []
+    verify_files = HDFStorage.verify_files
+    monkeypatch.setattr(HDFStorage, 'verify_files', lambda storage, urls: verified.append(list(urls)) or
+                        verify_files(storage, urls))
+
+    result = controller.download_and_aggregate(pipelined, urls, hdf_filter)
+
+    assert granule_name(3) not in ' '.join(requested)
+    # the stored files are verified once
+    assert verified == [urls]
+    assert_same_results(result, expected)
+
+
+def test_rolling_window_bounds_stored_granules(tmp_path, granule_server, monkeypatch):
+    serve, requested, connections, ranges_requested = granule_server
+    urls = serve_airs_granules(tmp_path, serve, 4)
+    granule_size = os.path.getsize(os.path.join(str(tmp_path), 'source', granule_name(1)))
+    monkeypatch.setattr(main_controller, 'ROLLING_WINDOW_CHUNK_SIZE', 1)
+    peak = []
+    add = RollingWindow.add
+
+    def record_peak(window, filename, size):
+        add(window, filename, size)
+        peak.append(window.size)
+
+    monkeypatch.setattr(RollingWindow, 'add', record_peak)
+
+    controller = MainController()
+    hdf_filter = controller.build_hdf_filter(SETTINGS)
+    sequential = dict(SETTINGS, data_directory=os.path.join(str(tmp_path), 'sequential'), username='user',
+                      password='password')
+    windowed = dict(sequential, data_directory=os.path.join(str(tmp_path), 'windowed'))
+    controller.download_files(sequential, urls)
+    expected = controller.aggregate_hdf_data(controller.build_granules_for_aggregation(sequential, urls), hdf_filter)
+
+    result = controller.download_and_aggregate(windowed, urls, hdf_filter, 1.5 * granule_size)
+
+    assert_same_results(result, expected)
+    assert len(peak) == 4 and max(peak) <= 2 * granule_size
+    storage = controller.get_storage(windowed)
+    assert not [name for name in os.listdir(windowed['data_directory']) if name.endswith('.hdf')]
+    assert len(storage.catalog) == 0
+    names = [url.split('/')[-1] for url in urls]
+    partial_results = PartialResults(windowed['data_directory'], hdf_filter, names)
+    # one running total for the period of the granules
+    assert os.listdir(partial_results.directory) == ['January_2013.pickle']
+    assert sorted(PartialResults(windowed['data_directory'], hdf_filter, names).load()[0]) == names
+
+    # a run that is interrupted before the output is written resumes from the checkpointed results
+    del requested[:]
+    assert_same_results(controller.download_and_aggregate(windowed, urls, hdf_filter, 1.5 * granule_size), expected)
+    assert requested == []
+
+    partial_results.remove()
+    assert PartialResults(windowed['data_directory'], hdf_filter, names).load() == (set(), [])
+    assert not os.path.exists(os.path.dirname(partial_results.directory))
+
+
+def test_rolling_window_keeps_granules_stored_before(tmp_path, granule_server):
+    serve, requested, connections, ranges_requested = granule_server
+    urls = serve_airs_granules(tmp_path, serve, 3)
+    granule_size = os.path.getsize(os.path.join(str(tmp_path), 'source', granule_name(1)))
+    controller = MainController()
+    hdf_filter = controller.build_hdf_filter(SETTINGS)
+    data = dict(SETTINGS, data_directory=os.path.join(str(tmp_path), 'data'), username='user', password='password')
+    # a run without the rolling window stored the first granule
+    controller.download_files(data, urls[:1])
+
+    controller.download_and_aggregate(data, urls, hdf_filter, 1.5 * granule_size)
+
+    assert [name for name in os.listdir(data['data_directory']) if name.endswith('.hdf')] == [granule_name(1)]
+    assert controller.get_storage(data).catalog.names() == {granule_name(1)}
+    controller.close()
+
+
+def test_batch_selection_matches_the_selection_of_each_file():
+    controller = MainController()
+    data = dict(SETTINGS, date_range_start=date(2013, 10, 27), date_range_end=date(2013, 10, 28),
+                time_range_start=time(1, 0), time_range_end=time(3, 0), gca_threshold=0, gca_is_max=False)
+    # files of a batch directory that only differ in their longitude slice
+    data_items = [dict(data, min_longitude=-100, max_longitude=-20), dict(data, min_longitude=-50, max_longitude=60)]
+
+    urls_by_item, all_urls = controller.get_urls_for_batch(data_items)
+
+    expected = [controller.get_urls_for_granules(item, *controller.get_granules(item)) for item in data_items]
+    assert urls_by_item == expected
+    assert all(expected) and set(expected[0]) != set(expected[1])
+    assert all_urls == sorted(set(expected[0]) | set(expected[1]))
+
+    with pytest.raises(ValueError):
+        controller.get_urls_for_batch([data, dict(data, date_range_end=date(2013, 10, 29))])
+
+
+def test_granules_that_fail_twice_are_quarantined(tmp_path, granule_server):
+    serve, requested, connections, ranges_requested = granule_server
+    source = os.path.join(str(tmp_path), 'source')
+    os.makedirs(source)
+    write_airs_granules(source, 2)
+    files = {granule_name(3): b'not an HDF file'}
+    for name in os.listdir(source):
+        with open(os.path.join(source, name), 'rb') as f:
+            files[name] = f.read()
+    base_url = serve(files)
+    urls = [base_url + granule_name(granule) for granule in range(1, 4)]
+
+    controller = MainController()
+    data = dict(SETTINGS, delete_unreadable_granules=True, data_directory=os.path.join(str(tmp_path), 'data'),
+                username='user', password='password')
+    hdf_filter = controller.build_hdf_filter(data)
+    storage = controller.get_storage(data)
+
+    # the broken granule is deleted and downloaded again after the first failure, and quarantined after the second
+    for run in range(3):
+        del requested[:]
+        result = controller.download_and_aggregate(data, urls, hdf_filter)
+        assert (granule_name(3) in ' '.join(requested)) == (run < 2)
+
+    quarantined = storage.catalog.quarantined([granule_name(granule) for granule in range(1, 4)])
+    assert list(quarantined) == [granule_name(3)]
+    reason, count = quarantined[granule_name(3)]
+    assert reason.startswith('unreadable') and count == 2
+    assert storage.skipped_quarantined == quarantined
+    expected = controller.aggregate_hdf_data(controller.build_granules_for_aggregation(data, urls[:2]), hdf_filter)
+    assert_same_results(result, expected)
+
+
+def test_granules_that_failed_to_download_are_not_quarantined(tmp_path, granule_server):
+    serve, requested, connections, ranges_requested = granule_server
+    urls = serve_airs_granules(tmp_path, serve, 3)
+    # nothing listens on port 1, so the last granule fails to download
+    unreachable = urls[:2] + ['http://127.0.0.1:1/data/' + granule_name(3)]
+
+    controller = MainController()
+    data = dict(SETTINGS, data_directory=os.path.join(str(tmp_path), 'data'), username='user', password='password',
+                download_attempts=1)
+    hdf_filter = controller.build_hdf_filter(data)
+    storage = controller.get_storage(data)
+
+    for run in range(2):
+        result = controller.download_then_aggregate(data, unreachable, hdf_filter)
+    assert storage.catalog.quarantined([granule_name(3)]) == {}
+    expected = controller.aggregate_hdf_data(controller.build_granules_for_aggregation(data, urls[:2]), hdf_filter)
+    assert_same_results(result, expected)
+
+    del requested[:]
+    controller.download_then_aggregate(data, urls, hdf_filter)
+    assert [path.split('/')[-1] for path in requested if not path.startswith('/login')] == [granule_name(3)]
+    controller.close()
+
+
+@pytest.mark.parametrize('examine_wavenumber_mode', [False, True])
+def test_merged_results_add_up_like_the_granules(tmp_path, examine_wavenumber_mode):
+    granules = write_airs_granules(tmp_path, 3)
+    hdf_filter = MainController.build_hdf_filter(dict(SETTINGS, examine_wavenumber_mode=examine_wavenumber_mode,
+                                                      selected_wavenumber=CHANNELS_TO_WAVELENGTHS['101']))
+
+    expected = calculate_averages_and_filter([extract_granule_dataset(granule, hdf_filter) for granule in granules],
+                                             hdf_filter)
+    results = [extract_granule_dataset(granule, hdf_filter) for granule in granules]
+    merged = calculate_averages_and_filter([merge_results(merge_results(results[0], results[1]), results[2])],
+                                           hdf_filter)
+
+    pd.testing.assert_frame_equal(merged[0], expected[0])
+    assert merged[1] == expected[1]
+    if examine_wavenumber_mode:
+        pd.testing.assert_frame_equal(merged[3].reset_index(drop=True), expected[3].reset_index(drop=True))
@@ -0,0 +1,83 @@
+import os
+
+from classes.catalog import GranuleCatalog
+from classes.granule import DATE_LAYOUT, FLAT_LAYOUT
+from classes.hdf import HDFStorage
+from classes.interface.main_controller import MainController
+from classes.migration import migrate_directory
+from tests.conftest import granule_name, touch
+
+
+def stored_files(directory):
+    return sorted(os.path.relpath(os.path.join(path, name), directory)
+                  for path, _directories, names in os.walk(directory) for name in names
+                  if name.endswith('.hdf') or name.endswith('.npz'))
+
+
+def test_directories_are_migrated_between_layouts(tmp_path):
+    directory = str(tmp_path)
+    for granule in (1, 2):
+        touch(directory, granule_name(granule))
+    touch(directory, granule_name(1)[:-len('.hdf')] + '.npz')
+    os.makedirs(os.path.join(directory, 'unrelated'))
+
+    assert migrate_directory(directory, DATE_LAYOUT, threads=2) == 3
+
+    assert stored_files(directory) == [os.path.join('2013', '001', granule_name(1)),
+                                       os.path.join('2013', '001', granule_name(1)[:-len('.hdf')] + '.npz'),
+                                       os.path.join('2013', '001', granule_name(2))]
+    catalog = GranuleCatalog(directory)
+    assert catalog.layout == DATE_LAYOUT
+    catalog.close()
+    assert migrate_directory(directory, DATE_LAYOUT) == 0
+
+    migrate_directory(directory, FLAT_LAYOUT)
+
+    assert stored_files(directory) == sorted([granule_name(1), granule_name(1)[:-len('.hdf')] + '.npz',
+                                              granule_name(2)])
+    assert sorted(os.listdir(directory)) == sorted(stored_files(directory) + ['granule_catalog.sqlite3',
+                                                                             'unrelated'])
+
+
+def test_only_granules_of_the_data_directory_are_migrated(tmp_path):
+    directory = str(tmp_path)
+    touch(directory, granule_name(1))
+    # a nested cache, and a day directory that does not match the date of the granule (2013-01-01)
+    for subdirectory, granule in ((os.path.join(directory, 'cache'), 2), (os.path.join(directory, '2013', '005'), 3)):
+        os.makedirs(subdirectory)
+        touch(subdirectory, granule_name(granule))
+
+    catalog = GranuleCatalog(directory)
+    assert catalog.layout == FLAT_LAYOUT
+    assert catalog.names() == {granule_name(1)}
+
+    assert migrate_directory(directory, DATE_LAYOUT, catalog) == 1
+    catalog.close()
+
+    assert stored_files(directory) == [os.path.join('2013', '001', granule_name(1)),
+                                       os.path.join('2013', '005', granule_name(3)),
+                                       os.path.join('cache', granule_name(2))]
+
+def test_storage_downloads_into_the_date_layout(tmp_path, granule_server):
+    serve, requested, connections, _ranges = granule_server
+    # 2013-01-01 and 2013-02-01
+    files = {name: os.urandom(100) for name in (granule_name(1), granule_name(2).replace('.01.01.', '.02.01.'))}
+    base_url = serve(files)
+    urls = [base_url + name for name in files]
+    directory = str(tmp_path)
+    touch(directory, granule_name(3))
+    data = {'data_directory': directory, 'data_directory_layout': DATE_LAYOUT, 'username': 'user',
+            'password': 'password'}
+
+    controller = MainController()
+    controller.download_files(data, urls)
+    storage = controller.get_storage(data)
+
+    assert isinstance(storage, HDFStorage) and storage.layout == DATE_LAYOUT
+    paths = [granule.local_file_name for granule in controller.build_granules_for_aggregation(data, urls)]
+    assert [os.path.relpath(path, directory) for path in paths] == [
+        os.path.join('2013', '001', granule_name(1)), os.path.join('2013', '032', urls[1].split('/')[-1])]
+    assert all(os.path.exists(path) for path in paths)
+    # the granule stored before was moved into the layout
+    assert os.path.exists(os.path.join(directory, '2013', '001', granule_name(3)))
+    controller.close()
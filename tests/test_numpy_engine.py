@@ -0,0 +1,141 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from classes.aqua_positions import calculate_lat_lon_filter_condition
+from classes.granule import GranuleArray
+from classes.hdf import extract_granule_dataset
+from classes.interface.main_controller import MainController
+from classes.numpy_engine import CHANNELS, LATITUDE_BUCKETS, latitude_bins
+from classes.transcode import read_hdf_datasets
+from tests.conftest import SETTINGS, airs_granule, granule_name, write_granule
+
+
+@pytest.fixture(scope='module')
+def golden_granules(tmp_path_factory):
+    """Synthetic granules: one with latitudes on every bin edge (and NaN/out of range ones), one crossing the prime
+    meridian, and one that is mostly outside of the areas below"""
+    directory = str(tmp_path_factory.mktemp('granules'))
+    edges = np.concatenate([np.arange(-90, 91, 10), [-95, 95, np.nan], np.linspace(-89, 89, 23)])
+    granules = [airs_granule(1), airs_granule(2, lat_range=(-60, 60)), airs_granule(3, lat_range=(40, 89))]
+    granules[0]['Latitude'] = np.repeat(edges[:, np.newaxis], 30, axis=1)
+    granules[1]['Longitude'] = np.repeat(np.linspace(-20, 20, 30)[np.newaxis, :], 45, axis=0)
+
+    filenames = [granule_name(granule) for granule in range(1, len(granules) + 1)]
+    for filename, datasets in zip(filenames, granules):
+        write_granule(os.path.join(directory, filename), datasets)
+    return list(GranuleArray.from_filenames(filenames, directory))
+
+
+# per-bucket latitude masks of filter_dataset before it switched to latitude_bins and bincount
+REFERENCE_LATITUDE_MASKS = [
+    lambda lat: (lat >= -90) & (lat < -80), lambda lat: (lat >= -80) & (lat < -70),
+    lambda lat: (lat >= -70) & (lat < -60), lambda lat: (lat >= -60) & (lat < -50),
+    lambda lat: (lat >= -50) & (lat < -40), lambda lat: (lat >= -40) & (lat < -30),
+    lambda lat: (lat >= -30) & (lat < -20), lambda lat: (lat >= -20) & (lat < -10),
+    lambda lat: (lat >= -10) & (lat < 0), lambda lat: (lat >= 0) & (lat <= 10),
+    lambda lat: (lat > 10) & (lat <= 20), lambda lat: (lat > 20) & (lat <= 30),
+    lambda lat: (lat > 30) & (lat <= 40), lambda lat: (lat > 40) & (lat <= 50),
+    lambda lat: (lat > 50) & (lat <= 60), lambda lat: (lat > 60) & (lat <= 70),
+    lambda lat: (lat > 70) & (lat <= 80), lambda lat: (lat > 80) & (lat <= 90),
+]
+
+
+def reference_extraction(granule, hdf_filter):
+    """
+    Independent reference for the sums, counts and filter stats of a granule: the DataFrame implementation of
+    filter_dataset as it was before the per-pixel stats and the bincount binning. Every filter stage recounts the
+    selected radiances, and each latitude bucket is sliced out of the radiance and QC frames and summed on its own.
+    """
+    data = read_hdf_datasets(granule.local_file_name)
+    df = pd.DataFrame({name: data[dataset].reshape(-1) for name, dataset in [
+        ('lat', 'Latitude'), ('lon', 'Longitude'), ('land_frac', 'landFrac'), ('cloud_cover', 'TotCld_4_CCfinal'),
+        ('all_spots', 'all_spots_avg'), ('final_noise_amp', 'CCfinal_Noise_Amp'), ('scanang', 'scanang'),
+        ('dust_flag', 'dust_flag'), ('solzen', 'solzen')]})
+    radiances = pd.DataFrame(data['radiances'].reshape(-1, CHANNELS))
+    quality = pd.DataFrame(data['radiances_QC'].reshape(-1, CHANNELS))
+
+    geo_condition = calculate_lat_lon_filter_condition(df, hdf_filter.min_lat, hdf_filter.max_lat, hdf_filter.min_lon,
+                                                       hdf_filter.max_lon, hdf_filter.include_prime_meridian,
+                                                       is_search_area=False)
+    df, radiances, quality = df[geo_condition], radiances[geo_condition], quality[geo_condition]
+
+    def at_most(values, limit, is_max):
+        return values <= limit if is_max else values >= limit
+
+    dust_filters = [hdf_filter.dust_flag_no_dust, hdf_filter.dust_flag_single_fov, hdf_filter.dust_flag_detected]
+    if hdf_filter.inside_scanang:
+        scanang = (df.scanang > -hdf_filter.scanang) & (df.scanang < hdf_filter.scanang)
+    else:
+        scanang = (df.scanang <= -hdf_filter.scanang) & (df.scanang >= hdf_filter.scanang)
+    stages = [
+        at_most(df.land_frac, hdf_filter.landfrac_threshold, hdf_filter.landfrac_threshold_is_max),
+        at_most(df.cloud_cover, hdf_filter.cloud_cover_threshold, hdf_filter.cloud_cover_threshold_is_max),
+        at_most(df.all_spots, hdf_filter.all_spots_avg_threshold, hdf_filter.all_spots_avg_threshold_is_max),
+        (df.final_noise_amp > 0.3333) & (df.final_noise_amp < 0.3334) if hdf_filter.noise_amp else None,
+        scanang,
+        df.dust_flag.isin([index - 1 for index, selected in enumerate(dust_filters) if selected]),
+        at_most(df.solzen, hdf_filter.solzen_threshold, hdf_filter.solzen_is_max),
+    ]
+
+    num_data_points = radiances.count().sum()
+    condition = pd.Series(True, index=df.index)
+    filtered = []
+    for stage in stages:
+        if stage is None:
+            filtered.append(0)
+            continue
+        condition &= stage
+        filtered.append(num_data_points - radiances[condition].count().sum() - sum(filtered))
+
+    quality_filters = [hdf_filter.data_quality_best, hdf_filter.data_quality_enough, hdf_filter.data_quality_worst]
+    quality_values = [index for index, selected in enumerate(quality_filters) if selected]
+    sums, counts = [], []
+    num_filtered_quality = 0
+    for mask in REFERENCE_LATITUDE_MASKS:
+        bucket = mask(df.lat) & condition
+        bucket_radiances = radiances[bucket]
+        selected = bucket_radiances[quality[bucket].isin(quality_values)]
+        num_filtered_quality += bucket_radiances.count().sum() - selected.count().sum()
+        sums.append(selected.sum().to_numpy())
+        counts.append(selected.count().to_numpy())
+
+    landfrac, cloud_cover, all_spots, noise_amp, scanang, dust, solzen = filtered
+    stats = (num_data_points, sum(filtered) + num_filtered_quality, landfrac, cloud_cover, all_spots, noise_amp, dust,
+             num_filtered_quality, scanang, solzen)
+    return np.array(sums), np.array(counts), stats
+
+
+@pytest.mark.parametrize('settings', [
+    {},
+    {'noise_amp': True, 'inside_scanang': False, 'scanang_limit': 20, 'landfrac_threshold_is_max': False,
+     'solzen_is_max': False, 'solzen_threshold': 90, 'data_quality_worst': True, 'dust_flag_detected': True},
+    {'min_latitude': -30, 'max_latitude': 60, 'min_longitude': -10, 'max_longitude': 10,
+     'include_prime_meridian': False, 'TotCld_4_CCfinal_threshold_is_max': False, 'data_quality_best': False},
+    {'min_longitude': -50, 'max_longitude': 50, 'all_spots_avg_threshold_is_max': False},
+])
+@pytest.mark.parametrize('engine', ['pandas', 'numpy'])
+def test_engines_match_the_reference(golden_granules, settings, engine):
+    hdf_filter = MainController.build_hdf_filter(dict(SETTINGS, processing_engine=engine, **settings))
+
+    for granule in golden_granules:
+        sums, counts, stats = reference_extraction(granule, hdf_filter)
+        result = extract_granule_dataset(granule, hdf_filter)
+
+        assert result[1].shape == result[2].shape == (len(LATITUDE_BUCKETS), CHANNELS)
+        np.testing.assert_array_equal(result[2], counts)
+        # the reference sums in float32
+        np.testing.assert_allclose(result[1], sums, rtol=1e-5)
+        assert result[4] == stats
+        assert stats[1] > 0
+        assert result[5] == (granule.local_file_name, pd.DataFrame(read_hdf_datasets(
+            granule.local_file_name)['TotCld_4_CCfinal']).mean().mean())
+
+
+def test_latitude_bins_follow_the_edge_rules():
+    latitude = np.array([-90, -80, -0.5, 0, 10, 10.5, 20, 90, -90.5, 90.5, np.nan])
+
+    assert [LATITUDE_BUCKETS[index] if index >= 0 else None for index in latitude_bins(latitude)] == [
+        '-90to-80', '-80to-70', '-10to0', '0to10', '0to10', '10to20', '10to20', '80to90', None, None, None]
@@ -0,0 +1,186 @@
+import errno
+import os
+import shutil
+import threading
+import zipfile
+
+import pandas as pd
+import pytest
+
+from classes.aqua_positions import AquaPositions, PositionQuery, calculate_footprint_filter_condition
+from classes.granule import Granule
+from classes import position_index
+from classes.position_index import PositionIndex
+
+
+POSITIONS = pd.DataFrame({
+    'year': [2013, 2013, 2013],
+    'day': [2, 1, 1],
+    'granule': [10, 200, 3],
+    'lat': [-2, 20, 85],
+    'lon': [-162, -167, 10],
+    'hdf_filename': ['AIRS.2013.01.02.010.L2.CC_IR.v6.0.11.0.G14092095944.hdf',
+                     'AIRS.2013.01.01.200.L2.CC_IR.v6.0.11.0.G14092100039.hdf',
+                     'AIRS.2013.01.01.003.L2.CC_IR.v6.0.11.0.G14092100040.hdf'],
+    'GCA': [31.3, 47.5, 111.3],
+})
+
+
+def write_positions_zip(directory, data, year=2013):
+    csv_name = 'aqua_positions_%s.csv' % year
+    with zipfile.ZipFile(os.path.join(str(directory), csv_name + '.zip'), 'w') as zipped:
+        zipped.writestr(csv_name, data.to_csv(index=False))
+
+
+def test_index_round_trip(tmp_path):
+    write_positions_zip(tmp_path, POSITIONS)
+    index = PositionIndex(str(tmp_path))
+
+    table = index.get_table(2013, 2013)
+    filenames = index.hdf_filenames(table.year, table.filename_id)
+
+    assert sorted(filenames) == sorted(POSITIONS.hdf_filename)
+    assert 'GCA' not in table
+    assert os.path.isfile(os.path.join(index.index_path(2013), 'VERSION'))
+
+
+def test_index_is_rebuilt_when_zip_changes(tmp_path):
+    write_positions_zip(tmp_path, POSITIONS)
+    PositionIndex(str(tmp_path)).get_table(2013, 2013)
+
+    write_positions_zip(tmp_path, POSITIONS.iloc[:1])
+    os.utime(os.path.join(str(tmp_path), 'aqua_positions_2013.csv.zip'), ns=(0, 0))
+    index = PositionIndex(str(tmp_path))
+
+    assert not index.is_current(2013)
+    assert len(index.get_table(2013, 2013)) == 1
+
+
+def test_concurrent_builders_share_one_index(tmp_path):
+    write_positions_zip(tmp_path, POSITIONS)
+    errors = []
+
+    def read_index():
+        try:
+            assert len(PositionIndex(str(tmp_path)).columns(2013)['key']) == 3
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read_index) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert os.listdir(os.path.join(str(tmp_path), 'index')) == ['2013']
+
+
+def test_index_installed_by_another_process_is_kept(tmp_path, monkeypatch):
+    write_positions_zip(tmp_path, POSITIONS)
+    index = PositionIndex(str(tmp_path))
+    rename = os.rename
+
+    def lose_race(source, destination):
+        # another builder installs its index between the rmtree and the rename
+        shutil.copytree(source, destination)
+        raise OSError(errno.ENOTEMPTY, 'Directory not empty', destination)
+
+    monkeypatch.setattr(position_index.os, 'rename', lose_race)
+    index.build(2013)
+    monkeypatch.setattr(position_index.os, 'rename', rename)
+
+    assert index.is_current(2013)
+    assert os.listdir(os.path.join(str(tmp_path), 'index')) == ['2013']
+    assert len(index.columns(2013)['key']) == 3
+
+
+def test_rows_are_sorted_by_granule_key(tmp_path):
+    write_positions_zip(tmp_path, POSITIONS)
+    table = PositionIndex(str(tmp_path)).get_table(2013, 2013)
+
+    assert list(table.key) == [2013001003, 2013001200, 2013002010]
+
+
+range_test_cases = [
+    # start_key, end_key, expected granules
+    [2013001001, 2013001240, [3, 200]],
+    [2013001004, 2013002010, [200, 10]],
+    [2013001004, 2013001199, []],
+    [2013002010, 2013002010, [10]],
+]
+
+
+@pytest.mark.parametrize('test_case', range_test_cases)
+def test_get_range(tmp_path, test_case):
+    write_positions_zip(tmp_path, POSITIONS)
+    table = PositionIndex(str(tmp_path)).get_range(test_case[0], test_case[1])
+
+    assert list(table.granule) == test_case[2]
+
+
+def test_batch_query_matches_single_queries():
+    start_granule, end_granule = Granule(2013, 300, 100), Granule(2013, 302, 180)
+    queries = [
+        PositionQuery(-30, -50, 30, 50, True, 0, False),
+        PositionQuery(60, -180, 90, -0.001, False, 100, False),
+        PositionQuery(-90, 20, -80, 40, True, 90, True),
+    ]
+    aqua_positions = AquaPositions()
+
+    urls_by_query, all_urls = aqua_positions.get_hdf_urls_for_queries(start_granule, end_granule, queries)
+
+    expected_union = set()
+    for query, urls in zip(queries, urls_by_query):
+        expected = list(aqua_positions.get_hdf_urls(
+            start_granule, end_granule, query.min_latitude, query.min_longitude, query.max_latitude,
+            query.max_longitude, query.include_prime_meridian, query.gca_threshold, query.gca_is_max, False))
+        assert urls == expected
+        expected_union.update(expected)
+
+    assert all_urls == sorted(expected_union)
+
+
+footprint_test_cases = [
+    # west, north, east, south, (min_lat, min_lon, max_lat, max_lon, include_prime_meridian), selected
+    [-60, 5, -40, -15, (-10, -30, 10, 30, True), False],  # derived footprint would reach the area, real one does not
+    [-40, 5, -20, -15, (-10, -30, 10, 30, True), True],
+    [170, 5, -170, -15, (-10, 160, 10, 175, False), True],  # crosses the antimeridian
+    [170, 5, -170, -15, (-10, -175, 10, -160, False), True],
+    [170, 5, -170, -15, (-10, -160, 10, 160, True), False],
+    [10, 90, 20, 75, (80, -100, 90, -90, False), True],  # crosses the north pole
+]
+
+
+@pytest.mark.parametrize('test_case', footprint_test_cases)
+def test_footprint_selection(tmp_path, test_case):
+    west, north, east, south, area, selected = test_case
+    positions = POSITIONS.iloc[:1].copy()
+    positions['lat'], positions['lon'] = (north + south) / 2, -50
+    positions['west'], positions['north'], positions['east'], positions['south'] = west, north, east, south
+    write_positions_zip(tmp_path, positions)
+    min_lat, min_lon, max_lat, max_lon, include_prime_meridian = area
+
+    data = PositionIndex(str(tmp_path)).get_table(2013, 2013)
+    condition = calculate_footprint_filter_condition(data, min_lat, max_lat, min_lon, max_lon,
+                                                     include_prime_meridian)
+
+    assert list(condition) == [selected]
+
+
+def test_gca_reference():
+    start_granule, end_granule = Granule(2013, 300, 1), Granule(2013, 300, 240)
+    aqua_positions = AquaPositions()
+
+    subsolar = aqua_positions.get_hdf_urls(start_granule, end_granule, -90, -180, 90, 180, True, 0, False, True)
+    antisolar = aqua_positions.get_hdf_urls(start_granule, end_granule, -90, -180, 90, 180, True, 0, False, True,
+                                            'antisolar')
+    fixed = aqua_positions.get_hdf_urls(start_granule, end_granule, -90, -180, 90, 180, True, 0, False, True,
+                                        [90, 0])
+
+    assert list(subsolar.hdf_filename) == list(antisolar.hdf_filename)
+    assert ((subsolar.GCA + antisolar.GCA - 180).abs() <= 0.1).all()
+    assert ((fixed.GCA - (90 - fixed.lat)).abs() <= 0.1).all()
+
+    with pytest.raises(ValueError):
+        aqua_positions.get_hdf_urls(start_granule, end_granule, -90, -180, 90, 180, True, 0, False, True, 'lunar')
@@ -0,0 +1,125 @@
+import os
+
+from classes.hdf import HDFStorage
+from classes.interface import prefetcher as prefetcher_module
+from classes.interface.prefetcher import BatchPrefetcher
+from tests.conftest import granule_name
+
+
+class BatchController(object):
+    """Stands in for MainController: batch i of the data list selects the URLs urls_by_batch[i]"""
+
+    def __init__(self, storage, urls_by_batch):
+        self.storage = storage
+        self.urls_by_batch = urls_by_batch
+
+    @staticmethod
+    def get_granules(data):
+        return data['batch'], data['batch']
+
+    def get_urls_for_granules(self, data, batch, _end):
+        return self.urls_by_batch[batch]
+
+    def get_storage(self, data):
+        return self.storage
+
+
+def stored(directory, urls):
+    return sum(os.path.exists(os.path.join(directory, url.split('/')[-1])) for url in urls)
+
+
+def test_prefetch_respects_lookahead_and_disk_budget(tmp_path, granule_server, monkeypatch):
+    monkeypatch.setattr(prefetcher_module, 'PREFETCH_CHUNK_SIZE', 2)
+    serve, requested, connections, ranges_requested = granule_server
+    files = {granule_name(g): os.urandom(1000) for g in range(1, 16)}
+    base_url = serve(files)
+    names = list(files)
+    urls_by_batch = [[base_url + name for name in names[i * 5:i * 5 + 5]] for i in range(3)]
+    directory = str(tmp_path)
+    storage = HDFStorage(directory, 'user', 'password')
+    data_list = [{'batch': i, 'data_directory': directory} for i in range(3)]
+
+    prefetcher = BatchPrefetcher(BatchController(storage, urls_by_batch), data_list, batches_ahead=1,
+                                 disk_budget=2500)
+    prefetcher.start()
+    prefetcher.selected(0)
+
+    # batch 2 is prefetched in chunks of 2 files until the budget is used up, batch 3 is too far ahead
+    assert prefetcher.wait_until_paused(timeout=10)
+    assert prefetcher.prefetched_bytes == 4000
+    assert stored(directory, urls_by_batch[1]) == 4
+    assert stored(directory, urls_by_batch[0] + urls_by_batch[2]) == 0
+
+    # once batch 2 starts, its files no longer count and batch 3 is prefetched
+    prefetcher.claim(1)
+    prefetcher.selected(1)
+    storage.download_files(urls_by_batch[1])
+    assert prefetcher.wait_until_paused(timeout=10)
+    assert stored(directory, urls_by_batch[2]) == 4
+    prefetcher.stop()
+
+    assert stored(directory, urls_by_batch[0]) == 0
+    # the last file of batch 3 waits for the budget
+    assert len(set(path.split('/')[-1] for path in requested)) == 9
+
+
+def test_prefetch_waits_for_the_selection_of_the_current_batch(tmp_path, granule_server):
+    serve, requested, connections, ranges_requested = granule_server
+    urls_by_batch = [[], [serve({granule_name(1): os.urandom(1000)}) + granule_name(1)]]
+    directory = str(tmp_path)
+    storage = HDFStorage(directory, 'user', 'password')
+    data_list = [{'batch': i, 'data_directory': directory} for i in range(2)]
+    first_batch_selected = []
+
+    class SelectionController(BatchController):
+        def get_urls_for_granules(self, data, batch, _end):
+            first_batch_selected.append(prefetcher._selected >= 0)
+            return super(SelectionController, self).get_urls_for_granules(data, batch, _end)
+
+    prefetcher = BatchPrefetcher(SelectionController(storage, urls_by_batch), data_list)
+    prefetcher.start()
+    prefetcher.selected(0)
+    assert prefetcher.wait_until_paused(timeout=10)
+    prefetcher.stop()
+    assert stored(directory, urls_by_batch[1]) == 1
+
+    # batch 2 was only selected once the selection of batch 1 had finished
+    assert first_batch_selected == [True]
+
+
+def test_prefetch_downloads_the_union_of_files_that_run_a_batch_together(tmp_path, granule_server, monkeypatch):
+    monkeypatch.setattr(prefetcher_module, 'PREFETCH_CHUNK_SIZE', 2)
+    serve, requested, connections, ranges_requested = granule_server
+    files = {granule_name(g): os.urandom(1000) for g in range(1, 8)}
+    base_url = serve(files)
+    urls = [base_url + name for name in files]
+    directory = str(tmp_path)
+    storage = HDFStorage(directory, 'user', 'password')
+    # the files of a batch directory that select overlapping granules of batch 2
+    urls_by_file = {'west': urls[:4], 'east': urls[2:6]}
+    batch_queries = []
+
+    class DirectoryController(BatchController):
+        def get_urls_for_batch(self, data_items):
+            batch_queries.append([data['file'] for data in data_items])
+            urls_by_item = [urls_by_file[data['file']] for data in data_items]
+            return urls_by_item, sorted(set(url for item_urls in urls_by_item for url in item_urls))
+
+    data_list = [[{'batch': i, 'file': name, 'data_directory': directory} for name in urls_by_file] for i in range(2)]
+    data_list.append({'batch': 2, 'data_directory': directory})
+
+    prefetcher = BatchPrefetcher(DirectoryController(storage, [[], [], urls[6:]]), data_list, disk_budget=3500)
+    prefetcher.start()
+    prefetcher.selected(0)
+    assert prefetcher.wait_until_paused(timeout=10)
+
+    # the union is selected in one query and downloaded once, within the disk budget
+    assert batch_queries == [['west', 'east']]
+    assert stored(directory, urls[:6]) == 4
+    assert len(set(path.split('/')[-1] for path in requested)) == 4
+
+    prefetcher.claim(1)
+    prefetcher.selected(1)
+    assert prefetcher.wait_until_paused(timeout=10)
+    prefetcher.stop()
+    assert stored(directory, urls[6:]) == 1
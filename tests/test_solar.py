@@ -0,0 +1,57 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from classes.calculate_GCA import calculate_central_angle, calculate_subsolar_point
+from classes.solar import SUBSOLAR_POINT_TOLERANCE, central_angle, granule_times, subsolar_point, \
+    subsolar_points_for_granules
+
+
+def random_times(count, seed=0):
+    rng = np.random.default_rng(seed)
+    start, end = pd.Timestamp('2002-01-01').value, pd.Timestamp('2030-12-31').value
+    return pd.to_datetime(rng.integers(start, end, count), utc=True)
+
+
+def test_subsolar_point_matches_ephem():
+    times = random_times(300)
+
+    latitude, longitude = subsolar_point(times.tz_localize(None).to_numpy())
+
+    for time, lat, lon in zip(times, latitude, longitude):
+        expected = calculate_subsolar_point({'time': time})
+        assert abs(lat - expected['subsolar lat']) < SUBSOLAR_POINT_TOLERANCE
+        assert abs((lon - expected['subsolar lon'] + 180) % 360 - 180) < SUBSOLAR_POINT_TOLERANCE
+
+
+def test_central_angle_matches_row_formula():
+    rng = np.random.default_rng(1)
+    lat, lon, reference_lat, reference_lon = rng.uniform(-90, 90, 4), rng.uniform(-180, 180, 4), \
+        rng.uniform(-23, 23, 4), rng.uniform(-180, 180, 4)
+
+    angles = central_angle(lat, lon, reference_lat, reference_lon)
+
+    for i, angle in enumerate(angles):
+        row = calculate_central_angle({'lat': lat[i], 'lon': lon[i], 'subsolar lat': reference_lat[i],
+                                       'subsolar lon': reference_lon[i]})
+        assert round(angle, 1) == row['GCA']
+
+
+def test_granule_times():
+    times = granule_times([2013, 2016], [1, 366], [1, 240])
+
+    assert list(pd.to_datetime(times)) == [
+        datetime.datetime(2013, 1, 1, 0, 8, 26),
+        datetime.datetime(2016, 12, 31, 0, 0, 0) + datetime.timedelta(minutes=239 * 6, seconds=8 * 60 + 26),
+    ]
+
+
+def test_subsolar_table_matches_direct_calculation():
+    year, day, granule = [2004, 2004, 2019], [1, 366, 200], [1, 240, 120]
+
+    table_latitude, table_longitude = subsolar_points_for_granules(year, day, granule)
+    latitude, longitude = subsolar_point(granule_times(year, day, granule))
+
+    assert np.allclose(table_latitude, latitude)
+    assert np.allclose(table_longitude, longitude)
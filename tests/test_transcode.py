@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from classes import transcode
+from classes.catalog import CATALOG_FILENAME, GranuleCatalog
+from classes.granule import DATE_LAYOUT
+from classes.hdf import extract_granule_dataset
+from classes.interface.main_controller import MainController
+from classes.migration import migrate_directory
+from tests.conftest import SETTINGS, serve_airs_granules, write_airs_granules
+
+
+def test_extraction_reads_transcoded_granules(tmp_path, monkeypatch):
+    granule = list(write_airs_granules(tmp_path, 1))[0]
+    hdf_filter = MainController.build_hdf_filter(dict(SETTINGS, transcode_granules=True))
+
+    expected = extract_granule_dataset(granule, hdf_filter)
+
+    transcoded = transcode.transcoded_file_name(granule.local_file_name)
+    with np.load(transcoded) as f:
+        assert sorted(f.files) == sorted(transcode.GRANULE_DATASETS)
+        assert (f['radiances'].dtype, f['radiances_QC'].dtype) == (np.float32, np.uint8)
+
+    def read_hdf_datasets(_filename):
+        raise AssertionError('the HDF file was read')
+
+    monkeypatch.setattr(transcode, 'read_hdf_datasets', read_hdf_datasets)
+    result = extract_granule_dataset(granule, hdf_filter)
+
+    for expected_buckets, buckets in zip(expected[1:3], result[1:3]):
+        np.testing.assert_array_equal(buckets, expected_buckets)
+    assert result[4:] == expected[4:]
+
+
+def test_stale_transcoded_granules_are_not_used(tmp_path):
+    granule = list(write_airs_granules(tmp_path, 1))[0]
+    filename = granule.local_file_name
+    assert transcode.transcode_granule(filename) == (filename, None)
+    transcoded = transcode.transcoded_file_name(filename)
+    assert transcode.has_current_transcoded(filename)
+
+    # the granule was downloaded again after it was transcoded
+    os.utime(transcoded, ns=(os.stat(filename).st_mtime_ns - 10 ** 9,) * 2)
+
+    assert not transcode.has_current_transcoded(filename)
+    assert transcode.read_transcoded(filename) is None
+    assert transcode.transcode_directory(str(tmp_path), processes=1) == []
+    assert transcode.has_current_transcoded(filename)
+
+
+def test_granules_can_be_kept_transcoded_only(tmp_path, granule_server):
+    serve, requested, _connections, _ranges = granule_server
+    urls = serve_airs_granules(tmp_path, serve, 2)
+    names = [url.split('/')[-1] for url in urls]
+    directory = os.path.join(str(tmp_path), 'data')
+    data = dict(SETTINGS, transcode_granules=True, drop_transcoded_hdf=True, data_directory=directory,
+                granule_cache_directory=os.path.join(str(tmp_path), 'cache'), username='user', password='password')
+    controller = MainController()
+    hdf_filter = controller.build_hdf_filter(data)
+
+    expected = controller.download_then_aggregate(data, urls, hdf_filter)
+
+    assert sorted(name for name in os.listdir(directory) if not name.startswith(CATALOG_FILENAME)) == sorted(
+        transcode.transcoded_file_name(name) for name in names)
+
+    # neither downloaded nor linked from the granule cache again
+    del requested[:]
+    result = controller.download_then_aggregate(data, urls, hdf_filter)
+    assert requested == []
+    assert not [name for name in os.listdir(directory) if name.endswith('.hdf')]
+    pd.testing.assert_frame_equal(result[0], expected[0])
+    catalog = controller.get_storage(data).catalog
+    assert catalog.transcoded(names) == set(names) and len(catalog) == 0
+    controller.close()
+
+    # a new catalog finds them, and they are migrated like HDF files
+    for name in os.listdir(directory):
+        if name.startswith(CATALOG_FILENAME):
+            os.remove(os.path.join(directory, name))
+    migrate_directory(directory, DATE_LAYOUT)
+    catalog = GranuleCatalog(directory)
+    assert catalog.transcoded(names) == set(names) and catalog.layout == DATE_LAYOUT
+    catalog.close()
+    assert sorted(os.listdir(os.path.join(directory, '2013', '001'))) == sorted(
+        transcode.transcoded_file_name(name) for name in names)
+
+
+def test_hdf_files_are_only_dropped_when_the_transcoded_file_matches(tmp_path):
+    filename = list(write_airs_granules(tmp_path, 1))[0].local_file_name
+    datasets = transcode.read_hdf_datasets(filename)
+    transcode.write_transcoded(filename, dict(datasets, radiances=datasets['radiances'] + 1))
+
+    assert transcode.transcode_granule(filename, drop_hdf=True)[1] is not None
+    assert os.path.exists(filename)
+
+    transcode.write_transcoded(filename, datasets)
+    assert transcode.transcode_directory(str(tmp_path), processes=1, drop_hdf=True) == []
+    assert not os.path.exists(filename) and transcode.has_current_transcoded(filename)
@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+
+from classes.download import file_md5
+from classes.catalog import GranuleCatalog
+from classes.hdf import HDFStorage
+from classes.verification import needs_reading, verify_directory, verify_files
+from tests.conftest import granule_name, write_granule
+
+
+def test_downloads_are_recorded(tmp_path, granule_server):
+    serve, requested, connections, ranges_requested = granule_server
+    files = {granule_name(g): os.urandom(1000) for g in range(1, 4)}
+    base_url = serve(files)
+
+    storage = HDFStorage(str(tmp_path), 'user', 'password')
+    storage.download_files([base_url + name for name in files])
+    storage.close()
+
+    catalog = GranuleCatalog(str(tmp_path))
+    for name, body in files.items():
+        filename = os.path.join(str(tmp_path), name)
+        assert catalog.get(name)['size'] == 1000
+        assert catalog.get(name)['md5'] == file_md5(filename)
+        assert not needs_reading(filename, catalog.get(name))
+
+
+def test_corrupt_files_are_downloaded_again(tmp_path, granule_server):
+    serve, requested, connections, ranges_requested = granule_server
+    files = {granule_name(g): os.urandom(1000) for g in range(1, 4)}
+    urls = [serve(files) + name for name in files]
+    storage = HDFStorage(str(tmp_path), 'user', 'password')
+    storage.download_files(urls)
+
+    # one granule is truncated, another one is corrupted in place
+    with open(os.path.join(str(tmp_path), granule_name(1)), 'r+b') as f:
+        f.truncate(500)
+    with open(os.path.join(str(tmp_path), granule_name(2)), 'r+b') as f:
+        f.write(b'corrupt')
+    del requested[:]
+
+    assert storage.download_files(urls)
+
+    assert set(path.split('/')[-1] for path in requested) == {granule_name(1), granule_name(2)}
+    for name, body in files.items():
+        with open(os.path.join(str(tmp_path), name), 'rb') as f:
+            assert f.read() == body
+
+
+def test_unrecorded_granules_are_checked_with_hdf4(tmp_path):
+    readable = os.path.join(str(tmp_path), granule_name(1))
+    unreadable = os.path.join(str(tmp_path), granule_name(2))
+    write_granule(readable, {'Latitude': np.zeros((45, 30))})
+    with open(unreadable, 'wb') as f:
+        f.write(b'<html>Earthdata login</html>')
+    catalog = GranuleCatalog(str(tmp_path))
+    assert catalog.get(granule_name(1)) == {'size': os.path.getsize(readable), 'md5': None, 'verified_mtime': None}
+
+    failed = verify_files([readable, unreadable], catalog, processes=2)
+
+    assert failed == [(unreadable, 'not a readable HDF file')]
+    assert catalog.get(granule_name(1))['md5'] == file_md5(readable)
+    assert granule_name(2) not in catalog
+
+
+def test_verify_directory(tmp_path):
+    write_granule(os.path.join(str(tmp_path), granule_name(1)), {'Latitude': np.zeros((45, 30))})
+    with open(os.path.join(str(tmp_path), granule_name(2)), 'wb') as f:
+        f.write(b'truncated')
+
+    assert verify_directory(str(tmp_path)) == 1
+
+    assert sorted(name for name in os.listdir(str(tmp_path)) if name.endswith('.hdf')) == [granule_name(1)]
@@ -0,0 +1,27 @@
+"""
+Transcodes every granule of a data directory into a compressed .npz file with only the datasets the analysis reads
+(see classes/transcode.py), using all available cores. Later runs read the transcoded files instead of the HDF files.
+Granules that already have a current transcoded file are skipped.
+
+The transcoded files take extra space next to the HDF files. With --drop-hdf, each HDF file is deleted once its
+transcoded file is verified to hold the same datasets, and the granule is not downloaded again.
+
+    python transcode_granules.py [--drop-hdf] <data directory>
+"""
+import sys
+
+from classes.transcode import transcode_directory
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    drop_hdf = '--drop-hdf' in arguments
+    if drop_hdf:
+        arguments.remove('--drop-hdf')
+    if len(arguments) != 1:
+        print(__doc__)
+        exit(1)
+
+    failed = transcode_directory(arguments[0], drop_hdf=drop_hdf)
+    for filename, problem in failed:
+        print('Could not transcode %s: %s' % (filename, problem))
+    print('Finished, %s granules could not be transcoded.' % len(failed))
@@ -0,0 +1,18 @@
+"""
+Verifies every granule of a data directory against its catalog (expected size and MD5 checksum), reading files in
+parallel on all available cores. Files that fail are deleted, so the next run downloads them again. Granules without a
+checksum in the catalog are accepted if HDF4 can open them, and their checksum is recorded.
+
+    python verify_granules.py <data directory>
+"""
+import sys
+
+from classes.verification import verify_directory
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print(__doc__)
+        exit(1)
+
+    deleted = verify_directory(sys.argv[1])
+    print('Finished, %s granules deleted.' % deleted)